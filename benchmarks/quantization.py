@@ -0,0 +1,111 @@
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from coordgen.models import AutoModelForCoordinationGeneration
+
+SAMPLES = [
+    ("Gold will retain its gain, he said.", (10, 25)),
+    ("The market rose sharply on Friday.", (11, 23)),
+    ("Prices of stocks fell in early trading.", (0, 16)),
+    ("The company said it expects higher profits this year.", (28, 42)),
+    ("Analysts were surprised by the strong results.", (14, 23)),
+    ("The board approved the plan last week.", (10, 27)),
+    ("Investors sold shares of technology companies.", (10, 21)),
+    ("The bank raised its forecast for next year.", (9, 28)),
+]
+
+SETTINGS: Dict[str, Dict[str, Any]] = {
+    "float32": {},
+    "bfloat16": {"torch_dtype": torch.bfloat16},
+    "int8": {"quantization": "int8"},
+}
+
+
+def load_inputs(input_file: Optional[str]) -> List[Tuple[str, Tuple[int, int]]]:
+    # NOTE: each line of `input_file` is `raw<TAB>start<TAB>end`
+    if input_file is None:
+        return list(SAMPLES)
+    inputs = []
+    with open(input_file) as f:
+        for line in f:
+            raw, start, end = line.rstrip("\n").split("\t")
+            inputs.append((raw, (int(start), int(end))))
+    return inputs
+
+
+def benchmark(
+    model_name_or_path: str,
+    input_file: Optional[str] = None,
+    batch_size: int = 8,
+    num_repeats: int = 3,
+    num_threads: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    inputs = load_inputs(input_file)
+    reference = None
+    results = []
+    for name, kwargs in SETTINGS.items():
+        model = AutoModelForCoordinationGeneration.from_pretrained(
+            model_name_or_path, num_threads=num_threads, **kwargs
+        )
+        model.generate(inputs[:batch_size])  # warm up
+
+        elapsed = []
+        for _ in range(num_repeats):
+            start = time.perf_counter()
+            outputs = [
+                output
+                for i in range(0, len(inputs), batch_size)
+                for output in model.generate(inputs[i : i + batch_size])
+            ]
+            elapsed.append(time.perf_counter() - start)
+
+        # NOTE: quality is measured as the agreement of the generated conjuncts with float32
+        conjuncts = [text[slice(*coord.conjuncts[1])] for text, coord in outputs]
+        if reference is None:
+            reference = conjuncts
+        agreement = sum(a == b for a, b in zip(conjuncts, reference)) / len(inputs)
+
+        best = min(elapsed)
+        results.append(
+            {
+                "setting": name,
+                "sentences_per_second": len(inputs) / best,
+                "latency_per_batch_ms": 1000 * best * batch_size / len(inputs),
+                "agreement": agreement,
+                "parameter_bytes": _parameter_bytes(model.model),
+            }
+        )
+    return results
+
+
+def _parameter_bytes(model: torch.nn.Module) -> int:
+    # NOTE: the packed weights of quantized layers are not parameters and are counted separately
+    size = sum(
+        t.numel() * t.element_size()
+        for t in model.state_dict().values()
+        if isinstance(t, torch.Tensor) and t.is_floating_point()
+    )
+    for m in model.modules():
+        if isinstance(m, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = m._weight_bias()
+            size += weight.numel() * weight.element_size()
+            size += 0 if bias is None else bias.numel() * bias.element_size()
+    return size
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="t5-small")
+    parser.add_argument("--input_file")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_repeats", type=int, default=3)
+    parser.add_argument("--num_threads", type=int)
+    args = parser.parse_args()
+    for result in benchmark(
+        args.model, args.input_file, args.batch_size, args.num_repeats, args.num_threads
+    ):
+        print(json.dumps(result))
@@ -0,0 +1,77 @@
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional
+
+# NOTE: each case runs in a fresh interpreter and prints the seconds spent in `STEP`
+CASES = {
+    "import_coordgen": "import coordgen",
+    "import_coordgen_models": "import coordgen.models",
+    "import_auto_class": "from coordgen.models import AutoModelForCoordinationGeneration",
+    "from_pretrained": (
+        "from coordgen.models import AutoModelForCoordinationGeneration\n"
+        "model = AutoModelForCoordinationGeneration.from_pretrained({path!r}, **{kwargs!r})"
+    ),
+    "first_generate": (
+        "from coordgen.models import AutoModelForCoordinationGeneration\n"
+        "model = AutoModelForCoordinationGeneration.from_pretrained({path!r}, **{kwargs!r})\n"
+        "model.generate([('Gold will retain its gain, he said.', (10, 25))])"
+    ),
+}
+
+TEMPLATE = """
+import time
+start = time.perf_counter()
+{step}
+print(time.perf_counter() - start)
+"""
+
+
+def measure(step: str, num_repeats: int) -> Dict[str, float]:
+    elapsed = []
+    for _ in range(num_repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", TEMPLATE.format(step=step)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        elapsed.append(float(output.split()[-1]))
+    return {"median_seconds": statistics.median(elapsed), "min_seconds": min(elapsed)}
+
+
+def benchmark(
+    model_name_or_path: str, quantization: Optional[str] = None, num_repeats: int = 3
+) -> List[Dict[str, Any]]:
+    kwargs = {"quantization": quantization} if quantization else {}
+    results = []
+    for name, step in CASES.items():
+        step = step.format(path=model_name_or_path, kwargs=kwargs)
+        results.append({"case": name, **measure(step, num_repeats)})
+
+    # NOTE: the same model restored from a snapshot, which is converted before it is saved
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        subprocess.run(
+            [sys.executable, "-m", "coordgen.models.snapshot", model_name_or_path, snapshot_dir]
+            + (["--quantization", quantization] if quantization else []),
+            check=True,
+            capture_output=True,
+        )
+        for name in ("from_pretrained", "first_generate"):
+            step = CASES[name].format(path=snapshot_dir, kwargs={})
+            results.append({"case": f"{name}_snapshot", **measure(step, num_repeats)})
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="t5-small")
+    parser.add_argument("--quantization", choices=["int8"])
+    parser.add_argument("--num_repeats", type=int, default=3)
+    args = parser.parse_args()
+    for result in benchmark(args.model, args.quantization, args.num_repeats):
+        print(json.dumps(result))
@@ -0,0 +1,307 @@
+import io
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import torch
+import transformers
+from coordgen import CoordinationGenerator, Span
+from coordgen.models import BertForCoordinationGeneration, T5ForCoordinationGeneration
+from coordgen.models.modeling_t5 import T5ForConditionalGeneration
+from tokenizers import Tokenizer, models, pre_tokenizers
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples"))
+
+from common.data import Sentence, parse_trees  # noqa: E402
+from common.selectors import (  # noqa: E402
+    ConstituentSpanIndex,
+    IndexedConstituentSelector,
+    RandomConstituentSelector,
+)
+from common.treebank import parse_compact_trees  # noqa: E402
+
+WORDS = [f"w{i}" for i in range(200)] + ["and", "or", ",", "."]
+LABELS = ["NP", "VP", "PP", "ADJP", "S"]
+
+
+def tiny_t5(max_length: int = 16, **kwargs) -> T5ForCoordinationGeneration:
+    special = ["<pad>", "</s>", "<unk>", "<extra_id_0>", "<extra_id_1>"]
+    tokenizer = _tokenizer(
+        special,
+        pad_token="<pad>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        additional_special_tokens=special[3:],
+        # NOTE: bounds the number of decoding steps of the randomly initialized model
+        model_max_length=max_length,
+    )
+    torch.manual_seed(0)
+    config = transformers.T5Config(
+        vocab_size=len(tokenizer),
+        d_model=64,
+        d_ff=128,
+        d_kv=16,
+        num_layers=2,
+        num_heads=4,
+        decoder_start_token_id=0,
+        pad_token_id=0,
+        eos_token_id=1,
+    )
+    return T5ForCoordinationGeneration(T5ForConditionalGeneration(config), tokenizer, **kwargs)
+
+
+def tiny_bert(**kwargs) -> BertForCoordinationGeneration:
+    special = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    tokenizer = _tokenizer(
+        special,
+        pad_token="[PAD]",
+        unk_token="[UNK]",
+        cls_token="[CLS]",
+        sep_token="[SEP]",
+        mask_token="[MASK]",
+    )
+    tokenizer._tokenizer.post_processor = _bert_post_processor(tokenizer)
+    torch.manual_seed(0)
+    config = transformers.BertConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=128,
+    )
+    return BertForCoordinationGeneration(transformers.BertForMaskedLM(config), tokenizer, **kwargs)
+
+
+def _tokenizer(special: List[str], **kwargs) -> transformers.PreTrainedTokenizerFast:
+    vocab = {w: i for i, w in enumerate(special + WORDS)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token=kwargs["unk_token"]))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.add_special_tokens(special)
+    return transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, **kwargs)
+
+
+def _bert_post_processor(tokenizer: transformers.PreTrainedTokenizerFast):
+    from tokenizers.processors import TemplateProcessing
+
+    cls_id, sep_id = tokenizer.cls_token_id, tokenizer.sep_token_id
+    return TemplateProcessing(
+        single="[CLS] $A [SEP]",
+        pair="[CLS] $A [SEP] $B:1 [SEP]:1",
+        special_tokens=[("[CLS]", cls_id), ("[SEP]", sep_id)],
+    )
+
+
+def make_inputs(num: int, length: int, seed: int = 0) -> List[Tuple[str, Span]]:
+    rng = random.Random(seed)
+    inputs = []
+    for _ in range(num):
+        tokens = [rng.choice(WORDS[:200]) for _ in range(length)]
+        start = rng.randrange(length - 1)
+        end = rng.randrange(start + 1, min(start + 4, length) + 1)
+        raw = " ".join(tokens)
+        char_start = len(" ".join(tokens[:start])) + (1 if start else 0)
+        inputs.append((raw, (char_start, len(" ".join(tokens[:end])))))
+    return inputs
+
+
+def make_treebank(num: int, length: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+
+    def _tree(words: List[str]) -> str:
+        if len(words) == 1:
+            return f"(NN {words[0]})"
+        split = rng.randrange(1, len(words))
+        return f"({rng.choice(LABELS)} {_tree(words[:split])} {_tree(words[split:])})"
+
+    return "".join(
+        f"( {_tree([rng.choice(WORDS[:200]) for _ in range(length)])})\n" for _ in range(num)
+    )
+
+
+def measure(fn: Callable[[], Any], num_items: int, repeats: int) -> Dict[str, float]:
+    fn()  # warm up
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "items_per_second": num_items * len(latencies) / sum(latencies),
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+        # NOTE: the peak resident set size of the process, which runs this case alone
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _peak_rss_mb() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+
+def generator_cases(
+    batch_sizes: Sequence[int], lengths: Sequence[int], beam_widths: Sequence[int]
+) -> Iterable[Dict[str, Any]]:
+    for length in lengths:
+        for batch_size in batch_sizes:
+            params = {"batch_size": batch_size, "length": length}
+            for k in beam_widths:
+                yield {"name": f"t5/beam{k}", **params, "num_beams": k}
+            yield {"name": "bert/argmax", **params}
+
+
+def data_cases(num_trees: int, length: int) -> Iterable[Dict[str, Any]]:
+    for name in DATA_CASES:
+        yield {"name": name, "num_trees": num_trees, "length": length}
+
+
+DATA_CASES = [
+    "data/parse_trees",
+    "data/parse_compact_trees",
+    "data/random_constituent_selector",
+    "data/indexed_constituent_selector",
+    "data/span_index_sample_all",
+]
+
+
+def run_case(case: Dict[str, Any], repeats: int) -> Dict[str, float]:
+    name = case["name"]
+    if name in DATA_CASES:
+        fn = _data_case(name, make_treebank(case["num_trees"], case["length"]))
+        return measure(fn, case["num_trees"], repeats)
+
+    model: CoordinationGenerator
+    if name == "bert/argmax":
+        model = tiny_bert()
+    else:
+        model = tiny_t5(num_beam=case["num_beams"])
+    inputs = make_inputs(case["batch_size"], case["length"])
+    return measure(lambda: model.generate(inputs), case["batch_size"], repeats)
+
+
+def _data_case(name: str, text: str) -> Callable[[], Any]:
+    if name == "data/parse_trees":
+        return lambda: list(parse_trees(io.StringIO(text)))
+    if name == "data/parse_compact_trees":
+        return lambda: list(parse_compact_trees(io.StringIO(text)))
+
+    sentences = [Sentence(" ".join(t.leaves()), t) for t in parse_compact_trees(text)]
+    if name == "data/random_constituent_selector":
+        selector = RandomConstituentSelector()
+        return lambda: [selector(s, 2) for s in sentences]
+    index = ConstituentSpanIndex.build(sentences)
+    if name == "data/indexed_constituent_selector":
+        indexed = IndexedConstituentSelector(index)
+        return lambda: [indexed(s, 2) for s in sentences]
+    return lambda: list(index.sample_all(2, seed=0))
+
+
+def run_isolated(case: Dict[str, Any], repeats: int) -> Dict[str, Any]:
+    # NOTE: each case runs in a fresh interpreter, as `ru_maxrss` is the peak of the whole
+    # process and would otherwise carry over from the cases before it
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--case", json.dumps(case)]
+        + ["--repeats", str(repeats)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return {**case, **json.loads(output.splitlines()[-1])}
+
+
+def environment() -> Dict[str, str]:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "num_threads": str(torch.get_num_threads()),
+    }
+
+
+def compare(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], threshold: float
+) -> List[str]:
+    # Returns the cases whose throughput dropped by more than `threshold` from the baseline.
+    def _key(r):
+        return tuple(sorted((k, v) for k, v in r.items() if not isinstance(v, float)))
+
+    base = {_key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get(_key(r))
+        if b is None:
+            continue
+        ratio = r["items_per_second"] / b["items_per_second"]
+        if ratio < 1 - threshold:
+            regressions.append(f"{r['name']} {dict(_key(r))}: {ratio:.2f}x of baseline")
+    return regressions
+
+
+def run(
+    output: Optional[str] = None,
+    baseline: Optional[str] = None,
+    threshold: float = 0.1,
+    batch_sizes: Sequence[int] = (1, 8, 32),
+    lengths: Sequence[int] = (10, 30),
+    beam_widths: Sequence[int] = (1, 4),
+    num_trees: int = 2000,
+    repeats: int = 5,
+) -> int:
+    results = []
+    cases = list(generator_cases(batch_sizes, lengths, beam_widths))
+    cases.extend(data_cases(num_trees, max(lengths)))
+    for case in cases:
+        result = run_isolated(case, repeats)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f)["results"], threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 30])
+    parser.add_argument("--beam_widths", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--num_trees", type=int, default=2000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--case", help="run a single case given as JSON (used internally)")
+    args = parser.parse_args()
+    if args.case is not None:
+        print(json.dumps(run_case(json.loads(args.case), args.repeats)))
+        sys.exit(0)
+    sys.exit(
+        run(
+            args.output,
+            args.baseline,
+            args.threshold,
+            args.batch_sizes,
+            args.lengths,
+            args.beam_widths,
+            args.num_trees,
+            args.repeats,
+        )
+    )
@@ -1,7 +1,14 @@
+from coordgen._cache import CachedGenerator, ResultCache
 from coordgen._core import Coord, CoordinationGenerator, Span
+from coordgen._profiling import GenerationStats
+from coordgen._scheduler import BatchScheduler
 
 __all__ = [
+    "BatchScheduler",
+    "CachedGenerator",
     "Coord",
     "CoordinationGenerator",
+    "GenerationStats",
+    "ResultCache",
     "Span",
 ]
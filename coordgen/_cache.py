@@ -0,0 +1,162 @@
+import dataclasses
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple, Union
+
+from coordgen._core import Coord, CoordinationGenerator, PreparedBatch, Span
+from coordgen._profiling import ProfilingHook
+
+_Key = Tuple[str, str, Span, Optional[str]]
+_Value = Tuple[str, Coord]
+
+
+class ResultCache:
+    def __init__(self, maxsize: int = 1024, path: Optional[Union[str, os.PathLike]] = None):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, _Value]" = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[_Value]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        return _copy(value)
+
+    def put(self, key: Hashable, value: _Value) -> None:
+        value = _copy(value)
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self),
+            "maxsize": self.maxsize,
+        }
+
+    def load(self, path: Union[str, os.PathLike]) -> None:
+        with open(path, "rb") as f:
+            items = pickle.load(f)
+        for key, value in items:
+            self.put(key, value)
+
+    def save(self, path: Optional[Union[str, os.PathLike]] = None) -> None:
+        path = path if path is not None else self.path
+        if path is None:
+            raise ValueError("path must be specified")
+        with self._lock:
+            items = list(self._data.items())
+        tmp = f"{os.fspath(path)}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(items, f)
+        os.replace(tmp, path)
+
+
+class CachedGenerator(CoordinationGenerator):
+    def __init__(self, generator: CoordinationGenerator, cache: Optional[ResultCache] = None):
+        self.generator = generator
+        self.cache = cache if cache is not None else ResultCache()
+        # NOTE: the settings of `generator` go into every key; they are serialized once, so the
+        # generator must not be reconfigured once it is wrapped.
+        config = generator.decoding_config()
+        self._config = json.dumps(config, sort_keys=True)
+        self._coordinator = config.get("coordinator")
+
+    def generate(
+        self, inputs: Iterable[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> List[Tuple[str, Coord]]:
+        inputs = list(inputs)
+        ccs: Sequence[Optional[str]] = [None] * len(inputs)
+        if coordinators is not None:
+            if len(coordinators) != len(inputs):
+                raise ValueError("coordinators must be given for each input")
+            ccs = coordinators
+        keys = [self.cache_key(raw, span, cc) for (raw, span), cc in zip(inputs, ccs)]
+
+        outputs: List[Optional[_Value]] = [self.cache.get(key) for key in keys]
+        missing: Dict[_Key, List[int]] = {}
+        for i, output in enumerate(outputs):
+            if output is None:
+                missing.setdefault(keys[i], []).append(i)
+
+        if missing:
+            missing_inputs = [(raw, span) for _, raw, span, _ in missing]
+            if coordinators is None:
+                results = self.generator.generate(missing_inputs)
+            else:
+                missing_ccs = [cc for *_, cc in missing]
+                results = self.generator.generate(missing_inputs, missing_ccs)  # type: ignore
+            for (key, indices), result in zip(missing.items(), results):
+                self.cache.put(key, result)
+                outputs[indices[0]] = result
+                for i in indices[1:]:
+                    outputs[i] = _copy(result)
+
+        return outputs  # type: ignore
+
+    def generate_candidates(
+        self, inputs: Iterable[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> List[List[Tuple[str, Coord]]]:
+        # NOTE: the cache holds a single result per input, so the candidates always come from the
+        # generator; the best one is stored for later calls of `generate`.
+        inputs = list(inputs)
+        if coordinators is None:
+            outputs = self.generator.generate_candidates(inputs)
+        else:
+            outputs = self.generator.generate_candidates(inputs, coordinators)
+        ccs = coordinators if coordinators is not None else [None] * len(inputs)
+        for (raw, span), cc, candidates in zip(inputs, ccs, outputs):
+            self.cache.put(self.cache_key(raw, span, cc), candidates[0])
+        return outputs
+
+    def cache_key(self, raw: str, span: Span, coordinator: Optional[str] = None) -> _Key:
+        # NOTE: the key of an input in `cache`, for callers that run the generator themselves; an
+        # omitted coordinator is keyed as the one the generator defaults to
+        if coordinator is None:
+            coordinator = self._coordinator
+        return (self._config, raw, tuple(span), coordinator)
+
+    def input_length(self, raw: str, span: Span) -> int:
+        return self.generator.input_length(raw, span)
+
+    def add_profiling_hook(self, hook: ProfilingHook) -> Callable[[], None]:
+        # NOTE: only the inputs that miss the cache reach the generator and are profiled
+        return self.generator.add_profiling_hook(hook)
+
+    def decoding_config(self) -> Dict[str, Any]:
+        return self.generator.decoding_config()
+
+    def _run_batch(self, batch: PreparedBatch) -> Any:
+        # NOTE: a pipelined `generate_iter` looks up the cache rather than the candidates
+        return [[output] for output in self.generate(batch.inputs, batch.coordinators)]
+
+
+def _copy(value: _Value) -> _Value:
+    raw, coord = value
+    return raw, dataclasses.replace(coord, conjuncts=list(coord.conjuncts))
@@ -1,5 +1,11 @@
-from dataclasses import dataclass
-from typing import Iterable, List, Tuple
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from coordgen._profiling import GenerationStats, ProfilingHook
+from coordgen._scheduler import BatchScheduler
 
 Span = Tuple[int, int]  # [start, end)
 
@@ -8,8 +14,127 @@ Span = Tuple[int, int]  # [start, end)
 class Coord:
     cc: Span
     conjuncts: List[Span]
+    score: Optional[float] = field(default=None, compare=False)
+
+
+@dataclass
+class PreparedBatch:
+    # NOTE: a batch between the stages of a pipelined run (see `BatchScheduler.iter_run`);
+    # `features` holds what the backend computed in `_prepare_batch` for `_run_batch`.
+    inputs: List[Tuple[str, Span]]
+    coordinators: Optional[List[str]] = None
+    stats: Optional[GenerationStats] = None
+    features: Dict[str, Any] = field(default_factory=dict)
 
 
 class CoordinationGenerator:
-    def generate(self, inputs: Iterable[Tuple[str, Span]]) -> List[Tuple[str, Coord]]:
+    _profiling_hooks: Tuple[ProfilingHook, ...] = ()
+
+    def generate(
+        self, inputs: Iterable[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> List[Tuple[str, Coord]]:
+        # NOTE: `coordinators` gives the coordinator for each input; when omitted, the one the
+        # generator was configured with is used.
         raise NotImplementedError
+
+    def generate_candidates(
+        self, inputs: Iterable[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> List[List[Tuple[str, Coord]]]:
+        # NOTE: the candidates for each input, best first. Generators that keep a single
+        # hypothesis return it alone.
+        outputs = (
+            self.generate(inputs) if coordinators is None else self.generate(inputs, coordinators)
+        )
+        return [[output] for output in outputs]
+
+    def generate_variants(
+        self,
+        inputs: Iterable[Tuple[str, Span]],
+        coordinators: Sequence[Union[str, Sequence[str]]],
+    ) -> List[List[Tuple[str, Coord]]]:
+        # NOTE: `coordinators[i]` is a coordinator or a list of coordinators for the i-th input.
+        # All the (input, coordinator) pairs go through a single `generate` call, and the
+        # results are grouped by input in the order of its coordinators.
+        inputs = list(inputs)
+        if len(coordinators) != len(inputs):
+            raise ValueError("coordinators must be given for each input")
+        expanded_inputs = []
+        expanded_coordinators = []
+        sizes = []
+        for x, ccs in zip(inputs, coordinators):
+            ccs = [ccs] if isinstance(ccs, str) else list(ccs)
+            expanded_inputs.extend([x] * len(ccs))
+            expanded_coordinators.extend(ccs)
+            sizes.append(len(ccs))
+
+        results = iter(self.generate(expanded_inputs, expanded_coordinators))
+        return [list(islice(results, n)) for n in sizes]
+
+    def generate_iter(
+        self,
+        inputs: Iterable[Tuple[str, Span]],
+        batch_size: int = 20,
+        max_tokens: Optional[int] = None,
+        max_in_flight: int = 1,
+        num_workers: int = 0,
+    ) -> Iterator[Tuple[str, Coord]]:
+        # NOTE: at most `batch_size * max_in_flight` inputs are read ahead; they are bucketed by
+        # length and the results are yielded in input order as soon as they are available.  With
+        # `num_workers`, the batches are prepared and finished by threads while the model runs.
+        scheduler = BatchScheduler(
+            max_tokens, max_batch_size=batch_size, buffer_size=batch_size * max_in_flight
+        )
+        return scheduler.iter_run(
+            self, inputs, num_workers=num_workers, max_in_flight=max_in_flight
+        )
+
+    def input_length(self, raw: str, span: Span) -> int:
+        # NOTE: the number of tokens fed to the model for an input, used for batch scheduling.
+        return len(raw.split()) + len(raw[span[0] : span[1]].split())
+
+    def decoding_config(self) -> Dict[str, Any]:
+        # NOTE: the settings that determine the output for a given input, used for caching.
+        return {"class": type(self).__qualname__}
+
+    def add_profiling_hook(self, hook: ProfilingHook) -> Callable[[], None]:
+        # NOTE: `hook` receives a `GenerationStats` after each call of the backend; profiling is
+        # disabled while no hook is registered.  Returns a function that removes the hook.
+        self._profiling_hooks = self._profiling_hooks + (hook,)
+
+        def _remove() -> None:
+            self._profiling_hooks = tuple(h for h in self._profiling_hooks if h is not hook)
+
+        return _remove
+
+    @contextmanager
+    def profile(self) -> Iterator[List[GenerationStats]]:
+        records: List[GenerationStats] = []
+        remove = self.add_profiling_hook(records.append)
+        try:
+            yield records
+        finally:
+            remove()
+
+    def _prepare_batch(
+        self, inputs: List[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> PreparedBatch:
+        # NOTE: `generate_candidates` split into the work before the model, the model and the
+        # work after it, which a pipelined run overlaps across batches.  By default, everything
+        # runs in `_run_batch`.
+        return PreparedBatch(inputs, None if coordinators is None else list(coordinators))
+
+    def _run_batch(self, batch: PreparedBatch) -> Any:
+        return self.generate_candidates(batch.inputs, batch.coordinators)
+
+    def _finish_batch(self, batch: PreparedBatch, outputs: Any) -> List[List[Tuple[str, Coord]]]:
+        return outputs
+
+    def _start_profiling(self, num_inputs: int) -> Optional[GenerationStats]:
+        return GenerationStats(num_inputs) if self._profiling_hooks else None
+
+    def _finish_profiling(self, stats: Optional[GenerationStats]) -> None:
+        if stats is None:
+            return
+        stats.elapsed = time.perf_counter() - stats.started
+        for hook in self._profiling_hooks:
+            hook(stats)
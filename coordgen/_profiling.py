@@ -0,0 +1,41 @@
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Callable, ContextManager, Dict, Iterator, Optional
+
+ProfilingHook = Callable[["GenerationStats"], None]
+
+
+@dataclass
+class GenerationStats:
+    # NOTE: the stage times are wall times, so on GPUs only `elapsed` is exact
+    num_inputs: int
+    stage_times: Dict[str, float] = field(default_factory=dict)
+    num_tokens: int = 0  # non-padding input tokens (both views)
+    num_padded_tokens: int = 0  # input positions including padding
+    num_steps: int = 0  # decoding steps (or forward passes of non-autoregressive models)
+    elapsed: float = 0.0
+    started: float = field(default_factory=time.perf_counter, repr=False)
+
+    @property
+    def padding_ratio(self) -> float:
+        if self.num_padded_tokens == 0:
+            return 0.0
+        return 1.0 - self.num_tokens / self.num_padded_tokens
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stage_times[stage] = self.stage_times.get(stage, 0.0) + elapsed
+
+
+_NULL_STAGE = nullcontext()
+
+
+def stage(stats: Optional[GenerationStats], name: str) -> ContextManager[None]:
+    # NOTE: a shared no-op context when profiling is disabled
+    return _NULL_STAGE if stats is None else stats.time(name)
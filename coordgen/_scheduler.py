@@ -0,0 +1,206 @@
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+if TYPE_CHECKING:
+    from coordgen._core import Coord, CoordinationGenerator, Span
+
+_Batch = List[Tuple[int, Tuple[str, "Span"]]]
+
+
+class BatchScheduler:
+    def __init__(
+        self,
+        max_tokens: Optional[int] = 4096,
+        max_batch_size: Optional[int] = None,
+        buffer_size: int = 1000,
+    ):
+        if max_tokens is not None and max_tokens <= 0:
+            raise ValueError("max_tokens must be positive")
+        if max_batch_size is not None and max_batch_size <= 0:
+            raise ValueError("max_batch_size must be positive")
+        if buffer_size <= 0:
+            raise ValueError("buffer_size must be positive")
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.buffer_size = buffer_size
+
+    def schedule(self, lengths: Sequence[int]) -> List[List[int]]:
+        # NOTE: the cost of a batch is its padded size, i.e., `len(batch) * max(lengths)`.
+        # An input that exceeds `max_tokens` on its own forms a singleton batch.
+        max_tokens = self.max_tokens
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            over = max_tokens is not None and (len(batch) + 1) * lengths[index] > max_tokens
+            if batch and (full or over):
+                batches.append(batch)
+                batch = []
+            batch.append(index)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def iter_batches(
+        self, inputs: Iterable[Tuple[str, "Span"]], length_fn: Callable[[str, "Span"], int]
+    ) -> Iterator[_Batch]:
+        offset = 0
+        iterator = iter(inputs)
+        while True:
+            buffer = list(islice(iterator, self.buffer_size))
+            if not buffer:
+                break
+            if self.max_tokens is None and len(buffer) <= (self.max_batch_size or len(buffer)):
+                # no need to measure inputs that all go into a single batch
+                batches = [list(range(len(buffer)))]
+            else:
+                batches = self.schedule([length_fn(raw, span) for raw, span in buffer])
+            for batch in batches:
+                yield [(offset + i, buffer[i]) for i in batch]
+            offset += len(buffer)
+
+    def iter_run(
+        self,
+        generator: "CoordinationGenerator",
+        inputs: Iterable[Tuple[str, "Span"]],
+        num_workers: int = 0,
+        max_in_flight: int = 1,
+    ) -> Iterator[Tuple[str, "Coord"]]:
+        # NOTE: with `num_workers`, the batches go through `_iter_pipelined`
+        batches: Iterator[Tuple[_Batch, List[Tuple[str, "Coord"]]]]
+        if num_workers > 0:
+            batches = self._iter_pipelined(generator, inputs, num_workers, max_in_flight)
+        else:
+            batches = (
+                (batch, generator.generate(x for _, x in batch))
+                for batch in self.iter_batches(inputs, generator.input_length)
+            )
+        pending: Dict[int, Tuple[str, "Coord"]] = {}
+        next_index = 0
+        for batch, results in batches:
+            pending.update(zip((index for index, _ in batch), results))
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+
+    def run(
+        self, generator: "CoordinationGenerator", inputs: Iterable[Tuple[str, "Span"]]
+    ) -> List[Tuple[str, "Coord"]]:
+        return list(self.iter_run(generator, inputs))
+
+    def _iter_pipelined(
+        self,
+        generator: "CoordinationGenerator",
+        inputs: Iterable[Tuple[str, "Span"]],
+        num_workers: int,
+        max_in_flight: int,
+    ) -> Iterator[Tuple[_Batch, List[Tuple[str, "Coord"]]]]:
+        # Runs `_prepare_batch` and `_finish_batch` of the generator on two pools of `num_workers`
+        # threads, while `_run_batch` runs on a thread of its own, one batch at a time.  At most
+        # `max_in_flight` batches wait between two stages, and the batches are yielded in order.
+        if max_in_flight <= 0:
+            raise ValueError("max_in_flight must be positive")
+        prepare_pool = ThreadPoolExecutor(num_workers, thread_name_prefix="coordgen-prepare")
+        finish_pool = ThreadPoolExecutor(num_workers, thread_name_prefix="coordgen-finish")
+        prepared: "queue.Queue[Optional[Tuple[_Batch, Future]]]" = queue.Queue(max_in_flight)
+        finished: "queue.Queue[Optional[Tuple[_Batch, Future]]]" = queue.Queue(max_in_flight)
+        closed = threading.Event()
+        pending: Set[Future] = set()
+        lock = threading.Lock()
+
+        def _submit(pool: ThreadPoolExecutor, fn: Callable[..., Any], *args: Any) -> Future:
+            # NOTE: futures are tracked to cancel them on close, as `shutdown(cancel_futures=True)`
+            # requires Python 3.9
+            future = pool.submit(fn, *args)
+            with lock:
+                pending.add(future)
+            future.add_done_callback(_discard)
+            if closed.is_set():
+                future.cancel()
+            return future
+
+        def _discard(future: Future) -> None:
+            with lock:
+                pending.discard(future)
+
+        def _put(q: "queue.Queue[Any]", item: Any) -> bool:
+            # NOTE: gives up once the consumer has gone away
+            while not closed.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _feed() -> None:
+            try:
+                for batch in self.iter_batches(inputs, generator.input_length):
+                    future = _submit(prepare_pool, generator._prepare_batch, [x for _, x in batch])
+                    if not _put(prepared, (batch, future)):
+                        return
+            except BaseException as e:
+                _put(prepared, ([], _failed(e)))
+            _put(prepared, None)
+
+        def _run() -> None:
+            while not closed.is_set():
+                try:
+                    item = prepared.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                batch, future = item
+                try:
+                    state = future.result()
+                    outputs = generator._run_batch(state)
+                    future = _submit(finish_pool, generator._finish_batch, state, outputs)
+                except BaseException as e:
+                    future = _failed(e)
+                if not _put(finished, (batch, future)):
+                    return
+            _put(finished, None)
+
+        threads = [
+            threading.Thread(target=_feed, name="coordgen-feed", daemon=True),
+            threading.Thread(target=_run, name="coordgen-run", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = finished.get()
+                if item is None:
+                    break
+                batch, future = item
+                yield batch, [candidates[0] for candidates in future.result()]
+        finally:
+            closed.set()
+            with lock:
+                futures = list(pending)
+            for future in futures:
+                future.cancel()
+            prepare_pool.shutdown(wait=False)
+            finish_pool.shutdown(wait=False)
+
+
+def _failed(e: BaseException) -> Future:
+    future: Future = Future()
+    future.set_exception(e)
+    return future
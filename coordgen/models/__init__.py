@@ -1,9 +1,36 @@
-from coordgen.models.modeling_auto import AutoModelForCoordinationGeneration
-from coordgen.models.modeling_bert import BertForCoordinationGeneration
-from coordgen.models.modeling_t5 import T5ForCoordinationGeneration
+import importlib
+from typing import TYPE_CHECKING, Any, List
+
+if TYPE_CHECKING:
+    from coordgen.models.engine import ContinuousBatchingEngine
+    from coordgen.models.modeling_auto import AutoModelForCoordinationGeneration
+    from coordgen.models.modeling_bert import BertForCoordinationGeneration
+    from coordgen.models.modeling_t5 import T5ForCoordinationGeneration
+
+# NOTE: the classes are imported on first access, so that importing this package does not load
+# torch and transformers.
+_LAZY_ATTRIBUTES = {
+    "AutoModelForCoordinationGeneration": "coordgen.models.modeling_auto",
+    "BertForCoordinationGeneration": "coordgen.models.modeling_bert",
+    "T5ForCoordinationGeneration": "coordgen.models.modeling_t5",
+    "ContinuousBatchingEngine": "coordgen.models.engine",
+}
 
 __all__ = [
     "AutoModelForCoordinationGeneration",
     "BertForCoordinationGeneration",
     "T5ForCoordinationGeneration",
+    "ContinuousBatchingEngine",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
@@ -1,4 +1,10 @@
-from typing import Tuple
+import threading
+import weakref
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import BatchEncoding, PreTrainedTokenizerBase
 
 from coordgen._core import Coord, Span
 
@@ -21,3 +27,94 @@ def embed_coord(text: str, raw: str, span: Span, cc: str) -> Tuple[str, Coord]:
     end2 = start2 + len(text)
     coord = Coord(cc=(end + 1, start2 - 1), conjuncts=[(start, end), (start2, end2)])
     return f"{raw[:end]}{cc}{text}{raw[end:]}", coord
+
+
+def model_precision(model: torch.nn.Module) -> str:
+    # NOTE: "int8" for dynamically quantized models, otherwise the dtype of the weights
+    if any(isinstance(m, torch.ao.nn.quantized.dynamic.Linear) for m in model.modules()):
+        return "int8"
+    param = next(model.parameters(), None)
+    if param is None:  # e.g., a model backed by exported graphs
+        return "float32"
+    return str(param.dtype).replace("torch.", "")
+
+
+_TOKENIZER_LOCKS: "weakref.WeakKeyDictionary[PreTrainedTokenizerBase, threading.RLock]"
+_TOKENIZER_LOCKS = weakref.WeakKeyDictionary()
+_TOKENIZER_LOCKS_GUARD = threading.Lock()
+
+
+def tokenizer_lock(tokenizer: PreTrainedTokenizerBase) -> threading.RLock:
+    # NOTE: a fast tokenizer fails if it is used by a thread while another one changes its
+    # padding, so the generators that share a tokenizer share its lock.
+    with _TOKENIZER_LOCKS_GUARD:
+        lock = _TOKENIZER_LOCKS.get(tokenizer)
+        if lock is None:
+            lock = _TOKENIZER_LOCKS[tokenizer] = threading.RLock()
+        return lock
+
+
+def resolve_coordinators(
+    coordinators: Optional[Sequence[str]], num_inputs: int, default: str
+) -> List[str]:
+    if coordinators is None:
+        return [default] * num_inputs
+    if len(coordinators) != num_inputs:
+        raise ValueError("coordinators must be given for each input")
+    return list(coordinators)
+
+
+class SpanTokenizer:
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, cache_size: int = 1024):
+        self.tokenizer = tokenizer
+        self.encode = lru_cache(maxsize=cache_size)(self._encode)
+
+    def _encode(self, raw: str) -> Tuple[List[int], Optional[List[Span]]]:
+        encoding = self.tokenizer(
+            raw, add_special_tokens=False, return_offsets_mapping=self.tokenizer.is_fast
+        )
+        return encoding.input_ids, encoding.get("offset_mapping")
+
+    def split(self, raw: str, span: Span) -> Optional[Tuple[List[int], List[int], List[int]]]:
+        # Splits the token ids of `raw` into those before, inside and after `span`, or returns
+        # `None` if a token straddles a boundary of the span.
+        ids, offsets = self.encode(raw)
+        if offsets is None:
+            raise ValueError("splitting tokens requires a fast tokenizer")
+        start, end = span
+        head, body, tail = [], [], []
+        for token_id, (s, e) in zip(ids, offsets):
+            s = e - len(raw[s:e].lstrip())  # offsets may include a leading space
+            if e <= start:
+                head.append(token_id)
+            elif s >= end:
+                tail.append(token_id)
+            elif s >= start and e <= end:
+                body.append(token_id)
+            else:
+                return None
+        return head, body, tail
+
+
+def pad_batch(
+    tokenizer: PreTrainedTokenizerBase, encoded_inputs: Dict[str, List[List[int]]]
+) -> BatchEncoding:
+    # NOTE: same as `tokenizer.pad(encoded_inputs, return_tensors="pt")` for lists of token ids
+    pad_values = {
+        "input_ids": tokenizer.pad_token_id,
+        "token_type_ids": tokenizer.pad_token_type_id,
+    }
+    input_ids = encoded_inputs["input_ids"]
+    max_length = max(len(ids) for ids in input_ids)
+    left = tokenizer.padding_side == "left"
+
+    def _pad(seqs: List[List[int]], value: int) -> torch.Tensor:
+        padded = [
+            [value] * (max_length - len(s)) + s if left else s + [value] * (max_length - len(s))
+            for s in seqs
+        ]
+        return torch.tensor(padded, dtype=torch.long)
+
+    data = {k: _pad(v, pad_values.get(k, 0)) for k, v in encoded_inputs.items()}
+    data["attention_mask"] = _pad([[1] * len(ids) for ids in input_ids], 0)
+    return BatchEncoding(data)
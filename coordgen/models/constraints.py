@@ -0,0 +1,233 @@
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import torch
+
+_END = -1  # marks the end of a sequence in a trie node
+
+
+class TokenTrie:
+    # NOTE: a prefix tree of token id sequences, such as the tokenized words of a vocabulary
+    def __init__(self, sequences: Iterable[Sequence[int]] = ()):
+        self.root: Dict[int, Any] = {}
+        self._next_tokens: Dict[int, List[int]] = {}
+        for sequence in sequences:
+            self.add(sequence)
+
+    def __contains__(self, sequence: Sequence[int]) -> bool:
+        node = self.find(sequence)
+        return node is not None and _END in node
+
+    def add(self, sequence: Sequence[int]) -> None:
+        if not sequence:
+            return
+        node = self.root
+        for token_id in sequence:
+            node = node.setdefault(token_id, {})
+        node[_END] = True
+        self._next_tokens.clear()
+
+    def next_tokens(self, node: Dict[int, Any]) -> List[int]:
+        # NOTE: the children of a node are listed once and reused by later steps
+        key = id(node)
+        if key not in self._next_tokens:
+            self._next_tokens[key] = [t for t in node if t != _END]
+        return self._next_tokens[key]
+
+    def find(self, sequence: Sequence[int]) -> Optional[Dict[int, Any]]:
+        node = self.root
+        for token_id in sequence:
+            if token_id not in node:
+                return None
+            node = node[token_id]
+        return node
+
+    def depth(self, node: Optional[Dict[int, Any]] = None) -> int:
+        node = self.root if node is None else node
+        return max((1 + self.depth(child) for t, child in node.items() if t != _END), default=0)
+
+
+class LogitsConstraints:
+    # NOTE: bans and `allowed` tries, applied in place to the merged log-probabilities of the views
+    def __init__(
+        self,
+        bad_token_ids: Optional[Iterable[int]] = None,
+        forbidden: Optional[TokenTrie] = None,
+        end_token_ids: Iterable[int] = (),
+        offset: int = 0,
+    ):
+        self.bad_token_ids = sorted(set(bad_token_ids or ()))
+        self.forbidden = forbidden
+        self.end_token_ids = list(end_token_ids)
+        self.offset = offset
+        self._banned = list(self.bad_token_ids)
+        # NOTE: only sequences of two or more tokens need to be matched against the hypotheses
+        self._depth = 0 if forbidden is None else forbidden.depth()
+        self._dynamic = self._depth > 1
+        if forbidden is not None:
+            self._banned.extend(t for t, child in forbidden.root.items() if _END in child)
+        self._index: Dict[Tuple[torch.device, int], torch.Tensor] = {}
+        self._prefixes: Dict[Tuple[torch.device, int], torch.Tensor] = {}
+        self._local = threading.local()
+
+    def banned_index(self, vocab_size: int, device: torch.device) -> torch.Tensor:
+        # NOTE: filling a few columns is much cheaper than adding a dense bias of the vocabulary
+        key = (device, vocab_size)
+        if key not in self._index:
+            token_ids = sorted({t for t in self._banned if t < vocab_size})
+            self._index[key] = torch.tensor(token_ids, dtype=torch.long, device=device)
+        return self._index[key]
+
+    def is_dynamic(self, allowed: Optional[Sequence[Optional[TokenTrie]]] = None) -> bool:
+        return self._dynamic or (allowed is not None and any(t is not None for t in allowed))
+
+    def __call__(
+        self,
+        sequences: torch.Tensor,
+        scores: torch.Tensor,
+        other: Optional[torch.Tensor] = None,
+        allowed: Optional[Sequence[Optional[TokenTrie]]] = None,
+        lengths: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # Updates and returns `scores` in place: the minimum with the scores of the other view,
+        # if any, then the constraints.  `scores` has one row of `sequences` and `allowed` for
+        # each index of its leading dimensions; left-padded `sequences` come with the `lengths`
+        # of their rows.
+        if other is not None:
+            torch.minimum(scores, other, out=scores)
+        vocab_size = scores.size(-1)
+        index = self.banned_index(vocab_size, scores.device)
+        if index.numel() > 0:
+            scores.index_fill_(-1, index, -float("inf"))
+        if not self.is_dynamic(allowed):
+            return scores
+
+        # NOTE: only the rows with an `allowed` trie or a prefix of `forbidden` among their last
+        # tokens are read back and matched
+        candidates = set(self._candidate_rows(sequences, lengths, vocab_size))
+        selected = set(candidates)
+        if allowed is not None:
+            selected.update(i for i, t in enumerate(allowed) if t is not None)
+        if not selected:
+            return scores
+        rows = sorted(selected)
+        width = sequences.size(-1)
+        if lengths is None:
+            starts = [self.offset] * len(rows)
+        else:
+            starts = (width - lengths[rows] + self.offset).tolist()
+        allowed_rows: List[int] = []
+        allowed_index: Tuple[List[int], List[int]] = ([], [])
+        banned_index: Tuple[List[int], List[int]] = ([], [])
+        for i, start, seq in zip(rows, starts, sequences[rows].tolist()):
+            seq = seq[start:]
+            if i in candidates:
+                banned = self._banned_tokens(seq)
+                banned_index[0].extend([i] * len(banned))
+                banned_index[1].extend(banned)
+            trie = allowed[i] if allowed is not None else None
+            if trie is not None:
+                token_ids = self._allowed_tokens(trie, seq)
+                if token_ids is not None:
+                    allowed_rows.append(i)
+                    allowed_index[0].extend([i] * len(token_ids))
+                    allowed_index[1].extend(token_ids)
+        if not allowed_rows and not banned_index[0]:
+            return scores
+
+        values = allowed_rows + allowed_index[0] + allowed_index[1]
+        sizes = [len(allowed_rows), len(allowed_index[0]), len(allowed_index[1])]
+        values += banned_index[0] + banned_index[1]
+        sizes += [len(banned_index[0]), len(banned_index[1])]
+        rows_t, allowed_i, allowed_j, banned_i, banned_j = self._index_buffer(
+            values, scores.device
+        ).split(sizes)
+        shape = scores.shape[:-1]
+        neg_inf = scores.new_tensor(-float("inf"))
+        if allowed_rows:
+            index = _unravel(allowed_i, shape) + (allowed_j,)
+            kept = scores[index]
+            scores.index_put_(_unravel(rows_t, shape), neg_inf)
+            scores.index_put_(index, kept)
+        if banned_index[0]:
+            scores.index_put_(_unravel(banned_i, shape) + (banned_j,), neg_inf)
+        return scores
+
+    def _candidate_rows(
+        self, sequences: torch.Tensor, lengths: Optional[torch.Tensor], vocab_size: int
+    ) -> List[int]:
+        # Returns the rows whose last `depth - 1` tokens after `offset` include the first token
+        # of a sequence of `forbidden` of two or more tokens.
+        width = sequences.size(-1)
+        num_tokens = min(self._depth - 1, width - self.offset)
+        if not self._dynamic or num_tokens <= 0:
+            return []
+        window = sequences[:, width - num_tokens :]
+        hits = self._prefix_table(vocab_size, sequences.device)[window]
+        if lengths is not None:
+            columns = torch.arange(width - num_tokens, width, device=sequences.device)
+            hits &= columns >= (width - lengths + self.offset).unsqueeze(-1)
+        return hits.any(-1).nonzero().squeeze(-1).tolist()
+
+    def _prefix_table(self, vocab_size: int, device: torch.device) -> torch.Tensor:
+        # NOTE: a lookup table over the vocabulary, built once per device like `banned_index`
+        key = (device, vocab_size)
+        if key not in self._prefixes:
+            assert self.forbidden is not None
+            table = torch.zeros(vocab_size, dtype=torch.bool)
+            for t, child in self.forbidden.root.items():
+                if 0 <= t < vocab_size and any(c != _END for c in child):
+                    table[t] = True
+            self._prefixes[key] = table.to(device)
+        return self._prefixes[key]
+
+    def _index_buffer(self, values: List[int], device: torch.device) -> torch.Tensor:
+        # NOTE: the indices of a step are copied to the device at once, into a buffer that is
+        # reused by the later steps; it is kept per thread, as a model may decode on several
+        if not hasattr(self._local, "buffers"):
+            self._local.buffers = {}
+        buffers: Dict[torch.device, torch.Tensor] = self._local.buffers
+        buffer = buffers.get(device)
+        if buffer is None or buffer.numel() < len(values):
+            size = max(len(values), 0 if buffer is None else 2 * buffer.numel())
+            buffer = buffers[device] = torch.empty(size, dtype=torch.long, device=device)
+        out = buffer[: len(values)]
+        out.copy_(torch.tensor(values, dtype=torch.long), non_blocking=True)
+        return out
+
+    def _banned_tokens(self, sequence: Sequence[int]) -> List[int]:
+        # Returns the tokens that complete a sequence of `forbidden` of two or more tokens.
+        assert self.forbidden is not None
+        banned = []
+        for start in range(max(len(sequence) - self._depth + 1, 0), len(sequence)):
+            node = self.forbidden.find(sequence[start:])
+            if node is not None:
+                banned.extend(t for t, child in node.items() if t != _END and _END in child)
+        return banned
+
+    def _allowed_tokens(self, trie: TokenTrie, sequence: Sequence[int]) -> Optional[List[int]]:
+        # Returns the tokens that can follow `sequence` in a concatenation of the sequences of
+        # `trie`, or `None` if `sequence` is not one, such as after the end token.
+        # NOTE: a token that both continues a sequence and starts another one continues it
+        node = trie.root
+        for token_id in sequence:
+            if token_id in node:
+                node = node[token_id]
+            elif _END in node and token_id in trie.root:
+                node = trie.root[token_id]
+            else:
+                return None
+        if node is trie.root:
+            return trie.next_tokens(node) + self.end_token_ids
+        if _END in node:
+            return trie.next_tokens(node) + trie.next_tokens(trie.root) + self.end_token_ids
+        return trie.next_tokens(node)
+
+
+def _unravel(index: torch.Tensor, shape: Sequence[int]) -> Tuple[torch.Tensor, ...]:
+    # Converts the indices of the rows of `scores` into indices of its leading dimensions.
+    indices = []
+    for size in reversed(shape[1:]):
+        indices.append(index % size)
+        index = torch.div(index, size, rounding_mode="floor")
+    return (index,) + tuple(reversed(indices))
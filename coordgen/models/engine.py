@@ -0,0 +1,515 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Deque, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import torch
+import transformers
+from transformers.generation.beam_search import BeamHypotheses
+
+from coordgen._core import Coord, Span
+from coordgen._profiling import GenerationStats, stage
+from coordgen.models.constraints import TokenTrie
+from coordgen.models.generation_utils import _forced_scores, _select_cache
+from coordgen.models.modeling_t5 import T5ForCoordinationGeneration
+
+_Result = Tuple[str, Coord]
+
+
+class _Request:
+    __slots__ = ("raw", "span", "coordinator", "future")
+
+    def __init__(self, raw: str, span: Span, coordinator: str):
+        self.raw = raw
+        self.span = span
+        self.coordinator = coordinator
+        self.future: "Future[_Result]" = Future()
+
+
+class _Slot:
+    __slots__ = ("request", "hyps", "max_length", "allowed")
+
+    def __init__(
+        self,
+        request: _Request,
+        hyps: BeamHypotheses,
+        max_length: int,
+        allowed: Optional[TokenTrie] = None,
+    ):
+        self.request = request
+        self.hyps = hyps
+        self.max_length = max_length
+        self.allowed = allowed
+
+
+class ContinuousBatchingEngine:
+    # NOTE: beam search over a batch that admits and releases inputs at every decoding step
+    def __init__(self, generator: T5ForCoordinationGeneration, max_batch_size: int = 16):
+        if not isinstance(generator, T5ForCoordinationGeneration):
+            raise ValueError("continuous batching requires a T5ForCoordinationGeneration")
+        if not isinstance(generator.model, transformers.PreTrainedModel):
+            raise ValueError("continuous batching requires a model with a key/value cache")
+        if generator.do_sample or generator.num_beam_groups > 1:
+            raise ValueError("continuous batching only supports beam search")
+        if max_batch_size <= 0:
+            raise ValueError("max_batch_size must be positive")
+        if generator.num_return_sequences > generator.num_beams:
+            raise ValueError("num_return_sequences must be at most num_beams")
+        self.generator = generator
+        self.model = generator.model.eval()
+        self.max_batch_size = max_batch_size
+        self.num_beams = generator.num_beams
+
+        kwargs = generator._decoding_kwargs()
+        config = self.model.config
+        self.min_length = kwargs["min_length"]
+        self.max_length = kwargs["max_length"]
+        self.eos_token_id = kwargs["eos_token_id"]
+        self.bos_token_id = kwargs["forced_bos_token_id"]
+        self.constraints = kwargs["constraints"]
+        self.decoder_start_token_id = config.decoder_start_token_id
+        self.pad_token_id = config.pad_token_id
+
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._reset()
+
+    def __enter__(self) -> "ContinuousBatchingEngine":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        with self._lock:
+            self._start()
+
+    def _start(self) -> None:
+        # NOTE: called with `_lock` held
+        if self._closed:
+            raise RuntimeError("the engine is stopped")
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        # NOTE: the inputs submitted so far are decoded before the worker exits
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def submit(self, raw: str, span: Span, coordinator: Optional[str] = None) -> "Future[_Result]":
+        request = _Request(raw, span, coordinator or self.generator.cc)
+        # NOTE: queued under the lock, so that no request follows the sentinel put by `stop`
+        with self._lock:
+            self._start()
+            self._queue.put(request)
+        return request.future
+
+    def generate(
+        self, inputs: Iterable[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> List[_Result]:
+        inputs = list(inputs)
+        if coordinators is not None and len(coordinators) != len(inputs):
+            raise ValueError("coordinators must be given for each input")
+        ccs = coordinators or [None] * len(inputs)
+        futures = [self.submit(raw, span, cc) for (raw, span), cc in zip(inputs, ccs)]
+        return [future.result() for future in futures]
+
+    def generate_iter(
+        self,
+        inputs: Iterable[Tuple[str, Span]],
+        max_pending: Optional[int] = None,
+        coordinators: Optional[Iterable[str]] = None,
+    ) -> Iterator[_Result]:
+        # NOTE: at most `max_pending` inputs (`2 * max_batch_size` by default) are submitted
+        # ahead of the result being yielded, and the results are yielded in input order.
+        if max_pending is None:
+            max_pending = 2 * self.max_batch_size
+        ccs = iter(coordinators) if coordinators is not None else None
+        futures: Deque["Future[_Result]"] = deque()
+        for raw, span in inputs:
+            cc = None
+            if ccs is not None:
+                cc = next(ccs, None)
+                if cc is None:
+                    raise ValueError("coordinators must be given for each input")
+            futures.append(self.submit(raw, span, cc))
+            if len(futures) >= max_pending:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+        if ccs is not None and next(ccs, None) is not None:
+            raise ValueError("coordinators must be given for each input")
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping or self._slots:
+            requests: List[_Request] = []
+            if not self._slots:
+                request = self._queue.get()
+                if request is None:
+                    break
+                requests.append(request)
+            while not stopping and len(self._slots) + len(requests) < self.max_batch_size:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                else:
+                    requests.append(request)
+            try:
+                self._step(requests)
+            except Exception as e:
+                for r in requests + [slot.request for slot in self._slots]:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+                self._reset()
+
+    def _reset(self) -> None:
+        # The rows of a slot `p` are `p * 2 * num_beams + v * num_beams + b` for the view `v` and
+        # the beam `b`; the sequences (left-padded) and the beam scores have one row per beam.
+        self._slots: List[_Slot] = []
+        self._sequences: Optional[torch.Tensor] = None
+        self._lengths: Optional[torch.Tensor] = None
+        self._max_lengths: Optional[torch.Tensor] = None
+        self._beam_scores: Optional[torch.Tensor] = None
+        self._encoder_states: Optional[torch.Tensor] = None
+        self._encoder_mask: Optional[torch.Tensor] = None
+        self._decoder_mask: Optional[torch.Tensor] = None
+        self._past_key_values: Any = None
+
+    @torch.no_grad()
+    def _step(self, requests: List[_Request]) -> None:
+        stats = self.generator._start_profiling(len(requests))
+        if stats is not None:
+            stats.num_steps += 1
+
+        logits = []
+        if self._slots:
+            with stage(stats, "model"):
+                logits.append(self._decode())
+        if requests:
+            logits.append(self._admit(requests, stats))
+
+        with stage(stats, "logits_processors"):
+            scores = torch.log_softmax(torch.cat(logits).float(), dim=-1)
+            num_slots, num_beams = len(self._slots), self.num_beams
+            scores = self._constrain(scores.view(num_slots, 2, num_beams, -1))
+            scores = self._process_scores(scores)
+
+        finished = self._update(scores)
+        if finished:
+            with stage(stats, "decode"):
+                self._release(finished)
+        self.generator._finish_profiling(stats)
+
+    def _decode(self) -> torch.Tensor:
+        num_rows = self._decoder_mask.size(0)
+        rows = torch.arange(num_rows, device=self._decoder_mask.device)
+        beam_rows = rows // (2 * self.num_beams) * self.num_beams + rows % self.num_beams
+        decoder_mask = torch.cat([self._decoder_mask, self._decoder_mask.new_ones(num_rows, 1)], 1)
+        outputs = self.model(
+            encoder_outputs=(self._encoder_states,),
+            attention_mask=self._encoder_mask,
+            decoder_input_ids=self._sequences[beam_rows, -1:],
+            decoder_attention_mask=decoder_mask,
+            past_key_values=self._past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        self._decoder_mask = decoder_mask
+        self._past_key_values = outputs.past_key_values
+        return outputs.logits[:, -1]
+
+    def _admit(self, requests: List[_Request], stats: Optional[GenerationStats]) -> torch.Tensor:
+        generator = self.generator
+        inputs = [(r.raw, r.span) for r in requests]
+        # NOTE: the tokenizer may be shared with generators running on other threads
+        with generator._tokenizer_lock:
+            batch = generator._encode_views(inputs, [r.coordinator for r in requests], stats)
+            max_lengths = [self.max_length] * len(requests)
+            if generator.max_length_ratio is not None:
+                max_lengths = [
+                    min(generator.OFFSET + generator._max_length(raw, span), self.max_length)
+                    for raw, span in inputs
+                ]
+            allowed: List[Optional[TokenTrie]] = [None] * len(requests)
+            if generator.conjunct_vocabulary is not None:
+                allowed = [generator._vocabulary(raw, span) for raw, span in inputs]
+        if generator.device:
+            batch = batch.to(generator.device)
+        num_inputs, num_beams = len(requests), self.num_beams
+        device = batch.input_ids.device
+
+        with stage(stats, "encode"):
+            encoder = self.model.get_encoder()
+            if generator.encoder_cache is not None:
+                states = generator.encoder_cache.encode(
+                    encoder, batch.input_ids, batch.attention_mask
+                )
+            else:
+                states = encoder(
+                    input_ids=batch.input_ids, attention_mask=batch.attention_mask
+                ).last_hidden_state
+        index = torch.arange(num_inputs, device=device).view(-1, 1, 1)
+        index = (index + torch.tensor([0, num_inputs], device=device).view(1, 2, 1)).expand(
+            -1, -1, num_beams
+        )
+        index = index.reshape(-1)
+        states, encoder_mask = states[index], batch.attention_mask[index]
+
+        with stage(stats, "model"):
+            outputs = self.model(
+                encoder_outputs=(states,),
+                attention_mask=encoder_mask,
+                decoder_input_ids=torch.full(
+                    (index.size(0), 1), self.decoder_start_token_id, device=device
+                ),
+                use_cache=True,
+                return_dict=True,
+            )
+
+        # NOTE: the first beam of each input starts the search
+        beam_scores = torch.full((num_inputs, num_beams), -1e9, device=device)
+        beam_scores[:, 0] = 0.0
+        new = {
+            "sequences": torch.full(
+                (num_inputs * num_beams, 1), self.decoder_start_token_id, device=device
+            ),
+            "lengths": torch.ones(num_inputs, dtype=torch.long, device=device),
+            "max_lengths": torch.tensor(max_lengths, device=device),
+            "beam_scores": beam_scores.view(-1),
+            "encoder_states": states,
+            "encoder_mask": encoder_mask,
+            "decoder_mask": encoder_mask.new_ones(index.size(0), 1),
+            "past_key_values": outputs.past_key_values,
+        }
+        self._merge(new)
+        self._slots.extend(
+            _Slot(r, BeamHypotheses(num_beams, 1.0, True), n, a)
+            for r, n, a in zip(requests, max_lengths, allowed)
+        )
+        return outputs.logits[:, -1]
+
+    def _merge(self, new: dict) -> None:
+        if self._sequences is None:
+            for name, value in new.items():
+                setattr(self, f"_{name}", value)
+            return
+
+        width = max(self._sequences.size(1), new["sequences"].size(1))
+        self._sequences = torch.cat(
+            [_pad(x, width, 1, self.pad_token_id) for x in (self._sequences, new["sequences"])]
+        )
+        for name in ("lengths", "max_lengths", "beam_scores"):
+            setattr(self, f"_{name}", torch.cat([getattr(self, f"_{name}"), new[name]]))
+
+        source_length = max(self._encoder_states.size(1), new["encoder_states"].size(1))
+        self._encoder_states = torch.cat(
+            [
+                _pad(x, source_length, 1, 0.0, right=True)
+                for x in (self._encoder_states, new["encoder_states"])
+            ]
+        )
+        self._encoder_mask = torch.cat(
+            [
+                _pad(x, source_length, 1, 0, right=True)
+                for x in (self._encoder_mask, new["encoder_mask"])
+            ]
+        )
+        target_length = max(self._decoder_mask.size(1), new["decoder_mask"].size(1))
+        self._decoder_mask = torch.cat(
+            [_pad(x, target_length, 1, 0) for x in (self._decoder_mask, new["decoder_mask"])]
+        )
+        # NOTE: each layer holds the self-attention key/value (over the target) followed by the
+        # cross-attention key/value (over the source), as in the legacy cache of transformers
+        self._past_key_values = tuple(
+            tuple(
+                torch.cat(
+                    [
+                        _pad(a, target_length, 2, 0.0)
+                        if i < 2
+                        else _pad(a, source_length, 2, 0.0, right=True)
+                        for a in (x, y)
+                    ]
+                )
+                for i, (x, y) in enumerate(zip(layer, new_layer))
+            )
+            for layer, new_layer in zip(self._past_key_values, new["past_key_values"])
+        )
+
+    def _constrain(self, scores: torch.Tensor) -> torch.Tensor:
+        # Merges the views of each beam in place and applies `LogitsConstraints` of the generator
+        # to the unpadded sequences.
+        num_beams = self.num_beams
+        allowed = [slot.allowed for slot in self._slots for _ in range(num_beams)]
+        lengths = None
+        if self.constraints.is_dynamic(allowed):
+            lengths = self._lengths.repeat_interleave(num_beams)
+        return self.constraints(self._sequences, scores[:, 0], scores[:, 1], allowed, lengths)
+
+    def _process_scores(self, scores: torch.Tensor) -> torch.Tensor:
+        # Applies the logits processors of `T5ForCoordinationGeneration` with the length of each
+        # slot: no eos before `min_length`, the sentinel first and eos at the length cap.  The
+        # bad tokens are banned by `_constrain`.
+        vocab_size, device = scores.size(-1), scores.device
+        lengths = self._lengths
+        scores[lengths < self.min_length, :, self.eos_token_id] = -float("inf")
+        at_bos = lengths == 1
+        if at_bos.any():
+            scores[at_bos] = _forced_scores(vocab_size, self.bos_token_id, device)
+        at_eos = lengths == self._max_lengths - 1
+        if at_eos.any():
+            scores[at_eos] = _forced_scores(vocab_size, self.eos_token_id, device)
+        return scores
+
+    def _update(self, scores: torch.Tensor) -> List[int]:
+        # Advances the beams of all slots by one token, following `BeamSearchScorer.process`,
+        # and returns the slots that are done.
+        num_slots, num_beams, vocab_size = scores.shape
+        device = scores.device
+        scores = scores + self._beam_scores.view(num_slots, num_beams, 1)
+        top_scores, tokens = scores.view(num_slots, -1).topk(2 * num_beams, dim=1)
+        indices = tokens // vocab_size
+        tokens = tokens % vocab_size
+
+        width = self._sequences.size(1)
+        next_scores = [[0.0] * num_beams for _ in range(num_slots)]
+        next_tokens = [[self.pad_token_id] * num_beams for _ in range(num_slots)]
+        next_indices = [[0] * num_beams for _ in range(num_slots)]
+        finished = []
+        for p, (slot, row_scores, row_tokens, row_indices, length) in enumerate(
+            zip(
+                self._slots,
+                top_scores.tolist(),
+                tokens.tolist(),
+                indices.tolist(),
+                self._lengths.tolist(),
+            )
+        ):
+            beam_id = 0
+            for rank, (score, token, index) in enumerate(zip(row_scores, row_tokens, row_indices)):
+                if token == self.eos_token_id:
+                    if rank < num_beams:
+                        slot.hyps.add(
+                            self._sequences[p * num_beams + index, width - length :], score
+                        )
+                else:
+                    next_scores[p][beam_id] = score
+                    next_tokens[p][beam_id] = token
+                    next_indices[p][beam_id] = index
+                    beam_id += 1
+                if beam_id == num_beams:
+                    break
+            if slot.hyps.is_done(max(row_scores), length + 1) or length + 1 >= slot.max_length:
+                finished.append(p)
+
+        beams = torch.tensor(next_indices, device=device)
+        slot_index = torch.arange(num_slots, device=device).unsqueeze(-1)
+        beam_rows = (slot_index * num_beams + beams).view(-1)
+        self._sequences = torch.cat(
+            [
+                self._sequences[beam_rows],
+                torch.tensor(next_tokens, device=device).view(-1, 1),
+            ],
+            dim=1,
+        )
+        self._beam_scores = torch.tensor(next_scores, device=device).view(-1)
+        self._lengths = self._lengths + 1
+        rows = (
+            slot_index.unsqueeze(-1) * 2 * num_beams
+            + torch.arange(2, device=device).view(1, 2, 1) * num_beams
+            + beams.unsqueeze(1)
+        ).view(-1)
+        self._decoder_mask = self._decoder_mask[rows]
+        self._past_key_values = _select_cache(self._past_key_values, rows)
+
+        for p in finished:
+            slot = self._slots[p]
+            if not slot.hyps.is_done(max(next_scores[p]), self._lengths[p].item()):
+                # NOTE: the length cap is reached without eos in the remaining beams
+                length = int(self._lengths[p])
+                for b in range(num_beams):
+                    k = p * num_beams + b
+                    slot.hyps.add(self._sequences[k, -length:], next_scores[p][b])
+        return finished
+
+    def _release(self, finished: List[int]) -> None:
+        generator = self.generator
+        done = set(finished)
+        slots = [self._slots[p] for p in finished]
+        decoding = [
+            [
+                (generator._strip(seq.tolist()), score)
+                for score, seq, *_ in sorted(slot.hyps.beams, key=lambda x: x[0], reverse=True)[
+                    : generator.num_return_sequences
+                ]
+            ]
+            for slot in slots
+        ]
+        with generator._tokenizer_lock:
+            outputs = generator._decode_outputs(
+                decoding,
+                [(slot.request.raw, slot.request.span) for slot in slots],
+                [slot.request.coordinator for slot in slots],
+            )
+        for slot, candidates in zip(slots, outputs):
+            slot.request.future.set_result(candidates[0])
+
+        live = [p for p in range(len(self._slots)) if p not in done]
+        self._slots = [self._slots[p] for p in live]
+        if not live:
+            self._reset()
+            return
+        num_beams = self.num_beams
+        device = self._sequences.device
+        slot_index = torch.tensor(live, device=device)
+        beam_rows = slot_index.unsqueeze(-1) * num_beams + torch.arange(num_beams, device=device)
+        rows = (
+            slot_index.unsqueeze(-1) * 2 * num_beams + torch.arange(2 * num_beams, device=device)
+        ).view(-1)
+        self._sequences = self._sequences[beam_rows.view(-1)]
+        self._beam_scores = self._beam_scores[beam_rows.view(-1)]
+        self._lengths = self._lengths[slot_index]
+        self._max_lengths = self._max_lengths[slot_index]
+        self._encoder_states = self._encoder_states[rows]
+        self._encoder_mask = self._encoder_mask[rows]
+        self._decoder_mask = self._decoder_mask[rows]
+        self._past_key_values = _select_cache(self._past_key_values, rows)
+
+        # NOTE: drop the padding that no remaining slot needs
+        trim = self._sequences.size(1) - int(self._lengths.max())
+        source_length = int(self._encoder_mask.sum(dim=1).max())
+        if trim > 0 or source_length < self._encoder_mask.size(1):
+            self._sequences = self._sequences[:, trim:]
+            self._decoder_mask = self._decoder_mask[:, trim:]
+            self._encoder_states = self._encoder_states[:, :source_length]
+            self._encoder_mask = self._encoder_mask[:, :source_length]
+            self._past_key_values = tuple(
+                tuple(
+                    x[:, :, trim:] if i < 2 else x[:, :, :source_length]
+                    for i, x in enumerate(layer)
+                )
+                for layer in self._past_key_values
+            )
+
+
+def _pad(x: torch.Tensor, length: int, dim: int, value: Any, right: bool = False) -> torch.Tensor:
+    if x.size(dim) >= length:
+        return x
+    shape = list(x.shape)
+    shape[dim] = length - x.size(dim)
+    padding = x.new_full(shape, value)
+    return torch.cat([x, padding] if right else [padding, x], dim=dim)
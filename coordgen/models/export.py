@@ -0,0 +1,185 @@
+import json
+import os
+from typing import Optional, Tuple, Union
+
+import torch
+import transformers
+
+EXPORT_CONFIG_NAME = "coordgen_export.json"
+EXPORT_FORMATS = {"onnx": ".onnx", "torchscript": ".pt"}
+
+
+class _Encoder(torch.nn.Module):
+    def __init__(self, model: transformers.PreTrainedModel):
+        super().__init__()
+        self.model = model
+        self.eval()
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        encoder = self.model.get_encoder()
+        return encoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+
+class _Decoder(torch.nn.Module):
+    def __init__(self, model: transformers.PreTrainedModel):
+        super().__init__()
+        self.model = model
+        self.eval()
+
+    def forward(
+        self,
+        decoder_input_ids: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        attention_mask: torch.Tensor,
+    ) -> Tuple[torch.Tensor, ...]:
+        # NOTE: the first step returns the logits of the last position, followed by the
+        # self-attention and cross-attention keys/values of each layer
+        outputs = self.model(
+            encoder_outputs=(encoder_hidden_states,),
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            use_cache=True,
+            return_dict=True,
+        )
+        return (outputs.logits[:, -1],) + _flatten(outputs.past_key_values)
+
+
+class _DecoderWithPast(torch.nn.Module):
+    def __init__(self, model: transformers.PreTrainedModel):
+        super().__init__()
+        self.model = model
+        self.eval()
+
+    def forward(
+        self,
+        decoder_input_ids: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        attention_mask: torch.Tensor,
+        past_key_values: Tuple[torch.Tensor, ...],
+    ) -> Tuple[torch.Tensor, ...]:
+        # NOTE: the next steps take the last token and the keys/values so far, and return the
+        # logits followed by the self-attention keys/values extended by the token; the
+        # cross-attention keys/values do not change.
+        outputs = self.model(
+            encoder_outputs=(encoder_hidden_states,),
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            past_key_values=_unflatten(past_key_values),
+            use_cache=True,
+            return_dict=True,
+        )
+        return (outputs.logits[:, -1],) + _flatten(
+            tuple(layer[:2] for layer in outputs.past_key_values)
+        )
+
+
+def _flatten(past_key_values: Tuple[Tuple[torch.Tensor, ...], ...]) -> Tuple[torch.Tensor, ...]:
+    return tuple(x for layer in past_key_values for x in layer)
+
+
+def _unflatten(past_key_values: Tuple[torch.Tensor, ...]) -> Tuple[Tuple[torch.Tensor, ...], ...]:
+    # NOTE: four tensors per layer, as in `transformers`: self key, self value, cross key and
+    # cross value
+    return tuple(tuple(past_key_values[i : i + 4]) for i in range(0, len(past_key_values), 4))
+
+
+def export_model(
+    model: transformers.PreTrainedModel,
+    tokenizer: transformers.PreTrainedTokenizerBase,
+    output_dir: Union[str, os.PathLike],
+    format: str = "onnx",
+    opset_version: Optional[int] = None,
+) -> None:
+    # NOTE: the decoder is exported twice, for the first step and for the steps with a cache
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"unknown format: {format!r}")
+    if not model.config.is_encoder_decoder:
+        raise ValueError("only encoder-decoder models can be exported")
+
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.cpu().eval()
+    encoder, decoder, decoder_with_past = _Encoder(model), _Decoder(model), _DecoderWithPast(model)
+    input_ids = torch.full((2, 4), model.config.decoder_start_token_id, dtype=torch.long)
+    attention_mask = torch.ones_like(input_ids)
+    decoder_input_ids = input_ids[:, :1]
+    with torch.no_grad():
+        encoder_hidden_states = encoder(input_ids, attention_mask)
+        decoder_args = (decoder_input_ids, encoder_hidden_states, attention_mask)
+        # NOTE: the cache is traced after a second step, so that its length is not taken as 1
+        past = _unflatten(decoder(*decoder_args)[1:])
+        outputs = decoder_with_past(*decoder_args, _flatten(past))
+    past_key_values = _flatten(
+        tuple(outputs[1 + 2 * i : 3 + 2 * i] + layer[2:] for i, layer in enumerate(past))
+    )
+
+    suffix = EXPORT_FORMATS[format]
+    paths = {
+        name: os.path.join(output_dir, name + suffix)
+        for name in ["encoder", "decoder", "decoder_with_past"]
+    }
+    if format == "onnx":
+        from torch.export import Dim
+
+        batch, source, target = Dim("batch"), Dim("source"), Dim("target")
+        encoder_shapes = {
+            "input_ids": {0: batch, 1: source},
+            "attention_mask": {0: batch, 1: source},
+        }
+        decoder_shapes = {
+            "decoder_input_ids": {0: batch},
+            "encoder_hidden_states": {0: batch, 1: source},
+            "attention_mask": {0: batch, 1: source},
+        }
+        past_shapes = tuple(
+            {0: batch, 2: target if i % 4 < 2 else source} for i in range(len(past_key_values))
+        )
+        for module, args, dynamic_shapes, path in [
+            (encoder, (input_ids, attention_mask), encoder_shapes, paths["encoder"]),
+            (decoder, decoder_args, decoder_shapes, paths["decoder"]),
+            (
+                decoder_with_past,
+                decoder_args + (past_key_values,),
+                {**decoder_shapes, "past_key_values": past_shapes},
+                paths["decoder_with_past"],
+            ),
+        ]:
+            torch.onnx.export(
+                module,
+                args,
+                path,
+                dynamic_shapes=dynamic_shapes,
+                opset_version=opset_version,
+                dynamo=True,
+            )
+    else:
+        with torch.no_grad():
+            torch.jit.trace(encoder, (input_ids, attention_mask)).save(paths["encoder"])
+            torch.jit.trace(decoder, decoder_args).save(paths["decoder"])
+            torch.jit.trace(decoder_with_past, decoder_args + (past_key_values,)).save(
+                paths["decoder_with_past"]
+            )
+
+    model.config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, EXPORT_CONFIG_NAME), "w") as f:
+        json.dump({"format": format}, f)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from coordgen.models.modeling_auto import _AutoModel
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model")
+    parser.add_argument("output_dir")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="onnx")
+    parser.add_argument("--opset_version", type=int)
+    args = parser.parse_args()
+    export_model(
+        _AutoModel.from_pretrained(args.model),
+        transformers.AutoTokenizer.from_pretrained(args.model),
+        args.output_dir,
+        args.format,
+        args.opset_version,
+    )
@@ -1,7 +1,14 @@
-from typing import List
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
 
 import torch
 import transformers
+from transformers.generation.beam_search import BeamHypotheses
+from transformers.modeling_outputs import BaseModelOutput
+
+from coordgen._profiling import GenerationStats, stage
+from coordgen.models.constraints import LogitsConstraints, TokenTrie
 
 
 class GenerationMixin(transformers.generation_utils.GenerationMixin):
@@ -21,9 +28,11 @@ class GenerationMixin(transformers.generation_utils.GenerationMixin):
 
 class SynchronizedLogitsProcessor(transformers.LogitsProcessor):
     def __call__(self, input_ids: torch.Tensor, logits: torch.Tensor) -> torch.Tensor:
+        # NOTE: both halves are overwritten with the minimum in place
         logits1, logits2 = logits.split(logits.size(0) // 2)
-        logits = self.forward(logits1, logits2)
-        return torch.cat((logits, logits), dim=0)
+        torch.minimum(logits1, logits2, out=logits1)
+        logits2.copy_(logits1)
+        return logits
 
     def forward(self, x1: torch.Tensor, x2: torch.Tensor) -> torch.Tensor:
         return torch.minimum(x1, x2)
@@ -32,7 +41,592 @@ class SynchronizedLogitsProcessor(transformers.LogitsProcessor):
 class NoBadTokenLogitsProcessor(transformers.LogitsProcessor):
     def __init__(self, bad_token_ids: List[int]):
         self.bad_token_ids = bad_token_ids
+        self._constraints = LogitsConstraints(bad_token_ids)
 
     def __call__(self, input_ids: torch.Tensor, logits: torch.Tensor) -> torch.Tensor:
-        logits[:, self.bad_token_ids] = -float("inf")
-        return logits
+        return self._constraints(input_ids, logits)
+
+
+class SynchronizedBeamSearch:
+    # NOTE: the beam search of `generate(..., synchronize=True)`, with the beams kept once per pair
+    def __init__(
+        self,
+        model: transformers.PreTrainedModel,
+        num_beams: int = 4,
+        min_length: int = 0,
+        max_length: int = 20,
+        length_penalty: float = 1.0,
+        early_stopping: bool = True,
+        num_return_sequences: int = 1,
+        num_beam_groups: int = 1,
+        diversity_penalty: float = 0.0,
+        decoder_start_token_id: Optional[int] = None,
+        pad_token_id: Optional[int] = None,
+        eos_token_id: Optional[int] = None,
+        forced_bos_token_id: Optional[int] = None,
+        forced_eos_token_id: Optional[int] = None,
+        bad_token_ids: Optional[Iterable[int]] = None,
+        constraints: Optional[LogitsConstraints] = None,
+        encoder_cache: Optional["EncoderCache"] = None,
+        compact: bool = True,
+    ):
+        if num_return_sequences > num_beams:
+            raise ValueError("num_return_sequences must be at most num_beams")
+        if num_beams % num_beam_groups != 0:
+            raise ValueError("num_beams must be divisible by num_beam_groups")
+        config = model.config
+        self.model = model
+        self.num_beams = num_beams
+        self.max_length = max_length
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.num_return_sequences = num_return_sequences
+        self.num_beam_groups = num_beam_groups
+        self.diversity_penalty = diversity_penalty
+        self.encoder_cache = encoder_cache
+        self.compact = compact
+        if decoder_start_token_id is None:
+            decoder_start_token_id = config.decoder_start_token_id
+        self.decoder_start_token_id = decoder_start_token_id
+        self.pad_token_id = config.pad_token_id if pad_token_id is None else pad_token_id
+        self.eos_token_id = config.eos_token_id if eos_token_id is None else eos_token_id
+        # NOTE: the token forced at the length cap of a pair (see `search`)
+        self.forced_eos_token_id = (
+            self.eos_token_id if forced_eos_token_id is None else forced_eos_token_id
+        )
+        self.logits_processor = _build_logits_processor(
+            min_length,
+            max_length,
+            self.eos_token_id,
+            forced_bos_token_id,
+            forced_eos_token_id,
+        )
+        self.constraints = _build_constraints(bad_token_ids, constraints)
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> List[List[int]]:
+        return [hyps[0][0] for hyps in self.search(input_ids, attention_mask)]
+
+    @torch.no_grad()
+    def search(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        stats: Optional[GenerationStats] = None,
+        max_lengths: Optional[Sequence[int]] = None,
+        allowed: Optional[Sequence[Optional[TokenTrie]]] = None,
+    ) -> List[List[Tuple[List[int], float]]]:
+        # Returns the `num_return_sequences` best hypotheses of each pair with their
+        # (length-normalized) scores, best first.  `max_lengths` caps the length of the
+        # hypotheses of each pair below `max_length`, and `allowed` restricts the tokens of each
+        # pair with a trie (see `LogitsConstraints`).
+        assert input_ids.size(0) % 2 == 0
+        num_pairs = input_ids.size(0) // 2
+        num_beams = self.num_beams
+        group_size = num_beams // self.num_beam_groups
+        device = input_ids.device
+        _check_allowed(allowed, num_pairs)
+
+        with stage(stats, "encode"):
+            encoder_outputs, attention_mask = _encode(
+                self.model, input_ids, attention_mask, num_beams, self.encoder_cache
+            )
+
+        sequences = torch.full(
+            (num_pairs * num_beams, 1),
+            self.decoder_start_token_id,
+            dtype=torch.long,
+            device=device,
+        )
+        # the first beam of each group starts the search
+        beam_scores = torch.full((num_pairs, num_beams), -1e9, device=device)
+        beam_scores[:, ::group_size] = 0.0
+        beam_scores = beam_scores.view(-1)
+        beam_hyps = [
+            [
+                BeamHypotheses(group_size, self.length_penalty, self.early_stopping)
+                for _ in range(self.num_beam_groups)
+            ]
+            for _ in range(num_pairs)
+        ]
+        done = [[False] * self.num_beam_groups for _ in range(num_pairs)]
+        past_key_values = None
+        # NOTE: `active` lists the pairs in the working batch; with `compact`, the rows of a pair
+        # are dropped once all its groups are done.
+        active = list(range(num_pairs))
+        caps = _length_caps(max_lengths, num_pairs, self.max_length, device)
+
+        while True:
+            batch_size = len(active)
+            with stage(stats, "model"):
+                outputs = self.model(
+                    encoder_outputs=encoder_outputs,
+                    attention_mask=attention_mask,
+                    decoder_input_ids=sequences[:, -1:].repeat(2, 1),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    return_dict=True,
+                )
+            if stats is not None:
+                stats.num_steps += 1
+            scores = torch.log_softmax(outputs.logits[:, -1, :].float(), dim=-1)
+            with stage(stats, "logits_processors"):
+                # NOTE: the views are merged and constrained in place, in a single pass
+                row_allowed = None
+                if allowed is not None:
+                    row_allowed = [allowed[i] for i in active for _ in range(num_beams)]
+                scores = self.constraints(
+                    sequences, *scores.split(batch_size * num_beams), allowed=row_allowed
+                )
+            vocab_size = scores.size(-1)
+            scores = scores.view(batch_size, num_beams, vocab_size)
+            beam_scores = beam_scores.view(batch_size, num_beams)
+            group_sequences = sequences.view(batch_size, num_beams, -1)
+            at_cap = None if caps is None else caps == sequences.size(-1) + 1
+            active_hyps = [beam_hyps[i] for i in active]
+            active_done = [done[i] for i in active]
+
+            next_beams = []
+            chosen = torch.zeros((batch_size, vocab_size), device=device)
+            for g in range(self.num_beam_groups):
+                group = slice(g * group_size, (g + 1) * group_size)
+                group_scores = scores[:, group]
+                with stage(stats, "logits_processors"):
+                    if g > 0 and self.diversity_penalty:
+                        # NOTE: as in `transformers`, the penalty precedes the other processors
+                        group_scores = group_scores - self.diversity_penalty * chosen.unsqueeze(1)
+                    group_scores = self.logits_processor(
+                        group_sequences[:, group].reshape(batch_size * group_size, -1),
+                        group_scores.reshape(batch_size * group_size, vocab_size),
+                    ).view(batch_size, group_size, vocab_size)
+                    if at_cap is not None and at_cap.any():
+                        group_scores[at_cap] = _forced_scores(
+                            vocab_size, self.forced_eos_token_id, device
+                        )
+                group_scores = group_scores + beam_scores[:, group, None]
+                group_scores, tokens = group_scores.reshape(batch_size, -1).topk(
+                    2 * group_size, dim=1
+                )
+                indices = tokens // vocab_size
+                tokens = tokens % vocab_size
+
+                group_beams = self._process(
+                    sequences, group_scores, tokens, indices, active_hyps, active_done, g
+                )
+                chosen.scatter_add_(
+                    1, group_beams[1], torch.ones_like(group_beams[1], dtype=chosen.dtype)
+                )
+                next_beams.append(group_beams)
+
+            beam_scores, beam_tokens, beam_idx = (
+                torch.cat(xs, dim=1).view(-1) for xs in zip(*next_beams)
+            )
+            if all(all(d) for d in done) or sequences.size(-1) + 1 >= self.max_length:
+                sequences = torch.cat([sequences[beam_idx], beam_tokens.unsqueeze(-1)], dim=-1)
+                break
+
+            live = [j for j, d in enumerate(active_done) if not all(d)]
+            reorder_cache = self.model._reorder_cache
+            if self.compact and len(live) < batch_size:
+                pair_idx = torch.tensor(live, dtype=torch.long, device=device)
+                rows = pair_idx.unsqueeze(-1) * num_beams + torch.arange(num_beams, device=device)
+                rows = rows.view(-1)
+                beam_scores, beam_tokens = beam_scores[rows], beam_tokens[rows]
+                beam_idx = beam_idx[rows]
+                view_rows = torch.cat([rows, rows + batch_size * num_beams])
+                encoder_outputs.last_hidden_state = encoder_outputs.last_hidden_state[view_rows]
+                attention_mask = attention_mask[view_rows]
+                active = [active[j] for j in live]
+                if caps is not None:
+                    caps = caps[pair_idx]
+                reorder_cache = _select_cache
+
+            sequences = torch.cat([sequences[beam_idx], beam_tokens.unsqueeze(-1)], dim=-1)
+            # NOTE: a single reordering of the cache follows the beams and drops finished pairs
+            beam_idx = torch.cat([beam_idx, beam_idx + batch_size * num_beams])
+            past_key_values = reorder_cache(outputs.past_key_values, beam_idx)
+
+        outputs = []
+        index = {i: j for j, i in enumerate(active)}
+        for i in range(num_pairs):
+            hyps = []
+            for g, beam_hyp in enumerate(beam_hyps[i]):
+                if not done[i][g]:
+                    for j in range(group_size):
+                        k = index[i] * num_beams + g * group_size + j
+                        beam_hyp.add(sequences[k], beam_scores[k].item())
+                hyps.extend(beam_hyp.beams)
+            hyps = sorted(hyps, key=lambda x: x[0], reverse=True)[: self.num_return_sequences]
+            outputs.append([(seq.tolist(), score) for score, seq, *_ in hyps])
+
+        return outputs
+
+    def _process(self, sequences, scores, tokens, indices, beam_hyps, done, group):
+        # This follows `transformers.BeamSearchScorer.process` for a single beam group.
+        num_beams = self.num_beams
+        group_size = num_beams // self.num_beam_groups
+        cur_len = sequences.size(-1) + 1
+        batch_size = len(beam_hyps)
+        next_scores = [[0.0] * group_size for _ in range(batch_size)]
+        next_tokens = [[self.pad_token_id] * group_size for _ in range(batch_size)]
+        next_indices = [[0] * group_size for _ in range(batch_size)]
+
+        for i, (row_scores, row_tokens, row_indices) in enumerate(
+            zip(scores.tolist(), tokens.tolist(), indices.tolist())
+        ):
+            if done[i][group]:
+                continue
+            beam_id = 0
+            for rank, (score, token, index) in enumerate(zip(row_scores, row_tokens, row_indices)):
+                k = i * num_beams + group * group_size + index
+                if token == self.eos_token_id:
+                    if rank < group_size:
+                        beam_hyps[i][group].add(sequences[k].clone(), score)
+                else:
+                    next_scores[i][beam_id] = score
+                    next_tokens[i][beam_id] = token
+                    next_indices[i][beam_id] = k
+                    beam_id += 1
+                if beam_id == group_size:
+                    break
+            done[i][group] = beam_hyps[i][group].is_done(max(row_scores), cur_len)
+
+        device = sequences.device
+        return (
+            torch.tensor(next_scores, device=device),
+            torch.tensor(next_tokens, dtype=torch.long, device=device),
+            torch.tensor(next_indices, dtype=torch.long, device=device),
+        )
+
+
+class SynchronizedSampling:
+    # NOTE: ancestral sampling over the merged log-probabilities of the two views of each input
+    def __init__(
+        self,
+        model: transformers.PreTrainedModel,
+        num_return_sequences: int = 1,
+        temperature: float = 1.0,
+        top_k: int = 0,
+        top_p: float = 1.0,
+        min_length: int = 0,
+        max_length: int = 20,
+        length_penalty: float = 1.0,
+        decoder_start_token_id: Optional[int] = None,
+        pad_token_id: Optional[int] = None,
+        eos_token_id: Optional[int] = None,
+        forced_bos_token_id: Optional[int] = None,
+        forced_eos_token_id: Optional[int] = None,
+        bad_token_ids: Optional[Iterable[int]] = None,
+        constraints: Optional[LogitsConstraints] = None,
+        encoder_cache: Optional["EncoderCache"] = None,
+        compact: bool = True,
+    ):
+        config = model.config
+        self.model = model
+        self.num_return_sequences = num_return_sequences
+        self.max_length = max_length
+        self.length_penalty = length_penalty
+        self.encoder_cache = encoder_cache
+        self.compact = compact
+        if decoder_start_token_id is None:
+            decoder_start_token_id = config.decoder_start_token_id
+        self.decoder_start_token_id = decoder_start_token_id
+        self.pad_token_id = config.pad_token_id if pad_token_id is None else pad_token_id
+        self.eos_token_id = config.eos_token_id if eos_token_id is None else eos_token_id
+        # NOTE: the token forced at the length cap of a pair (see `search`)
+        self.forced_eos_token_id = (
+            self.eos_token_id if forced_eos_token_id is None else forced_eos_token_id
+        )
+        self.logits_processor = _build_logits_processor(
+            min_length,
+            max_length,
+            self.eos_token_id,
+            forced_bos_token_id,
+            forced_eos_token_id,
+        )
+        self.constraints = _build_constraints(bad_token_ids, constraints)
+        warpers = transformers.LogitsProcessorList()
+        if temperature != 1.0:
+            warpers.append(transformers.TemperatureLogitsWarper(temperature))
+        if top_k > 0:
+            warpers.append(transformers.TopKLogitsWarper(top_k))
+        if top_p < 1.0:
+            warpers.append(transformers.TopPLogitsWarper(top_p))
+        self.logits_warper = warpers
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> List[List[int]]:
+        return [hyps[0][0] for hyps in self.search(input_ids, attention_mask)]
+
+    @torch.no_grad()
+    def search(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        stats: Optional[GenerationStats] = None,
+        max_lengths: Optional[Sequence[int]] = None,
+        allowed: Optional[Sequence[Optional[TokenTrie]]] = None,
+    ) -> List[List[Tuple[List[int], float]]]:
+        assert input_ids.size(0) % 2 == 0
+        num_pairs = input_ids.size(0) // 2
+        num_samples = self.num_return_sequences
+        num_rows = num_pairs * num_samples
+        device = input_ids.device
+        _check_allowed(allowed, num_pairs)
+
+        with stage(stats, "encode"):
+            encoder_outputs, attention_mask = _encode(
+                self.model, input_ids, attention_mask, num_samples, self.encoder_cache
+            )
+
+        sequences = torch.full(
+            (num_rows, 1), self.decoder_start_token_id, dtype=torch.long, device=device
+        )
+        sum_scores = torch.zeros(num_rows, device=device)
+        lengths = torch.zeros_like(sum_scores)
+        finished = torch.zeros(num_rows, dtype=torch.bool, device=device)
+        past_key_values = None
+        # NOTE: `active` holds the sample of each row of the working batch; with `compact`, the
+        # finished samples are collected into `results` and their rows are dropped.
+        active = torch.arange(num_rows, device=device)
+        results: List[Tuple[List[int], float]] = [([], 0.0)] * num_rows
+        caps = _length_caps(max_lengths, num_pairs, self.max_length, device)
+        if caps is not None:
+            caps = caps.repeat_interleave(num_samples)
+
+        while True:
+            batch_size = sequences.size(0)
+            with stage(stats, "model"):
+                outputs = self.model(
+                    encoder_outputs=encoder_outputs,
+                    attention_mask=attention_mask,
+                    decoder_input_ids=sequences[:, -1:].repeat(2, 1),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    return_dict=True,
+                )
+            if stats is not None:
+                stats.num_steps += 1
+            scores = torch.log_softmax(outputs.logits[:, -1, :].float(), dim=-1)
+            with stage(stats, "logits_processors"):
+                row_allowed = None
+                if allowed is not None:
+                    row_allowed = [allowed[k // num_samples] for k in active.tolist()]
+                scores = self.constraints(
+                    sequences, *scores.split(batch_size), allowed=row_allowed
+                )
+                scores = self.logits_processor(sequences, scores)
+                if caps is not None:
+                    at_cap = caps == sequences.size(-1) + 1
+                    if at_cap.any():
+                        scores[at_cap] = _forced_scores(
+                            scores.size(-1), self.forced_eos_token_id, device
+                        )
+                probs = torch.softmax(self.logits_warper(sequences, scores.clone()), dim=-1)
+            tokens = torch.multinomial(probs, num_samples=1).squeeze(-1)
+            tokens = tokens.masked_fill(finished, self.pad_token_id)
+
+            token_scores = scores.gather(-1, tokens.unsqueeze(-1)).squeeze(-1)
+            is_eos = ~finished & (tokens == self.eos_token_id)
+            # NOTE: as in `BeamHypotheses`, the length excludes the final eos token
+            lengths = lengths.masked_fill(is_eos, sequences.size(-1))
+            sum_scores = sum_scores + token_scores.masked_fill(finished, 0.0)
+            finished = finished | is_eos
+            sequences = torch.cat([sequences, tokens.unsqueeze(-1)], dim=-1)
+
+            if finished.all() or sequences.size(-1) >= self.max_length:
+                break
+
+            past_key_values = outputs.past_key_values
+            if self.compact and finished.any():
+                self._collect(results, active, sequences, sum_scores, lengths, finished)
+                keep = (~finished).nonzero().squeeze(-1)
+                sequences, sum_scores, lengths = sequences[keep], sum_scores[keep], lengths[keep]
+                active, finished = active[keep], finished[keep]
+                if caps is not None:
+                    caps = caps[keep]
+                view_rows = torch.cat([keep, keep + batch_size])
+                encoder_outputs.last_hidden_state = encoder_outputs.last_hidden_state[view_rows]
+                attention_mask = attention_mask[view_rows]
+                past_key_values = _select_cache(past_key_values, view_rows)
+
+        lengths = lengths.masked_fill(~finished, sequences.size(-1))
+        self._collect(results, active, sequences, sum_scores, lengths)
+        return [
+            sorted(results[i : i + num_samples], key=lambda x: x[1], reverse=True)
+            for i in range(0, num_rows, num_samples)
+        ]
+
+    def _collect(self, results, active, sequences, sum_scores, lengths, mask=None):
+        if mask is not None:
+            active, sequences, sum_scores, lengths = (
+                x[mask] for x in (active, sequences, sum_scores, lengths)
+            )
+        normalized_scores = sum_scores / lengths**self.length_penalty
+        for k, seq, n, score in zip(
+            active.tolist(), sequences.tolist(), lengths.tolist(), normalized_scores.tolist()
+        ):
+            results[k] = (seq[: int(n)], score)
+
+
+def _build_logits_processor(
+    min_length: int,
+    max_length: int,
+    eos_token_id: int,
+    forced_bos_token_id: Optional[int],
+    forced_eos_token_id: Optional[int],
+) -> transformers.LogitsProcessorList:
+    processors = transformers.LogitsProcessorList()
+    if min_length > 0:
+        processors.append(transformers.MinLengthLogitsProcessor(min_length, eos_token_id))
+    if forced_bos_token_id is not None:
+        processors.append(transformers.ForcedBOSTokenLogitsProcessor(forced_bos_token_id))
+    if forced_eos_token_id is not None:
+        processors.append(
+            transformers.ForcedEOSTokenLogitsProcessor(max_length, forced_eos_token_id)
+        )
+    return processors
+
+
+def _build_constraints(
+    bad_token_ids: Optional[Iterable[int]], constraints: Optional[LogitsConstraints]
+) -> LogitsConstraints:
+    if constraints is None:
+        return LogitsConstraints(bad_token_ids)
+    if bad_token_ids is not None:
+        raise ValueError("bad_token_ids must be given to constraints")
+    return constraints
+
+
+def _check_allowed(allowed: Optional[Sequence[Optional[TokenTrie]]], num_pairs: int) -> None:
+    if allowed is not None and len(allowed) != num_pairs:
+        raise ValueError("allowed must be given for each pair")
+
+
+def _length_caps(
+    max_lengths: Optional[Sequence[int]], num_rows: int, max_length: int, device: torch.device
+) -> Optional[torch.Tensor]:
+    if max_lengths is None:
+        return None
+    if len(max_lengths) != num_rows:
+        raise ValueError("max_lengths must be given for each pair")
+    return torch.tensor(max_lengths, dtype=torch.long, device=device).clamp(max=max_length)
+
+
+def _select_cache(past_key_values: Any, index: torch.Tensor) -> Any:
+    # NOTE: unlike `_reorder_cache` of some models, this allows the batch to shrink
+    if isinstance(past_key_values, torch.Tensor):
+        return past_key_values.index_select(0, index)
+    return type(past_key_values)(_select_cache(x, index) for x in past_key_values)
+
+
+def _forced_scores(vocab_size: int, token_id: int, device: torch.device) -> torch.Tensor:
+    # NOTE: the scores of `transformers.ForcedEOSTokenLogitsProcessor` at the last position
+    scores = torch.full((vocab_size,), -float("inf"), device=device)
+    scores[token_id] = 0.0
+    return scores
+
+
+def _encode(
+    model: transformers.PreTrainedModel,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    num_copies: int,
+    cache: Optional["EncoderCache"] = None,
+) -> Tuple[BaseModelOutput, torch.Tensor]:
+    # Encodes the views once and repeats the states for each beam (or sample). The rows are laid
+    # out as [view1 copies of all pairs; view2 copies of all pairs].
+    if cache is not None:
+        last_hidden_state = cache.encode(model.get_encoder(), input_ids, attention_mask)
+        encoder_outputs = BaseModelOutput(last_hidden_state=last_hidden_state)
+    else:
+        encoder_outputs = model.get_encoder()(
+            input_ids=input_ids, attention_mask=attention_mask, return_dict=True
+        )
+    index = torch.arange(input_ids.size(0), device=input_ids.device)
+    index = index.repeat_interleave(num_copies)
+    encoder_outputs.last_hidden_state = encoder_outputs.last_hidden_state.index_select(0, index)
+    return encoder_outputs, attention_mask.index_select(0, index)
+
+
+class EncoderCache:
+    # NOTE: an LRU cache of the encoder states of a view, keyed by its unpadded input ids
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Tuple[int, ...], torch.Tensor]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Tuple[int, ...]) -> Optional[torch.Tensor]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def put(self, key: Tuple[int, ...], value: torch.Tensor) -> None:
+        size = value.numel() * value.element_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                old = self._data.pop(key)
+                self.num_bytes -= old.numel() * old.element_size()
+            self._data[key] = value
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, old = self._data.popitem(last=False)
+                self.num_bytes -= old.numel() * old.element_size()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.num_bytes = self.hits = self.misses = 0
+
+    def info(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self),
+            "bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def encode(
+        self, encoder: Callable[..., Any], input_ids: torch.Tensor, attention_mask: torch.Tensor
+    ) -> torch.Tensor:
+        mask = attention_mask.bool()
+        keys = [tuple(ids[m].tolist()) for ids, m in zip(input_ids, mask)]
+        states: List[Optional[torch.Tensor]] = [self.get(key) for key in keys]
+        missing: Dict[Tuple[int, ...], List[int]] = {}
+        for i, value in enumerate(states):
+            if value is None:
+                missing.setdefault(keys[i], []).append(i)
+
+        if missing:
+            rows = [indices[0] for indices in missing.values()]
+            outputs = encoder(
+                input_ids=input_ids[rows], attention_mask=attention_mask[rows], return_dict=True
+            )
+            for (key, indices), row, hidden in zip(
+                missing.items(), rows, outputs.last_hidden_state
+            ):
+                value = hidden[mask[row]]
+                self.put(key, value)
+                for i in indices:
+                    states[i] = value
+
+        first = states[0]
+        assert first is not None
+        last_hidden_state = first.new_zeros((*input_ids.shape, first.size(-1)))
+        for i, value in enumerate(states):
+            last_hidden_state[i, mask[i]] = value
+        return last_hidden_state
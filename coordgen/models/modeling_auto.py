@@ -1,9 +1,15 @@
 import importlib
+import os
 from types import ModuleType
 from typing import Any, Dict
 
+import torch
 from transformers import AutoConfig, AutoTokenizer, PretrainedConfig
 
+from coordgen.models.export import EXPORT_CONFIG_NAME
+from coordgen.models.runtime import ExportedModelForSeq2SeqLM
+from coordgen.models.snapshot import SNAPSHOT_CONFIG_NAME, load_snapshot_model
+
 
 class _LazyAutoMapping(Dict[str, Any]):
     def __init__(self, mapping: Dict[str, str]):
@@ -85,7 +91,43 @@ class AutoModelForCoordinationGeneration(_BaseAutoModelClass):
 
     @classmethod
     def from_pretrained(cls, pretrained_model_name_or_path, **kwargs):
-        tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path)
-        model = cls._auto_model_class.from_pretrained(pretrained_model_name_or_path)
+        # NOTE: `torch_dtype` (e.g. `torch.bfloat16`) sets the dtype of the weights,
+        # `quantization="int8"` dynamically quantizes the linear layers for CPU inference, and
+        # `num_threads` sets the number of intra-op threads of torch.  A loaded `tokenizer` is used
+        # as it is, e.g., to share one between checkpoints of the same vocabulary.
+        tokenizer = kwargs.pop("tokenizer", None)
+        torch_dtype = kwargs.pop("torch_dtype", None)
+        quantization = kwargs.pop("quantization", None)
+        num_threads = kwargs.pop("num_threads", None)
+        if quantization not in (None, "int8"):
+            raise ValueError(f"unknown quantization: {quantization!r}")
+        if quantization is not None:
+            if torch_dtype not in (None, torch.float32, "float32"):
+                raise ValueError("int8 quantization requires float32 weights")
+            if kwargs.get("device") is not None and torch.device(kwargs["device"]).type != "cpu":
+                raise ValueError("int8 quantization is only supported on CPU")
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        if tokenizer is None:
+            tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path)
+        if os.path.isfile(os.path.join(pretrained_model_name_or_path, EXPORT_CONFIG_NAME)):
+            # NOTE: a directory written by `coordgen.models.export`
+            if torch_dtype is not None or quantization is not None:
+                raise ValueError("exported models cannot be converted on loading")
+            model = ExportedModelForSeq2SeqLM.from_pretrained(pretrained_model_name_or_path)
+        elif os.path.isfile(os.path.join(pretrained_model_name_or_path, SNAPSHOT_CONFIG_NAME)):
+            # NOTE: a directory written by `coordgen.models.snapshot`, already converted
+            if torch_dtype is not None or quantization is not None:
+                raise ValueError("snapshots cannot be converted on loading")
+            model = load_snapshot_model(pretrained_model_name_or_path)
+        else:
+            model = cls._auto_model_class.from_pretrained(
+                pretrained_model_name_or_path, torch_dtype=torch_dtype
+            )
+        if quantization == "int8":
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
         model_class = cls._get_model_class(model.config)
         return model_class(model, tokenizer, **kwargs)
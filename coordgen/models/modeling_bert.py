@@ -1,11 +1,19 @@
-from typing import Iterable, List, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
 
 import torch
 import transformers
 
-from coordgen._core import Coord, CoordinationGenerator, Span
-from coordgen.models._utils import embed_coord, embed_mask
-from coordgen.models.generation_utils import SynchronizedLogitsProcessor
+from coordgen._core import Coord, CoordinationGenerator, PreparedBatch, Span
+from coordgen._profiling import GenerationStats, stage
+from coordgen.models._utils import (
+    SpanTokenizer,
+    embed_coord,
+    embed_mask,
+    model_precision,
+    pad_batch,
+    resolve_coordinators,
+    tokenizer_lock,
+)
 
 
 class BertForCoordinationGeneration(CoordinationGenerator):
@@ -27,73 +35,288 @@ class BertForCoordinationGeneration(CoordinationGenerator):
             self.model.to(self.device)
 
         self.cc = kwargs.get("coordinator", "and")
+        # NOTE: `decoding` is either "argmax" (fill every mask in one pass) or "mask_predict"
+        # (refine the least confident positions over `num_iterations` rounds).  The conjunct is
+        # generated for each span length `num_tokens + offset` in `length_offsets`, and the
+        # candidate with the best synchronized score is chosen.
+        self.decoding = kwargs.get("decoding", "argmax")
+        self.num_iterations = kwargs.get("num_iterations", 4)
+        self.length_offsets = tuple(kwargs.get("length_offsets", (0,)))
+        # NOTE: `generate_candidates` returns up to `num_return_sequences` of the length
+        # candidates, best first.
+        self.num_return_sequences = kwargs.get("num_return_sequences", 1)
+        if self.decoding not in ("argmax", "mask_predict"):
+            raise ValueError(f"unknown decoding: {self.decoding!r}")
+        # NOTE: with `pretokenize`, each sentence is tokenized once and the views are built by
+        # splicing token ids, which requires a fast tokenizer.
+        self.pretokenize = kwargs.get("pretokenize", False)
+        if self.pretokenize and not tokenizer.is_fast:
+            raise ValueError("pretokenize requires a fast tokenizer")
+        self._span_tokenizer = SpanTokenizer(tokenizer)
+        # NOTE: the stages of a pipelined run take turns with the tokenizer
+        self._tokenizer_lock = tokenizer_lock(tokenizer)
 
-    def generate(self, inputs: Iterable[Tuple[str, Span]]) -> List[Tuple[str, Coord]]:
-        inputs = list(inputs)
+    def generate(
+        self, inputs: Iterable[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> List[Tuple[str, Coord]]:
+        return [candidates[0] for candidates in self.generate_candidates(inputs, coordinators)]
 
-        batch_append_inputs = []
-        batch_prepend_inputs = []
-        for raw, span in inputs:
+    def generate_candidates(
+        self, inputs: Iterable[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> List[List[Tuple[str, Coord]]]:
+        batch = self._prepare_batch(list(inputs), coordinators)
+        return self._finish_batch(batch, self._run_batch(batch))
+
+    def input_length(self, raw: str, span: Span) -> int:
+        # NOTE: the views are packed into `[CLS] view1 [SEP] view2 [SEP]`
+        encode = self._span_tokenizer.encode
+        with self._tokenizer_lock:
+            length = len(encode(raw)[0]) + len(encode(" " + self.cc)[0])
             num_tokens = len(self.tokenizer.tokenize(raw[span[0] : span[1]]))
-            mask = " ".join([self.tokenizer.mask_token] * num_tokens)
-            s1, s2 = embed_mask(mask, raw, span, self.cc)
-            batch_append_inputs.append(s1)
-            batch_prepend_inputs.append(s2)
+        # NOTE: the longest of the candidate lengths, which sets the length of the padded rows
+        return 2 * (length + max(self._candidate_lengths(num_tokens))) + 3
+
+    def decoding_config(self) -> Dict[str, Any]:
+        return {
+            "class": type(self).__qualname__,
+            "model": self.model.config.name_or_path,
+            "precision": model_precision(self.model),
+            "coordinator": self.cc,
+            "decoding": self.decoding,
+            "num_iterations": self.num_iterations,
+            "length_offsets": list(self.length_offsets),
+            "num_return_sequences": self.num_return_sequences,
+        }
+
+    def _prepare_batch(
+        self, inputs: List[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> PreparedBatch:
+        ccs = resolve_coordinators(coordinators, len(inputs), self.cc)
+        stats = self._start_profiling(len(inputs))
+
+        with self._tokenizer_lock:
+            if self.pretokenize:
+                with stage(stats, "tokenize"):
+                    batch, batch_owners = self._encode_spliced(inputs, ccs)
+            else:
+                batch_append_inputs = []
+                batch_prepend_inputs = []
+                batch_owners = []
+                with stage(stats, "embed_mask"):
+                    for i, ((raw, span), cc) in enumerate(zip(inputs, ccs)):
+                        num_tokens = len(self.tokenizer.tokenize(raw[span[0] : span[1]]))
+                        for length in self._candidate_lengths(num_tokens):
+                            s1, s2 = self._embed_masks(raw, span, cc, length)
+                            batch_append_inputs.append(s1)
+                            batch_prepend_inputs.append(s2)
+                            batch_owners.append(i)
+                with stage(stats, "tokenize"):
+                    batch = self.tokenizer(
+                        batch_append_inputs,
+                        batch_prepend_inputs,
+                        padding=True,
+                        return_tensors="pt",
+                    )
+        if stats is not None:
+            stats.num_tokens += int(batch.attention_mask.sum())
+            stats.num_padded_tokens += batch.attention_mask.numel()
+        return PreparedBatch(inputs, ccs, stats, {"batch": batch, "owners": batch_owners})
+
+    def _run_batch(self, batch: PreparedBatch) -> List[Tuple[List[int], float]]:
+        with stage(batch.stats, "search"):
+            return self._forward(batch.features["batch"], batch.stats)
+
+    def _finish_batch(
+        self, batch: PreparedBatch, outputs: List[Tuple[List[int], float]]
+    ) -> List[List[Tuple[str, Coord]]]:
+        assert batch.coordinators is not None
+        stats = batch.stats
+        with stage(stats, "decode"):
+            hyps: List[List[Tuple[List[int], float]]] = [[] for _ in batch.inputs]
+            for i, hyp in zip(batch.features["owners"], outputs):
+                hyps[i].append(hyp)
+            hyps = [
+                sorted(h, key=lambda x: x[1], reverse=True)[: self.num_return_sequences]
+                for h in hyps
+            ]
+
+            with self._tokenizer_lock:
+                texts = iter(self.tokenizer.batch_decode([ids for h in hyps for ids, _ in h]))
+            candidates = []
+            for h, (raw, span), cc in zip(hyps, batch.inputs, batch.coordinators):
+                row = []
+                for (_, score), text in zip(h, texts):
+                    s, coord = embed_coord(text.strip(), raw, span, cc)
+                    coord.score = score
+                    row.append((s, coord))
+                candidates.append(row)
 
-        decoding = self._forward(batch_append_inputs, batch_prepend_inputs)
+        self._finish_profiling(stats)
+        return candidates
 
-        outputs = []
-        for ids, (raw, span) in zip(decoding, inputs):
-            text = self.tokenizer.decode(ids).strip()
-            s = embed_coord(text, raw, span, self.cc)
-            outputs.append(s)
+    def _candidate_lengths(self, num_tokens: int) -> List[int]:
+        return sorted({max(num_tokens + d, 1) for d in self.length_offsets})
 
-        return outputs
+    def _embed_masks(self, raw: str, span: Span, cc: str, length: int) -> Tuple[str, str]:
+        mask = " ".join([self.tokenizer.mask_token] * length)
+        return embed_mask(mask, raw, span, cc)
+
+    def _encode_spliced(
+        self, inputs: List[Tuple[str, Span]], coordinators: List[str]
+    ) -> Tuple[transformers.BatchEncoding, List[int]]:
+        # NOTE: inputs that only differ in the coordinator share the split of `raw`
+        splits: Dict[Tuple[str, Span], Optional[Tuple[List[int], List[int], List[int]]]] = {}
+
+        batch_input_ids = []
+        batch_token_type_ids = []
+        batch_owners = []
+        for i, ((raw, span), cc) in enumerate(zip(inputs, coordinators)):
+            key = (raw, tuple(span))
+            if key not in splits:
+                splits[key] = self._span_tokenizer.split(raw, span)
+            parts = splits[key]
+            if parts is None:  # the span does not fall on token boundaries
+                num_tokens = len(self.tokenizer.tokenize(raw[span[0] : span[1]]))
+            else:
+                head, body, tail = parts
+                num_tokens = len(body)
+                cc_ids = self._span_tokenizer.encode(" " + cc)[0]
+            for length in self._candidate_lengths(num_tokens):
+                if parts is None:
+                    texts = self._embed_masks(raw, span, cc, length)
+                    ids1, ids2 = self.tokenizer(list(texts), add_special_tokens=False).input_ids
+                else:
+                    masks = [self.tokenizer.mask_token_id] * length
+                    ids1 = head + body + cc_ids + masks + tail
+                    ids2 = head + masks + cc_ids + body + tail
+                batch_input_ids.append(self.tokenizer.build_inputs_with_special_tokens(ids1, ids2))
+                batch_token_type_ids.append(
+                    self.tokenizer.create_token_type_ids_from_sequences(ids1, ids2)
+                )
+                batch_owners.append(i)
+
+        batch = pad_batch(
+            self.tokenizer, {"input_ids": batch_input_ids, "token_type_ids": batch_token_type_ids}
+        )
+        return batch, batch_owners
 
     @torch.no_grad()
-    def _forward(self, inputs1: List[str], inputs2: List[str]) -> List[List[int]]:
-        assert len(inputs1) == len(inputs2)
-        batch = self.tokenizer(inputs1, inputs2, padding=True, return_tensors="pt")
+    def _forward(
+        self, batch: transformers.BatchEncoding, stats: Optional[GenerationStats] = None
+    ) -> List[Tuple[List[int], float]]:
         if self.device:
             batch = batch.to(self.device)
 
+        positions, lengths = _find_span_pairs(
+            batch.input_ids, self.tokenizer.sep_token_id, self.tokenizer.mask_token_id
+        )
+        valid = torch.arange(positions.size(-1), device=lengths.device) < lengths.unsqueeze(-1)
+
         self.model.eval()
-        logits = self.model(**batch).logits
-
-        outputs = []
-        logits_processor = SynchronizedLogitsProcessor()
-        for i, ids in enumerate(batch.input_ids):
-            (start1, end1), (start2, end2) = _find_span_pair(
-                ids, self.tokenizer.sep_token_id, self.tokenizer.mask_token_id
-            )
-            scores = logits_processor.forward(logits[i, start1:end1], logits[i, start2:end2])
-            outputs.append(scores.argmax(dim=-1).tolist())
-
-        return outputs
-
-
-def _find_span_pair(ids, sep_token_id, mask_token_id):
-    length = len(ids)
-
-    sep_idx = 0
-    while sep_idx < length and ids[sep_idx] != sep_token_id:
-        sep_idx += 1
-    assert sep_idx < length, "could not find sep_token_id"
-
-    start1 = 0
-    while start1 < sep_idx and ids[start1] != mask_token_id:
-        start1 += 1
-    assert start1 < sep_idx, "could not find mask_token_id"
-    end1 = start1
-    while end1 < sep_idx and ids[end1] == mask_token_id:
-        end1 += 1
-
-    start2 = sep_idx + 1
-    while start2 < length and ids[start2] != mask_token_id:
-        start2 += 1
-    assert start2 < length, "could not find mask_token_id"
-    end2 = start2
-    while end2 < length and ids[end2] == mask_token_id:
-        end2 += 1
-
-    return (start1, end1), (start2, end2)
+        logits = self._predict(batch, positions, stats)
+        if self.decoding == "argmax":
+            with stage(stats, "logits_processors"):
+                # NOTE: the views are synchronized over log-probabilities, as in `_mask_predict`
+                log_probs = logits.log_softmax(dim=-1)
+                scores, ids = torch.minimum(log_probs[0], log_probs[1]).max(dim=-1)
+        else:
+            ids, scores = self._mask_predict(batch, positions, valid, logits, stats)
+
+        scores = scores.masked_fill(~valid, 0.0).sum(dim=-1) / lengths
+        return [
+            (row[:n], score)
+            for row, n, score in zip(ids.tolist(), lengths.tolist(), scores.tolist())
+        ]
+
+    def _predict(
+        self,
+        batch: Mapping[str, torch.Tensor],
+        positions: torch.Tensor,
+        stats: Optional[GenerationStats] = None,
+    ) -> torch.Tensor:
+        if stats is not None:
+            stats.num_steps += 1
+        batch_index = torch.arange(positions.size(1), device=positions.device).unsqueeze(-1)
+        head = getattr(self.model, "cls", None)
+        with stage(stats, "model"):
+            if head is not None:
+                # NOTE: only the masked positions go through the (vocabulary-sized) prediction head
+                hidden_states = self.model.base_model(**batch).last_hidden_state
+                return head(hidden_states[batch_index, positions]).float()
+            return self.model(**batch).logits[batch_index, positions].float()
+
+    def _mask_predict(
+        self,
+        batch: Mapping[str, torch.Tensor],
+        positions: torch.Tensor,
+        valid: torch.Tensor,
+        logits: torch.Tensor,
+        stats: Optional[GenerationStats] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Mask-Predict (Ghazvininejad et al., 2019) over synchronized scores: each round re-masks
+        # the `length * (T - t) / T` least confident positions in both views and re-scores them
+        # with a full forward pass of the rows that still have positions to refine.
+        log_probs = logits.log_softmax(dim=-1)
+        scores, ids = torch.minimum(log_probs[0], log_probs[1]).max(dim=-1)
+        input_ids = batch["input_ids"].clone()
+        lengths = valid.sum(dim=-1)
+        num_iterations = self.num_iterations
+
+        for t in range(1, num_iterations):
+            num_masks = lengths * (num_iterations - t) // num_iterations
+            rows = (num_masks > 0).nonzero().squeeze(-1)
+            if rows.numel() == 0:
+                break
+
+            confidence = scores[rows].masked_fill(~valid[rows], float("inf"))
+            ranks = confidence.argsort(dim=-1).argsort(dim=-1)
+            remask = ranks < num_masks[rows].unsqueeze(-1)
+            values = ids[rows].masked_fill(remask, self.tokenizer.mask_token_id)
+            sub_input_ids = input_ids[rows]
+            for p in positions[:, rows]:
+                _assign(sub_input_ids, p, valid[rows], values)
+
+            sub_batch = {k: v[rows] for k, v in batch.items()}
+            sub_batch["input_ids"] = sub_input_ids
+            log_probs = self._predict(sub_batch, positions[:, rows], stats).log_softmax(dim=-1)
+            new_scores, new_ids = torch.minimum(log_probs[0], log_probs[1]).max(dim=-1)
+            ids[rows] = torch.where(remask, new_ids, ids[rows])
+            scores[rows] = torch.where(remask, new_scores, scores[rows])
+
+        return ids, scores
+
+
+def _assign(
+    input_ids: torch.Tensor, positions: torch.Tensor, valid: torch.Tensor, values: torch.Tensor
+) -> None:
+    rows, cols = valid.nonzero(as_tuple=True)
+    input_ids[rows, positions[rows, cols]] = values[rows, cols]
+
+
+def _find_span_pairs(
+    ids: torch.Tensor, sep_token_id: int, mask_token_id: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # Returns the positions of the mask spans in the first and second segments, each padded to
+    # the longest span in the batch, as a tensor of shape `(2, batch_size, max_span_length)`,
+    # together with the span lengths.
+    length = ids.size(1)
+    is_sep = ids == sep_token_id
+    assert is_sep.any(dim=1).all(), "could not find sep_token_id"
+    sep_idx = is_sep.int().argmax(dim=1, keepdim=True)
+
+    index = torch.arange(length, device=ids.device).unsqueeze(0)
+    is_mask = ids == mask_token_id
+    is_mask1 = is_mask & (index < sep_idx)
+    is_mask2 = is_mask & (index > sep_idx)
+    assert is_mask1.any(dim=1).all() and is_mask2.any(dim=1).all(), "could not find mask_token_id"
+
+    lengths = is_mask1.sum(dim=1)
+    assert torch.equal(lengths, is_mask2.sum(dim=1)), "mask spans must have the same length"
+    starts = torch.stack([is_mask1.int().argmax(dim=1), is_mask2.int().argmax(dim=1)])
+    offsets = torch.arange(int(lengths.max()), device=ids.device)
+    positions = (starts.unsqueeze(-1) + offsets).clamp(max=length - 1)
+
+    padding = offsets >= lengths.unsqueeze(-1)
+    assert (is_mask.gather(1, positions[0]) | padding).all(), "mask span must be contiguous"
+    assert (is_mask.gather(1, positions[1]) | padding).all(), "mask span must be contiguous"
+    return positions, lengths
@@ -1,16 +1,33 @@
-from typing import Iterable, List, Optional, Tuple
+import math
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import torch
 import transformers
 
-from coordgen._core import Coord, CoordinationGenerator, Span
-from coordgen.models._utils import embed_coord, embed_mask
-from coordgen.models.generation_utils import GenerationMixin
+from coordgen._core import Coord, CoordinationGenerator, PreparedBatch, Span
+from coordgen._profiling import GenerationStats, stage
+from coordgen.models._utils import (
+    SpanTokenizer,
+    embed_coord,
+    embed_mask,
+    model_precision,
+    pad_batch,
+    resolve_coordinators,
+    tokenizer_lock,
+)
+from coordgen.models.constraints import LogitsConstraints, TokenTrie
+from coordgen.models.generation_utils import (
+    EncoderCache,
+    GenerationMixin,
+    SynchronizedBeamSearch,
+    SynchronizedSampling,
+)
 
 
 class T5ForCoordinationGeneration(CoordinationGenerator):
     EXTRA_TOKEN_0 = "<extra_id_0>"
     EXTRA_TOKEN_1 = "<extra_id_1>"
+    OFFSET = 3  # <pad> <extra_id_0> [...] <extra_id_1>
 
     def __init__(
         self,
@@ -18,10 +35,6 @@ class T5ForCoordinationGeneration(CoordinationGenerator):
         tokenizer: transformers.PreTrainedTokenizerBase,
         **kwargs,
     ):
-        if not isinstance(model, GenerationMixin):
-            mixin_name = f"{GenerationMixin.__module__}.{GenerationMixin.__qualname__}"
-            raise TypeError(f"model must implement `{mixin_name}`")
-
         self.model = model
         self.tokenizer = tokenizer
         self.device: Optional[torch.device] = None
@@ -35,68 +48,264 @@ class T5ForCoordinationGeneration(CoordinationGenerator):
 
         self.cc = kwargs.get("coordinator", "and")
         self.num_beams = kwargs.get("num_beam", 4)
+        # NOTE: `generate_candidates` returns the `num_return_sequences` best synchronized
+        # hypotheses of one search per input: beam search, optionally diversified over
+        # `num_beam_groups`, or sampling with `do_sample`.
+        self.num_return_sequences = kwargs.get("num_return_sequences", 1)
+        self.num_beam_groups = kwargs.get("num_beam_groups", 1)
+        self.diversity_penalty = kwargs.get("diversity_penalty", 0.0)
+        self.do_sample = kwargs.get("do_sample", False)
+        self.temperature = kwargs.get("temperature", 1.0)
+        self.top_k = kwargs.get("top_k", 0)
+        self.top_p = kwargs.get("top_p", 1.0)
+        # NOTE: with `max_length_ratio`, the conjunct generated for an input is cut at
+        # `ceil(max_length_ratio * n) + max_length_slack` tokens, where `n` is the number of tokens
+        # of the span, instead of `tokenizer.model_max_length`.
+        self.max_length_ratio = kwargs.get("max_length_ratio")
+        self.max_length_slack = kwargs.get("max_length_slack", 4)
+        # NOTE: with `pretokenize`, each sentence is tokenized once and the views are built by
+        # splicing token ids, which requires a fast tokenizer.
+        self.pretokenize = kwargs.get("pretokenize", False)
+        if self.pretokenize and not tokenizer.is_fast:
+            raise ValueError("pretokenize requires a fast tokenizer")
+        self._span_tokenizer = SpanTokenizer(tokenizer)
+        # NOTE: the stages of a pipelined run take turns with the tokenizer
+        self._tokenizer_lock = tokenizer_lock(tokenizer)
+        # NOTE: with `encoder_cache_bytes`, the encoder states of views that recur within a batch
+        # or across batches are reused, up to the given memory budget.
+        self.encoder_cache: Optional[EncoderCache] = None
+        if kwargs.get("encoder_cache_bytes"):
+            self.encoder_cache = EncoderCache(kwargs["encoder_cache_bytes"])
 
         allowed_tokens = [self.EXTRA_TOKEN_0, self.EXTRA_TOKEN_1]
         allowed_token_ids = set(tokenizer.convert_tokens_to_ids(allowed_tokens))
         self._all_special_ids = set(self.tokenizer.all_special_ids)
         self._bad_token_ids = self._all_special_ids - allowed_token_ids
 
-    def generate(self, inputs: Iterable[Tuple[str, Span]]) -> List[Tuple[str, Coord]]:
-        inputs = list(inputs)
+        # NOTE: with `forbidden_words`, the conjunct never contains any of the words, and with
+        # `conjunct_vocabulary` ("span" or "sentence"), it only consists of words of the span or
+        # the sentence of each input.  Both are enforced while decoding.
+        self.forbidden_words = list(kwargs.get("forbidden_words") or [])
+        self.conjunct_vocabulary = kwargs.get("conjunct_vocabulary")
+        if self.conjunct_vocabulary not in (None, "span", "sentence"):
+            raise ValueError(f"unknown conjunct_vocabulary: {self.conjunct_vocabulary}")
+        self.constraints = LogitsConstraints(
+            self._bad_token_ids,
+            self._word_trie(self.forbidden_words) if self.forbidden_words else None,
+            end_token_ids=tokenizer.convert_tokens_to_ids([self.EXTRA_TOKEN_1]),
+            offset=2,  # <pad> <extra_id_0>
+        )
+
+    def generate(
+        self, inputs: Iterable[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> List[Tuple[str, Coord]]:
+        return [candidates[0] for candidates in self.generate_candidates(inputs, coordinators)]
 
-        batch_append_inputs = []
-        batch_prepend_inputs = []
-        for raw, span in inputs:
-            s1, s2 = embed_mask(self.EXTRA_TOKEN_0, raw, span, self.cc)
-            batch_append_inputs.append(s1)
-            batch_prepend_inputs.append(s2)
+    def generate_candidates(
+        self, inputs: Iterable[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> List[List[Tuple[str, Coord]]]:
+        batch = self._prepare_batch(list(inputs), coordinators)
+        return self._finish_batch(batch, self._run_batch(batch))
 
-        decoding = self._forward(batch_append_inputs, batch_prepend_inputs)
+    def input_length(self, raw: str, span: Span) -> int:
+        # NOTE: each view is `raw` with the coordinator and a sentinel token, followed by `</s>`
+        encode = self._span_tokenizer.encode
+        with self._tokenizer_lock:
+            length = len(encode(raw)[0]) + len(encode(" " + self.cc)[0]) + 2
+        return 2 * length
 
-        outputs = []
-        for ids, (raw, span) in zip(decoding, inputs):
-            text = self.tokenizer.decode(ids).strip()
-            s = embed_coord(text, raw, span, self.cc)
-            outputs.append(s)
+    def decoding_config(self) -> Dict[str, Any]:
+        return {
+            "class": type(self).__qualname__,
+            "model": self.model.config.name_or_path,
+            "precision": model_precision(self.model),
+            "coordinator": self.cc,
+            "num_beams": self.num_beams,
+            "num_return_sequences": self.num_return_sequences,
+            "num_beam_groups": self.num_beam_groups,
+            "diversity_penalty": self.diversity_penalty,
+            "do_sample": self.do_sample,
+            "temperature": self.temperature,
+            "top_k": self.top_k,
+            "top_p": self.top_p,
+            "max_length_ratio": self.max_length_ratio,
+            "max_length_slack": self.max_length_slack,
+            "forbidden_words": self.forbidden_words,
+            "conjunct_vocabulary": self.conjunct_vocabulary,
+        }
+
+    def _prepare_batch(
+        self, inputs: List[Tuple[str, Span]], coordinators: Optional[Sequence[str]] = None
+    ) -> PreparedBatch:
+        ccs = resolve_coordinators(coordinators, len(inputs), self.cc)
+        stats = self._start_profiling(len(inputs))
+        features: Dict[str, Any] = {}
+        with self._tokenizer_lock:
+            features["batch"] = self._encode_views(inputs, ccs, stats)
+            if self.max_length_ratio is not None:
+                features["max_lengths"] = [self._max_length(raw, span) for raw, span in inputs]
+            if self.conjunct_vocabulary is not None:
+                features["allowed"] = [self._vocabulary(raw, span) for raw, span in inputs]
+        return PreparedBatch(inputs, ccs, stats, features)
+
+    def _run_batch(self, batch: PreparedBatch) -> List[List[Tuple[List[int], float]]]:
+        with stage(batch.stats, "search"):
+            return self._forward(
+                batch.features["batch"],
+                batch.stats,
+                batch.features.get("max_lengths"),
+                batch.features.get("allowed"),
+            )
+
+    def _finish_batch(
+        self, batch: PreparedBatch, outputs: List[List[Tuple[List[int], float]]]
+    ) -> List[List[Tuple[str, Coord]]]:
+        assert batch.coordinators is not None
+        with stage(batch.stats, "decode"), self._tokenizer_lock:
+            candidates = self._decode_outputs(outputs, batch.inputs, batch.coordinators)
+        self._finish_profiling(batch.stats)
+        return candidates
 
+    def _max_length(self, raw: str, span: Span) -> int:
+        num_tokens = len(self.tokenizer.tokenize(raw[span[0] : span[1]]))
+        return math.ceil(self.max_length_ratio * num_tokens) + self.max_length_slack
+
+    def _vocabulary(self, raw: str, span: Span) -> TokenTrie:
+        text = raw[span[0] : span[1]] if self.conjunct_vocabulary == "span" else raw
+        return self._word_trie(text.split())
+
+    def _word_trie(self, words: Iterable[str]) -> TokenTrie:
+        # NOTE: words are tokenized as they appear after a space
+        return TokenTrie(self._span_tokenizer.encode(" " + word)[0] for word in words)
+
+    def _encode_views(
+        self,
+        inputs: List[Tuple[str, Span]],
+        coordinators: List[str],
+        stats: Optional[GenerationStats] = None,
+    ) -> transformers.BatchEncoding:
+        # Returns the first views of all the inputs followed by their second views.
+        if self.pretokenize:
+            with stage(stats, "tokenize"):
+                batch = self._encode_spliced(inputs, coordinators)
+        else:
+            batch_append_inputs = []
+            batch_prepend_inputs = []
+            with stage(stats, "embed_mask"):
+                for (raw, span), cc in zip(inputs, coordinators):
+                    s1, s2 = embed_mask(self.EXTRA_TOKEN_0, raw, span, cc)
+                    batch_append_inputs.append(s1)
+                    batch_prepend_inputs.append(s2)
+            with stage(stats, "tokenize"):
+                batch = self.tokenizer(
+                    batch_append_inputs + batch_prepend_inputs, padding=True, return_tensors="pt"
+                )
+        if stats is not None:
+            stats.num_tokens += int(batch.attention_mask.sum())
+            stats.num_padded_tokens += batch.attention_mask.numel()
+        return batch
+
+    def _decode_outputs(
+        self,
+        decoding: List[List[Tuple[List[int], float]]],
+        inputs: List[Tuple[str, Span]],
+        coordinators: List[str],
+    ) -> List[List[Tuple[str, Coord]]]:
+        texts = iter(self.tokenizer.batch_decode([ids for hyps in decoding for ids, _ in hyps]))
+        outputs = []
+        for hyps, (raw, span), cc in zip(decoding, inputs, coordinators):
+            candidates = []
+            for (_, score), text in zip(hyps, texts):
+                s, coord = embed_coord(text.strip(), raw, span, cc)
+                coord.score = score
+                candidates.append((s, coord))
+            outputs.append(candidates)
         return outputs
 
+    def _encode_spliced(
+        self, inputs: List[Tuple[str, Span]], coordinators: List[str]
+    ) -> transformers.BatchEncoding:
+        extra_token_0_id = self.tokenizer.convert_tokens_to_ids(self.EXTRA_TOKEN_0)
+        # NOTE: inputs that only differ in the coordinator share the split of `raw`
+        splits: Dict[Tuple[str, Span], Optional[Tuple[List[int], List[int], List[int]]]] = {}
+
+        batch_append_ids = []
+        batch_prepend_ids = []
+        for (raw, span), cc in zip(inputs, coordinators):
+            key = (raw, tuple(span))
+            if key not in splits:
+                splits[key] = self._span_tokenizer.split(raw, span)
+            parts = splits[key]
+            if parts is None:  # the span does not fall on token boundaries
+                texts = embed_mask(self.EXTRA_TOKEN_0, raw, span, cc)
+                ids1, ids2 = self.tokenizer(list(texts), add_special_tokens=False).input_ids
+            else:
+                head, body, tail = parts
+                cc_ids = self._span_tokenizer.encode(" " + cc)[0]
+                ids1 = head + body + cc_ids + [extra_token_0_id] + tail
+                ids2 = head + [extra_token_0_id] + cc_ids + body + tail
+            batch_append_ids.append(self.tokenizer.build_inputs_with_special_tokens(ids1))
+            batch_prepend_ids.append(self.tokenizer.build_inputs_with_special_tokens(ids2))
+
+        return pad_batch(self.tokenizer, {"input_ids": batch_append_ids + batch_prepend_ids})
+
     @torch.no_grad()
-    def _forward(self, inputs1: List[str], inputs2: List[str]) -> List[List[int]]:
-        assert len(inputs1) == len(inputs2)
-        batch = self.tokenizer(inputs1 + inputs2, padding=True, return_tensors="pt")
+    def _forward(
+        self,
+        batch: transformers.BatchEncoding,
+        stats: Optional[GenerationStats] = None,
+        max_lengths: Optional[List[int]] = None,
+        allowed: Optional[List[TokenTrie]] = None,
+    ) -> List[List[Tuple[List[int], float]]]:
         if self.device:
             batch = batch.to(self.device)
 
+        self.model.eval()
+        kwargs = self._decoding_kwargs()
+        search: Union[SynchronizedBeamSearch, SynchronizedSampling]
+        if self.do_sample:
+            search = SynchronizedSampling(
+                self.model,
+                temperature=self.temperature,
+                top_k=self.top_k,
+                top_p=self.top_p,
+                **kwargs,
+            )
+        else:
+            search = SynchronizedBeamSearch(
+                self.model,
+                num_beams=self.num_beams,
+                early_stopping=True,
+                num_beam_groups=self.num_beam_groups,
+                diversity_penalty=self.diversity_penalty,
+                **kwargs,
+            )
+        if max_lengths is not None:
+            max_lengths = [self.OFFSET + n for n in max_lengths]
+        decoding = search.search(
+            batch.input_ids, batch.attention_mask, stats, max_lengths, allowed
+        )
+        return [[(self._strip(ids), score) for ids, score in hyps] for hyps in decoding]
+
+    def _decoding_kwargs(self) -> Dict[str, Any]:
         extra_token_0_id = self.tokenizer.convert_tokens_to_ids(self.EXTRA_TOKEN_0)
         extra_token_1_id = self.tokenizer.convert_tokens_to_ids(self.EXTRA_TOKEN_1)
-        offset = 3  # <pad> <extra_id_0> [...] <extra_id_1>
-
-        self.model.eval()
-        decoding = self.model.generate(
-            **batch,
-            min_length=offset,
-            max_length=offset + self.tokenizer.model_max_length,
-            early_stopping=True,
-            num_beams=self.num_beams,
-            num_return_sequences=1,
-            bos_token_id=extra_token_0_id,
+        return dict(
+            num_return_sequences=self.num_return_sequences,
+            min_length=self.OFFSET,
+            max_length=self.OFFSET + self.tokenizer.model_max_length,
             eos_token_id=extra_token_1_id,
             forced_bos_token_id=extra_token_0_id,
             forced_eos_token_id=extra_token_1_id,
-            bad_token_ids=self._bad_token_ids,
-            synchronize=True,
+            constraints=self.constraints,
+            encoder_cache=self.encoder_cache,
         )
 
-        outputs = []
-        max_length = decoding.size(1)
-        for ids in decoding[: len(decoding) // 2].tolist():
-            i = j = 2  # skip "<pad>" and "<extra_id_0>"
-            while j < max_length and ids[j] not in self._all_special_ids:
-                j += 1
-            outputs.append(ids[i:j])
-
-        return outputs
+    def _strip(self, ids: List[int]) -> List[int]:
+        i = j = 2  # skip "<pad>" and "<extra_id_0>"
+        while j < len(ids) and ids[j] not in self._all_special_ids:
+            j += 1
+        return ids[i:j]
 
 
 class T5ForConditionalGeneration(transformers.T5ForConditionalGeneration, GenerationMixin):
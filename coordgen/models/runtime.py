@@ -0,0 +1,104 @@
+import json
+import os
+from typing import Any, Callable, Optional, Tuple, Union
+
+import torch
+import transformers
+from transformers.modeling_outputs import BaseModelOutput, Seq2SeqLMOutput
+
+from coordgen.models.export import EXPORT_CONFIG_NAME, EXPORT_FORMATS
+
+_Graph = Callable[..., Any]
+_Cache = Tuple[Tuple[torch.Tensor, ...], ...]
+
+
+class ExportedModelForSeq2SeqLM(torch.nn.Module):
+    # NOTE: the parts of `PreTrainedModel` that the synchronized searches use, over exported graphs
+    def __init__(
+        self,
+        config: transformers.PretrainedConfig,
+        encoder: _Graph,
+        decoder: _Graph,
+        decoder_with_past: _Graph,
+    ):
+        super().__init__()
+        self.config = config
+        self.encoder = encoder
+        self.decoder = decoder
+        self.decoder_with_past = decoder_with_past
+
+    @classmethod
+    def from_pretrained(cls, path: Union[str, os.PathLike]) -> "ExportedModelForSeq2SeqLM":
+        with open(os.path.join(path, EXPORT_CONFIG_NAME)) as f:
+            format = json.load(f)["format"]
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"unknown format: {format!r}")
+        suffix = EXPORT_FORMATS[format]
+        load = _load_onnx if format == "onnx" else _load_torchscript
+        config = transformers.AutoConfig.from_pretrained(path)
+        graphs = [
+            load(os.path.join(path, name + suffix))
+            for name in ["encoder", "decoder", "decoder_with_past"]
+        ]
+        return cls(config, *graphs)
+
+    def get_encoder(self) -> Callable[..., BaseModelOutput]:
+        return self._encode
+
+    def _encode(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor, return_dict: bool = True
+    ) -> BaseModelOutput:
+        return BaseModelOutput(last_hidden_state=self.encoder(input_ids, attention_mask))
+
+    def forward(
+        self,
+        encoder_outputs: BaseModelOutput,
+        attention_mask: torch.Tensor,
+        decoder_input_ids: torch.Tensor,
+        past_key_values: Optional[_Cache] = None,
+        use_cache: bool = True,
+        return_dict: bool = True,
+    ) -> Seq2SeqLMOutput:
+        args = (decoder_input_ids, encoder_outputs.last_hidden_state, attention_mask)
+        if past_key_values is None:
+            logits, *flat = self.decoder(*args)
+            past_key_values = tuple(
+                tuple(flat[i : i + 4]) for i in range(0, len(flat), 4)  # type: ignore
+            )
+        else:
+            flat = tuple(x for layer in past_key_values for x in layer)
+            logits, *flat = self.decoder_with_past(*args, flat)
+            # NOTE: the graph returns the self-attention keys/values only
+            past_key_values = tuple(
+                (flat[2 * i], flat[2 * i + 1]) + layer[2:]
+                for i, layer in enumerate(past_key_values)
+            )
+        return Seq2SeqLMOutput(logits=logits.unsqueeze(1), past_key_values=past_key_values)
+
+    def _reorder_cache(self, past_key_values: _Cache, beam_idx: torch.Tensor) -> _Cache:
+        return tuple(
+            tuple(x.index_select(0, beam_idx) for x in layer) for layer in past_key_values
+        )
+
+
+def _load_onnx(path: str) -> _Graph:
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    names = [x.name for x in session.get_inputs()]
+
+    def _run(*args: Union[torch.Tensor, Tuple[torch.Tensor, ...]]) -> Any:
+        # NOTE: the tensors of a tuple argument are separate inputs of the graph, and a graph
+        # with a single output returns it as is, as TorchScript does
+        flat = [x for arg in args for x in (arg if isinstance(arg, tuple) else (arg,))]
+        feeds = {name: x.detach().cpu().numpy() for name, x in zip(names, flat)}
+        outputs = tuple(torch.from_numpy(x) for x in session.run(None, feeds))
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    return _run
+
+
+def _load_torchscript(path: str) -> _Graph:
+    module = torch.jit.load(path, map_location="cpu")
+    module.eval()
+    return module
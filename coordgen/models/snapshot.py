@@ -0,0 +1,72 @@
+import inspect
+import json
+import os
+from typing import TYPE_CHECKING, Union
+
+import torch
+import transformers
+
+from coordgen.models._utils import model_precision
+from coordgen.models.runtime import ExportedModelForSeq2SeqLM
+
+if TYPE_CHECKING:
+    from coordgen._core import CoordinationGenerator
+
+SNAPSHOT_CONFIG_NAME = "coordgen_snapshot.json"
+SNAPSHOT_MODEL_NAME = "model.pt"
+
+
+def save_snapshot(generator: "CoordinationGenerator", output_dir: Union[str, os.PathLike]) -> None:
+    # NOTE: snapshots are pickles: only load those you trust, with the versions that wrote them
+    model = getattr(generator, "model", None)
+    if not isinstance(model, transformers.PreTrainedModel):
+        if isinstance(model, ExportedModelForSeq2SeqLM):
+            raise ValueError("exported models cannot be snapshotted")
+        raise ValueError("the generator has no model to snapshot")
+
+    os.makedirs(output_dir, exist_ok=True)
+    torch.save(model, os.path.join(output_dir, SNAPSHOT_MODEL_NAME))
+    model.config.save_pretrained(output_dir)
+    generator.tokenizer.save_pretrained(output_dir)  # type: ignore
+    with open(os.path.join(output_dir, SNAPSHOT_CONFIG_NAME), "w") as f:
+        json.dump(
+            {
+                "precision": model_precision(model),
+                "torch": torch.__version__,
+                "transformers": transformers.__version__,
+            },
+            f,
+        )
+
+
+def load_snapshot_model(path: Union[str, os.PathLike]) -> transformers.PreTrainedModel:
+    # NOTE: the weights are memory-mapped and paged in as they are first used, with torch>=2.1;
+    # older versions read them into memory
+    kwargs = {
+        name: value
+        for name, value in (("mmap", True), ("weights_only", False))
+        if name in inspect.signature(torch.load).parameters
+    }
+    model = torch.load(os.path.join(path, SNAPSHOT_MODEL_NAME), map_location="cpu", **kwargs)
+    return model.eval()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from coordgen.models.modeling_auto import AutoModelForCoordinationGeneration
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model")
+    parser.add_argument("output_dir")
+    parser.add_argument("--torch_dtype", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--quantization", choices=["int8"])
+    args = parser.parse_args()
+    save_snapshot(
+        AutoModelForCoordinationGeneration.from_pretrained(
+            args.model,
+            torch_dtype=getattr(torch, args.torch_dtype) if args.torch_dtype else None,
+            quantization=args.quantization,
+        ),
+        args.output_dir,
+    )
@@ -1,18 +1,41 @@
+import asyncio
+import gc
+import hashlib
+import json
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from functools import lru_cache
-from typing import Any, Dict, List
+from itertools import islice
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
 
-import torch
-from coordgen.models import AutoModelForCoordinationGeneration
+from coordgen import CachedGenerator, Coord, CoordinationGenerator, GenerationStats, ResultCache
 from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import AnyHttpUrl, BaseModel, BaseSettings
 
 
 class Settings(BaseSettings):
+    # NOTE: `model_name` is loaded on startup and serves the requests that name no model; the
+    # other `models` are loaded when a request first names them, and the least recently used
+    # ones are unloaded once the loaded models take more than `model_memory_bytes`.
     model_name: str = "t5-small"
+    models: List[str] = []
+    model_memory_bytes: Optional[int] = None
     device: str = "cpu"
+    cache_size: int = 1024
+    cache_path: Optional[str] = None
+    batch_max_size: int = 16
+    batch_max_wait_ms: float = 5.0
+    batch_max_tokens: Optional[int] = None
+    metrics_enabled: bool = True
+    # NOTE: decode with `ContinuousBatchingEngine` (T5 beam search only) instead of micro-batches
+    continuous_batching: bool = False
     cors_origins: List[AnyHttpUrl] = []
 
     class Config:
@@ -24,16 +47,403 @@ def get_settings() -> Settings:
     return Settings()
 
 
+class GenerationMetrics:
+    # NOTE: aggregates the `GenerationStats` of the model calls for the `/metrics` endpoint
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.calls = 0
+        self.inputs = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.steps = 0
+        self.seconds = 0.0
+        self.stage_seconds: Dict[str, float] = {}
+        self.latency_buckets = [0] * len(self.LATENCY_BUCKETS)
+        self._lock = threading.Lock()
+
+    def observe(self, stats: GenerationStats) -> None:
+        with self._lock:
+            self.calls += 1
+            self.inputs += stats.num_inputs
+            self.tokens += stats.num_tokens
+            self.padded_tokens += stats.num_padded_tokens
+            self.steps += stats.num_steps
+            self.seconds += stats.elapsed
+            for stage, seconds in stats.stage_times.items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if stats.elapsed <= bound:
+                    self.latency_buckets[i] += 1
+
+    def render(self, cache: Optional[ResultCache] = None) -> str:
+        with self._lock:
+            lines = []
+
+            def _metric(name: str, kind: str, help: str, samples: List[Tuple[str, Any]]) -> None:
+                lines.append(f"# HELP coordgen_{name} {help}")
+                lines.append(f"# TYPE coordgen_{name} {kind}")
+                lines.extend(f"coordgen_{name}{labels} {value}" for labels, value in samples)
+
+            _metric("generate_calls_total", "counter", "Model calls.", [("", self.calls)])
+            _metric("generate_inputs_total", "counter", "Generated inputs.", [("", self.inputs)])
+            _metric("input_tokens_total", "counter", "Non-padding tokens.", [("", self.tokens)])
+            _metric(
+                "input_padded_tokens_total",
+                "counter",
+                "Input positions including padding.",
+                [("", self.padded_tokens)],
+            )
+            _metric("decoding_steps_total", "counter", "Decoding steps.", [("", self.steps)])
+            _metric(
+                "stage_seconds_total",
+                "counter",
+                "Wall time per stage (model, logits_processors and encode are within search).",
+                [(f'{{stage="{k}"}}', v) for k, v in sorted(self.stage_seconds.items())],
+            )
+            buckets = [
+                (f'_bucket{{le="{bound}"}}', count)
+                for bound, count in zip(self.LATENCY_BUCKETS, self.latency_buckets)
+            ]
+            buckets.append(('_bucket{le="+Inf"}', self.calls))
+            buckets.append(("_sum", self.seconds))
+            buckets.append(("_count", self.calls))
+            _metric("generate_duration_seconds", "histogram", "Latency of model calls.", buckets)
+            if cache is not None:
+                info = cache.info()
+                _metric("cache_hits_total", "counter", "Result cache hits.", [("", info["hits"])])
+                _metric(
+                    "cache_misses_total", "counter", "Result cache misses.", [("", info["misses"])]
+                )
+                _metric("cache_size", "gauge", "Cached results.", [("", info["size"])])
+        return "\n".join(lines) + "\n"
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        generator: CoordinationGenerator,
+        executor: ThreadPoolExecutor,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+    ):
+        self.generator = generator
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "asyncio.Queue[Tuple[Tuple[str, Tuple[int, int]], asyncio.Future]]"
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, raw: str, span: Tuple[int, int]) -> Tuple[str, Coord]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((raw, span), future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [(x, future) for x, future in batch if not future.done()]
+            if not batch:
+                continue
+            inputs = [x for x, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.generator.generate, inputs
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class EngineBatcher:
+    # NOTE: feeds a `ContinuousBatchingEngine`, which admits requests at every decoding step
+    def __init__(self, generator: CachedGenerator, engine: Any):
+        self.generator = generator
+        self.engine = engine
+
+    def start(self) -> None:
+        self.engine.start()
+
+    async def stop(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.engine.stop)
+
+    async def submit(self, raw: str, span: Tuple[int, int]) -> Tuple[str, Coord]:
+        return await asyncio.wrap_future(self._submit(raw, span))
+
+    async def generate_iter(
+        self, inputs: Iterable[Tuple[str, Tuple[int, int]]], max_pending: int
+    ) -> AsyncIterator[Tuple[str, Coord]]:
+        # NOTE: the futures of the engine are awaited on the event loop, and at most
+        # `max_pending` inputs are submitted ahead of the result being yielded
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(max_pending)
+        futures: "asyncio.Queue[Optional[asyncio.Future]]" = asyncio.Queue()
+
+        async def _feed() -> None:
+            try:
+                for raw, span in inputs:
+                    await slots.acquire()
+                    futures.put_nowait(asyncio.wrap_future(self._submit(raw, span)))
+            except Exception as e:
+                failed = loop.create_future()
+                failed.set_exception(e)
+                futures.put_nowait(failed)
+            futures.put_nowait(None)
+
+        task = asyncio.create_task(_feed())
+        try:
+            while True:
+                future = await futures.get()
+                if future is None:
+                    break
+                result = await future
+                slots.release()
+                yield result
+        finally:
+            task.cancel()
+
+    def _submit(self, raw: str, span: Tuple[int, int]) -> "Future[Tuple[str, Coord]]":
+        key = self.generator.cache_key(raw, span)
+        cached = self.generator.cache.get(key)
+        if cached is not None:
+            future: "Future[Tuple[str, Coord]]" = Future()
+            future.set_result(cached)
+            return future
+        future = self.engine.submit(raw, span)
+
+        def _put(f: "Future[Tuple[str, Coord]]") -> None:
+            if f.exception() is None:
+                self.generator.cache.put(key, f.result())
+
+        future.add_done_callback(_put)
+        return future
+
+
+class UnknownModelError(KeyError):
+    pass
+
+
+@dataclass
+class ModelEntry:
+    name: str
+    generator: CachedGenerator
+    batcher: Any
+    tokenizer_key: str
+    size: int
+    users: int = 0
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "bytes": self.size,
+            "precision": self.generator.decoding_config()["precision"],
+            "tokenizer": self.tokenizer_key[:12],
+            "continuous_batching": isinstance(self.batcher, EngineBatcher),
+            "active_requests": self.users,
+        }
+
+
+class ModelRegistry:
+    """Loads the models named by requests on first use and unloads the least recently used ones.
+
+    Models that load identical tokenizers share one.  Once the loaded models take more than
+    `memory_bytes`, those without requests in progress are unloaded, least recently used first;
+    a model that is being used is never unloaded, even if it alone exceeds the budget.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        cache: ResultCache,
+        metrics: GenerationMetrics,
+        executor: ThreadPoolExecutor,
+    ):
+        self.settings = settings
+        self.cache = cache
+        self.metrics = metrics
+        self.executor = executor
+        self.names = [settings.model_name] + [
+            name for name in settings.models if name != settings.model_name
+        ]
+        self.memory_bytes = settings.model_memory_bytes
+        # NOTE: ordered from the least to the most recently used
+        self._entries: "OrderedDict[str, ModelEntry]" = OrderedDict()
+        self._tokenizers: "weakref.WeakValueDictionary[str, Any]" = weakref.WeakValueDictionary()
+        self._tokenizers_lock = threading.Lock()
+        self._loading: Dict[str, asyncio.Lock] = {}
+
+    def resolve(self, name: Optional[str]) -> str:
+        name = name or self.settings.model_name
+        if name not in self.names:
+            raise UnknownModelError(name)
+        return name
+
+    @asynccontextmanager
+    async def use(self, name: Optional[str] = None) -> AsyncIterator[ModelEntry]:
+        entry = await self.load(self.resolve(name))
+        entry.users += 1
+        try:
+            await self._evict()
+            yield entry
+        finally:
+            entry.users -= 1
+        await self._evict()
+
+    async def load(self, name: str) -> ModelEntry:
+        if name not in self._entries:
+            async with self._loading.setdefault(name, asyncio.Lock()):
+                if name not in self._entries:
+                    # NOTE: loading runs outside `executor`, which keeps serving the other models
+                    loop = asyncio.get_running_loop()
+                    entry = await loop.run_in_executor(None, self._load, name)
+                    entry.batcher.start()
+                    self._entries[name] = entry
+        self._entries.move_to_end(name)
+        return self._entries[name]
+
+    async def close(self) -> None:
+        while self._entries:
+            await self._unload(next(iter(self._entries)))
+
+    def memory_usage(self) -> int:
+        return sum(entry.size for entry in self._entries.values())
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "available": self.names,
+            "loaded": [entry.info() for entry in reversed(self._entries.values())],
+            "memory_bytes": self.memory_usage(),
+            "memory_budget_bytes": self.memory_bytes,
+        }
+
+    def _load(self, name: str) -> ModelEntry:
+        # NOTE: torch and transformers are imported here rather than with the app
+        from coordgen.models import AutoModelForCoordinationGeneration, T5ForCoordinationGeneration
+        from transformers import AutoTokenizer
+
+        settings = self.settings
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        key = _tokenizer_key(tokenizer)
+        with self._tokenizers_lock:
+            tokenizer = self._tokenizers.setdefault(key, tokenizer)
+        # NOTE: `name` can be a snapshot written by `coordgen.models.snapshot`
+        model = AutoModelForCoordinationGeneration.from_pretrained(
+            name, tokenizer=tokenizer, device=settings.device
+        )
+        if settings.metrics_enabled:
+            model.add_profiling_hook(self.metrics.observe)
+        generator = CachedGenerator(model, self.cache)
+        batcher: Any
+        if settings.continuous_batching and isinstance(model, T5ForCoordinationGeneration):
+            from coordgen.models import ContinuousBatchingEngine
+
+            engine = ContinuousBatchingEngine(model, settings.batch_max_size)
+            batcher = EngineBatcher(generator, engine)
+        else:
+            batcher = MicroBatcher(
+                generator, self.executor, settings.batch_max_size, settings.batch_max_wait_ms
+            )
+        return ModelEntry(name, generator, batcher, key, _model_bytes(model.model, name))
+
+    async def _evict(self) -> None:
+        if self.memory_bytes is None:
+            return
+        while self.memory_usage() > self.memory_bytes:
+            name = next((k for k, v in self._entries.items() if v.users == 0), None)
+            if name is None:
+                break
+            await self._unload(name)
+
+    async def _unload(self, name: str) -> None:
+        entry = self._entries.pop(name)
+        await entry.batcher.stop()
+        del entry
+        if self.settings.device.startswith("cuda"):
+            import torch
+
+            # NOTE: returns the memory of the unloaded model to the device
+            gc.collect()
+            torch.cuda.empty_cache()
+
+
+def _tokenizer_key(tokenizer: Any) -> str:
+    # NOTE: tokenizers of the same class, settings and vocabulary are identical; the paths of the
+    # files they were loaded from are left out, and slow tokenizers are never shared.
+    if not tokenizer.is_fast:
+        return f"{tokenizer.name_or_path}:{id(tokenizer)}"
+    init_kwargs = {
+        k: v
+        for k, v in tokenizer.init_kwargs.items()
+        if k != "name_or_path" and not k.endswith("_file")
+    }
+    state = [type(tokenizer).__name__, init_kwargs, tokenizer.backend_tokenizer.to_str()]
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _model_bytes(model: Any, name: str) -> int:
+    # NOTE: counts each tensor of the state dict once, including the packed weights of quantized
+    # layers; a model without one, such as exported graphs, counts as the size of its files.
+    seen = set()
+    size = 0
+    values = list(model.state_dict().values())
+    while values:
+        value = values.pop()
+        if isinstance(value, (tuple, list)):
+            values.extend(value)
+        elif hasattr(value, "element_size") and value.data_ptr() not in seen:
+            seen.add(value.data_ptr())
+            size += value.numel() * value.element_size()
+    if size == 0 and os.path.isdir(name):
+        for root, _, files in os.walk(name):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     settings = get_settings()
-    model = AutoModelForCoordinationGeneration.from_pretrained(
-        settings.model_name, device=torch.device(settings.device)
-    )
-    app.state.models = {}
-    app.state.models["coordgen"] = model
+    cache = ResultCache(settings.cache_size, settings.cache_path)
+    app.state.cache = cache
+    app.state.metrics = GenerationMetrics()
+    # NOTE: all model calls go through a single worker thread
+    app.state.executor = ThreadPoolExecutor(max_workers=1)
+    app.state.registry = ModelRegistry(settings, cache, app.state.metrics, app.state.executor)
+    # NOTE: the default model is loaded on startup, the others on first use
+    await app.state.registry.load(settings.model_name)
     yield
-    app.state.models.clear()
+    await app.state.registry.close()
+    app.state.executor.shutdown(wait=True)
+    if settings.cache_path is not None:
+        cache.save()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -53,36 +463,120 @@ async def get_info() -> Dict[str, Any]:
     settings = get_settings()
     return {
         "model_name": settings.model_name,
+        "models": app.state.registry.info(),
+        "cache": app.state.cache.info(),
     }
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> str:
+    # NOTE: Prometheus text exposition format
+    return app.state.metrics.render(app.state.cache)
+
+
 class Span(BaseModel):
     start: int
     end: int
 
 
-class GenerateRequest(BaseModel):
+class GenerateItem(BaseModel):
     text: str
     start: int
     end: int
 
 
+class GenerateRequest(GenerateItem):
+    # NOTE: `model_name` or one of `models` of the settings, `model_name` by default
+    model: Optional[str] = None
+
+
 class GenerateResponse(BaseModel):
     text: str
     cc: Span
     conjuncts: List[Span]
 
+    @classmethod
+    def from_result(cls, raw: str, coord: Coord) -> "GenerateResponse":
+        return cls(
+            text=raw,
+            cc=Span(start=coord.cc[0], end=coord.cc[1]),
+            conjuncts=[Span(start=conj[0], end=conj[1]) for conj in coord.conjuncts],
+        )
+
+
+class BatchGenerateRequest(BaseModel):
+    items: List[GenerateItem]
+    model: Optional[str] = None
+
+
+class BatchGenerateResponse(BaseModel):
+    results: List[GenerateResponse]
+
 
 @app.post("/generate")
 async def generate(request: GenerateRequest) -> GenerateResponse:
-    batch = [(request.text, (request.start, request.end))]
-    results = app.state.models["coordgen"].generate(batch)
-    raw, coord = results[0]
-    return GenerateResponse(
-        text=raw,
-        cc=Span(start=coord.cc[0], end=coord.cc[1]),
-        conjuncts=[Span(start=conj[0], end=conj[1]) for conj in coord.conjuncts],
+    async with app.state.registry.use(request.model) as entry:
+        raw, coord = await entry.batcher.submit(request.text, (request.start, request.end))
+    return GenerateResponse.from_result(raw, coord)
+
+
+async def _iter_results(
+    entry: ModelEntry, request: BatchGenerateRequest, chunk_size: int
+) -> AsyncIterator[Tuple[str, Coord]]:
+    settings = get_settings()
+    inputs = ((item.text, (item.start, item.end)) for item in request.items)
+    if isinstance(entry.batcher, EngineBatcher):
+        # NOTE: the engine decodes on a thread of its own, so the executor is left to the others
+        async for result in entry.batcher.generate_iter(inputs, 2 * settings.batch_max_size):
+            yield result
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = entry.generator.generate_iter(
+        inputs,
+        batch_size=settings.batch_max_size,
+        max_tokens=settings.batch_max_tokens,
     )
+    # NOTE: the results are taken `chunk_size` at a time, so that the other requests and models
+    # get the executor in between
+    while True:
+        chunk = await loop.run_in_executor(app.state.executor, _take, iterator, chunk_size)
+        if not chunk:
+            break
+        for result in chunk:
+            yield result
+
+
+def _take(iterator: Iterator[Tuple[str, Coord]], size: int) -> List[Tuple[str, Coord]]:
+    return list(islice(iterator, size))
+
+
+@app.post("/generate/batch")
+async def generate_batch(request: BatchGenerateRequest) -> BatchGenerateResponse:
+    size = get_settings().batch_max_size
+    async with app.state.registry.use(request.model) as entry:
+        results = [result async for result in _iter_results(entry, request, size)]
+    return BatchGenerateResponse(
+        results=[GenerateResponse.from_result(raw, coord) for raw, coord in results]
+    )
+
+
+@app.post("/generate/stream")
+async def generate_stream(request: BatchGenerateRequest) -> StreamingResponse:
+    # NOTE: an unknown model is rejected before the response starts
+    name = app.state.registry.resolve(request.model)
+
+    async def _stream() -> AsyncIterator[str]:
+        async with app.state.registry.use(name) as entry:
+            async for result in _iter_results(entry, request, 1):
+                yield GenerateResponse.from_result(*result).json() + "\n"
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+
+@app.exception_handler(UnknownModelError)
+async def unknown_model_handler(request: Request, exc: UnknownModelError) -> Response:
+    return JSONResponse({"detail": f"Unknown model: {exc.args[0]}"}, status_code=404)
 
 
 @app.exception_handler(RuntimeError)
@@ -0,0 +1,13 @@
+import pytest
+
+from tests.conftest import save_tiny_bert, save_tiny_t5
+
+
+@pytest.fixture(scope="session")
+def model_path(tmp_path_factory):
+    return str(save_tiny_bert(tmp_path_factory.mktemp("bert")))
+
+
+@pytest.fixture(scope="session")
+def t5_model_path(tmp_path_factory):
+    return str(save_tiny_t5(tmp_path_factory.mktemp("t5")))
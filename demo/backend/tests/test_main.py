@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app import main  # noqa: E402
+
+ITEMS = [
+    {"text": "gold will retain its gain , he said .", "start": 10, "end": 25},
+    {"text": "the market rose sharply .", "start": 4, "end": 15},
+    {"text": "he said the market rose .", "start": 0, "end": 7},
+    {"text": "gold rose sharply .", "start": 5, "end": 17},
+    {"text": "the gain will retain .", "start": 4, "end": 8},
+]
+
+
+@pytest.fixture()
+def client(model_path, monkeypatch):
+    monkeypatch.setenv("MODEL_NAME", model_path)
+    monkeypatch.setenv("BATCH_MAX_SIZE", "2")
+    main.get_settings.cache_clear()
+    with TestClient(main.app) as client:
+        yield client
+    main.get_settings.cache_clear()
+
+
+def test_generate_batch(client, monkeypatch):
+    expected = [client.post("/generate", json=item).json() for item in ITEMS]
+    executor = main.app.state.executor
+    calls = []
+    submit = executor.submit
+    monkeypatch.setattr(executor, "submit", lambda *args: calls.append(args) or submit(*args))
+
+    response = client.post("/generate/batch", json={"items": ITEMS})
+    assert response.status_code == 200
+    assert response.json()["results"] == expected
+    # NOTE: 5 items in batches of 2, and a last call that finds the results exhausted
+    assert len(calls) == 4
+
+
+def test_generate_stream(client):
+    expected = [client.post("/generate", json=item).json() for item in ITEMS]
+    response = client.post("/generate/stream", json={"items": ITEMS})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == expected
+
+
+def test_generate_unknown_model(client):
+    item = {**ITEMS[0], "model": "unknown"}
+    assert client.post("/generate", json=item).status_code == 404
+    assert client.post("/generate/stream", json={"items": ITEMS, "model": "x"}).status_code == 404
+
+
+def test_generate_continuous_batching(t5_model_path, monkeypatch):
+    monkeypatch.setenv("MODEL_NAME", t5_model_path)
+    monkeypatch.setenv("BATCH_MAX_SIZE", "2")
+    monkeypatch.setenv("CONTINUOUS_BATCHING", "true")
+    main.get_settings.cache_clear()
+    items = [
+        {"text": "w1 w2 and w3 w4 .", "start": 0, "end": 17},
+        {"text": "w5 , w6 and w7 w8 .", "start": 0, "end": 10},
+        {"text": "w9 w10 or w11 .", "start": 3, "end": 14},
+    ]
+    with TestClient(main.app) as client:
+        assert client.get("/info").json()["models"]["loaded"][0]["continuous_batching"]
+        expected = [client.post("/generate", json=item).json() for item in items]
+        # NOTE: the engine futures are awaited on the event loop, never on the executor
+        executor = main.app.state.executor
+        monkeypatch.setattr(executor, "submit", lambda *args: pytest.fail("executor used"))
+        main.app.state.cache.clear()
+        response = client.post("/generate/batch", json={"items": items})
+        assert response.json()["results"] == expected
+        main.app.state.cache.clear()
+        response = client.post("/generate/stream", json={"items": items})
+        assert [json.loads(line) for line in response.text.splitlines()] == expected
+        assert main.app.state.cache.info()["misses"] == len(items)
+    main.get_settings.cache_clear()
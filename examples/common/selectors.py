@@ -1,6 +1,9 @@
+import hashlib
+import os
 import random
-from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from typing import Callable, Collection, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 from coordgen import Span
 
 from common.data import Sentence, Tree
@@ -47,6 +50,191 @@ class RandomConstituentSelector(SpanSelector):
         return spans
 
 
+class ConstituentSpanIndex:
+    # NOTE: the candidate spans of `RandomConstituentSelector` for a corpus, keyed by sentence hash
+    def __init__(
+        self,
+        labels: List[str],
+        keys: np.ndarray,
+        offsets: np.ndarray,
+        span_labels: np.ndarray,
+        span_starts: np.ndarray,
+        span_ends: np.ndarray,
+    ):
+        self.labels = labels
+        self.keys = keys
+        self.offsets = offsets
+        self.span_labels = span_labels
+        self.span_starts = span_starts
+        self.span_ends = span_ends
+        # NOTE: duplicate sentences, and sentences whose 64-bit hashes collide, resolve to the
+        # first of their rows
+        self._rows = {int(key): row for row, key in reversed(list(enumerate(keys)))}
+
+    @classmethod
+    def build(
+        cls,
+        sentences: Iterable[Sentence],
+        exclude_root: bool = False,
+        filter: Optional[Callable[[Tree, Tuple[int, int]], bool]] = None,
+    ) -> "ConstituentSpanIndex":
+        label_ids: Dict[str, int] = {}
+        keys, offsets = [], [0]
+        span_labels, span_starts, span_ends = [], [], []
+        for sentence in sentences:
+            if not sentence.tree:
+                raise ValueError("sentence must have a parse tree")
+            tokens = list(sentence.tree.leaves())
+            positions = list(to_char_positions(tokens, sentence.raw))
+            for node, (start, end) in sentence.tree.traverse():
+                if exclude_root and end - start == len(tokens):
+                    continue
+                if filter and not filter(node, (start, end)):
+                    continue
+                span_labels.append(label_ids.setdefault(node.label, len(label_ids)))
+                span_starts.append(positions[start][0])
+                span_ends.append(positions[end - 1][1])
+            keys.append(_hash(sentence.raw))
+            offsets.append(len(span_labels))
+        return cls(
+            list(label_ids),
+            np.array(keys, dtype=np.int64),
+            np.array(offsets, dtype=np.int64),
+            np.array(span_labels, dtype=np.int32),
+            np.array(span_starts, dtype=np.int32),
+            np.array(span_ends, dtype=np.int32),
+        )
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, raw: str) -> bool:
+        return _hash(raw) in self._rows
+
+    def row(self, raw: str) -> int:
+        return self._rows[_hash(raw)]
+
+    def spans(self, row: int, labels: Optional[Collection[str]] = None) -> List[Tuple[str, Span]]:
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return [
+            (self.labels[label], (int(s), int(e)))
+            for label, s, e in zip(
+                self.span_labels[start:end], self.span_starts[start:end], self.span_ends[start:end]
+            )
+            if labels is None or self.labels[label] in labels
+        ]
+
+    def sample(
+        self,
+        row: int,
+        num: int = 1,
+        replace: bool = False,
+        labels: Optional[Collection[str]] = None,
+        rng: Optional[random.Random] = None,
+    ) -> List[Span]:
+        # NOTE: `rng` defaults to the global state of `random`, as in `RandomConstituentSelector`
+        sampler = rng or random
+        spans = [span for _, span in self.spans(row, labels)]
+        if not spans:
+            return spans
+        if replace:
+            return sampler.choices(spans, k=num)
+        return sampler.sample(spans, min(num, len(spans)))
+
+    def sample_all(
+        self,
+        num: int = 1,
+        replace: bool = False,
+        labels: Optional[Collection[str]] = None,
+        seed: Optional[int] = None,
+    ) -> Iterator[Tuple[int, List[Span]]]:
+        # Draws spans for every sentence at once (e.g., for an epoch of augmentation), yielding
+        # the row of each sentence and its spans.
+        rng = np.random.default_rng(seed)
+        sizes = np.diff(self.offsets)
+        segments = np.repeat(np.arange(len(self)), sizes)
+        valid = np.ones(len(segments), dtype=bool)
+        if labels is not None:
+            label_ids = [i for i, label in enumerate(self.labels) if label in labels]
+            valid = np.isin(self.span_labels, label_ids)
+
+        if replace:
+            counts = np.bincount(segments[valid], minlength=len(self))
+            candidates = np.flatnonzero(valid)
+            starts = np.cumsum(counts) - counts
+            picks = starts[:, None] + (rng.random((len(self), num)) * counts[:, None]).astype(int)
+            for row in range(len(self)):
+                indices = candidates[picks[row]] if counts[row] else []
+                yield row, [self._span(i) for i in indices]
+            return
+
+        # order the candidates of each sentence by random keys and take the first `num`
+        order = np.lexsort((rng.random(len(segments)), segments))
+        order = order[valid[order]]
+        first = np.searchsorted(segments[order], np.arange(len(self) + 1))
+        for row in range(len(self)):
+            yield row, [
+                self._span(i) for i in order[first[row] : min(first[row + 1], first[row] + num)]
+            ]
+
+    def _span(self, i: int) -> Span:
+        return int(self.span_starts[i]), int(self.span_ends[i])
+
+    def save(self, path: Union[str, os.PathLike]) -> None:
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                labels=np.array(self.labels, dtype=str),
+                keys=self.keys,
+                offsets=self.offsets,
+                span_labels=self.span_labels,
+                span_starts=self.span_starts,
+                span_ends=self.span_ends,
+            )
+
+    @classmethod
+    def load(cls, path: Union[str, os.PathLike]) -> "ConstituentSpanIndex":
+        with np.load(path) as data:
+            return cls(
+                data["labels"].tolist(),
+                data["keys"],
+                data["offsets"],
+                data["span_labels"],
+                data["span_starts"],
+                data["span_ends"],
+            )
+
+
+class IndexedConstituentSelector(SpanSelector):
+    def __init__(
+        self,
+        index: ConstituentSpanIndex,
+        replace: bool = False,
+        labels: Optional[Collection[str]] = None,
+        fallback: Optional[SpanSelector] = None,
+    ):
+        # NOTE: `fallback` selects the spans of the sentences missing from `index`, which are
+        # otherwise rejected
+        self.index = index
+        self.replace = replace
+        self.labels = labels
+        self.fallback = fallback
+
+    def __call__(self, sentence: Sentence, num: int = 1) -> List[Span]:
+        try:
+            row = self.index.row(sentence.raw)
+        except KeyError:
+            if self.fallback is None:
+                raise ValueError(f"sentence not in the span index: {sentence.raw!r}") from None
+            return self.fallback(sentence, num)
+        return self.index.sample(row, num, self.replace, self.labels)
+
+
+def _hash(raw: str) -> int:
+    digest = hashlib.blake2b(raw.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
 def to_char_positions(tokens: Iterable[str], raw: str) -> Iterator[Span]:
     offset = 0
     for token in tokens:
@@ -0,0 +1,262 @@
+import json
+import os
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from common.data import _B_CLOSE, _B_OPEN, _TOKEN_RE, _TREE_UNESCAPE, _parse_error
+
+_ARRAYS = {
+    # name: typecode
+    "tree_offsets": "q",  # [num_trees + 1] range of the nodes of each tree
+    "leaf_offsets": "q",  # [num_trees + 1] range of the leaves of each tree
+    "node_label": "i",  # [num_nodes] label id
+    "node_start": "i",  # [num_nodes] first leaf (relative to the tree)
+    "node_end": "i",  # [num_nodes] last leaf + 1 (relative to the tree)
+    "node_preterminal": "b",  # [num_nodes]
+    "leaf_word": "i",  # [num_leaves] word id
+}
+_VOCAB_FILE = "vocab.json"
+
+
+class TreeStore:
+    # NOTE: trees in flat arrays, with the nodes in post-order and the labels and words interned
+    def __init__(self, labels: List[str], words: List[str], arrays: Dict[str, Sequence[int]]):
+        self.labels = labels
+        self.words = words
+        for name in _ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self) -> int:
+        return len(self.tree_offsets) - 1
+
+    def __getitem__(self, index: int) -> "CompactTree":
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return CompactTree(self, index)
+
+    def __iter__(self) -> Iterator["CompactTree"]:
+        return (CompactTree(self, i) for i in range(len(self)))
+
+    def save(self, path: Union[str, os.PathLike]) -> None:
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), np.asarray(getattr(self, name)))
+        with open(os.path.join(path, _VOCAB_FILE), "w") as f:
+            json.dump({"labels": self.labels, "words": self.words}, f)
+
+    @classmethod
+    def load(cls, path: Union[str, os.PathLike], mmap: bool = True) -> "TreeStore":
+        with open(os.path.join(path, _VOCAB_FILE)) as f:
+            vocab = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            for name in _ARRAYS
+        }
+        return cls(vocab["labels"], vocab["words"], arrays)
+
+
+class CompactTree:
+    # NOTE: a read-only view of a tree in a `TreeStore`, with the parts of `Tree` used for spans
+    __slots__ = ("store", "index")
+
+    def __init__(self, store: TreeStore, index: int):
+        self.store = store
+        self.index = index
+
+    @property
+    def label(self) -> str:
+        return self.root.label
+
+    @property
+    def root(self) -> "CompactNode":
+        return CompactNode(self, int(self.store.tree_offsets[self.index + 1]) - 1)
+
+    def __len__(self) -> int:
+        # NOTE: the number of leaves, unlike `len(Tree)`
+        store = self.store
+        return int(store.leaf_offsets[self.index + 1] - store.leaf_offsets[self.index])
+
+    def leaves(self) -> Iterator[str]:
+        store = self.store
+        start, end = int(store.leaf_offsets[self.index]), int(store.leaf_offsets[self.index + 1])
+        words = store.words
+        return (words[i] for i in store.leaf_word[start:end])
+
+    def traverse(self) -> Iterator[Tuple["CompactNode", Tuple[int, int]]]:
+        store = self.store
+        start, end = int(store.tree_offsets[self.index]), int(store.tree_offsets[self.index + 1])
+        for i in range(start, end):
+            yield CompactNode(self, i), (int(store.node_start[i]), int(store.node_end[i]))
+
+    def spans(self) -> Iterator[Tuple[str, Tuple[int, int]]]:
+        # Yields the label and the leaf span of each node, without creating node objects.
+        store = self.store
+        start, end = int(store.tree_offsets[self.index]), int(store.tree_offsets[self.index + 1])
+        labels = store.labels
+        for label, s, e in zip(
+            store.node_label[start:end], store.node_start[start:end], store.node_end[start:end]
+        ):
+            yield labels[label], (int(s), int(e))
+
+
+class CompactNode:
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree: CompactTree, index: int):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def label(self) -> str:
+        store = self.tree.store
+        return store.labels[store.node_label[self.index]]
+
+    @property
+    def is_preterminal(self) -> bool:
+        return bool(self.tree.store.node_preterminal[self.index])
+
+    def leaves(self) -> Iterator[str]:
+        store = self.tree.store
+        offset = int(store.leaf_offsets[self.tree.index])
+        start, end = int(store.node_start[self.index]), int(store.node_end[self.index])
+        words = store.words
+        return (words[i] for i in store.leaf_word[offset + start : offset + end])
+
+
+class TreeStoreBuilder:
+    def __init__(self):
+        self._label_ids: Dict[str, int] = {}
+        self._word_ids: Dict[str, int] = {}
+        self._labels: List[str] = []
+        self._words: List[str] = []
+        self.reset()
+
+    def reset(self) -> None:
+        # NOTE: starts a new store with the same labels and words; the stores built so far keep
+        # their arrays
+        self._arrays = {name: array(typecode) for name, typecode in _ARRAYS.items()}
+        self._arrays["tree_offsets"].append(0)
+        self._arrays["leaf_offsets"].append(0)
+        self.store = TreeStore(self._labels, self._words, self._arrays)
+
+    def label_id(self, label: str) -> int:
+        i = self._label_ids.get(label)
+        if i is None:
+            i = self._label_ids[label] = len(self.store.labels)
+            self.store.labels.append(label)
+        return i
+
+    def word_id(self, word: str) -> int:
+        i = self._word_ids.get(word)
+        if i is None:
+            i = self._word_ids[word] = len(self.store.words)
+            self.store.words.append(word)
+        return i
+
+    def build(self) -> TreeStore:
+        # NOTE: the returned store shares memory with the builder, which can no longer grow
+        arrays = {name: np.frombuffer(a, dtype=a.typecode) for name, a in self._arrays.items()}
+        return TreeStore(self.store.labels, self.store.words, arrays)
+
+
+def _columns(
+    builder: TreeStoreBuilder,
+) -> Tuple[Dict[str, array], array, array, array, array, array]:
+    a = builder._arrays
+    return (
+        a,
+        a["node_label"],
+        a["node_start"],
+        a["node_end"],
+        a["node_preterminal"],
+        a["leaf_word"],
+    )
+
+
+def parse_compact_trees(
+    text: Union[Iterable[str], str], builder: Optional[TreeStoreBuilder] = None
+) -> Iterator[CompactTree]:
+    # NOTE: the trees go to the store of `builder`, or each to its own store over one vocabulary
+    shared = builder is not None
+    if builder is None:
+        builder = TreeStoreBuilder()
+    a, node_label, node_start, node_end, node_preterminal, leaf_word = _columns(builder)
+
+    # each entry: [label id, first leaf, number of child nodes, number of terminals]
+    stack: List[List[int]] = []
+    context: List[str] = []
+    leaf_base = len(leaf_word)
+    iter_idx = -1
+    for s in [text] if isinstance(text, str) else text:
+        iter_idx += 1
+        context.append(s)
+        for match in _TOKEN_RE.finditer(s):
+            token = match.group()
+            if token[0] == _B_OPEN:
+                label = token[1:].lstrip()
+                if not label and stack:
+                    _parse_error(iter_idx, context, match, "<label>")
+                stack.append([builder.label_id(label), len(leaf_word) - leaf_base, 0, 0])
+            elif token == _B_CLOSE:
+                if not stack:
+                    _parse_error(iter_idx, context, match, _B_OPEN)
+                label_id, start, num_nodes, num_terminals = stack.pop()
+                if num_nodes + num_terminals == 0:
+                    _parse_error(iter_idx, context, match, "<children>")
+                elif num_terminals and num_nodes + num_terminals > 1:
+                    _parse_error(iter_idx, context, match, "<single-terminal>")
+                node_label.append(label_id)
+                node_start.append(start)
+                node_end.append(len(leaf_word) - leaf_base)
+                node_preterminal.append(num_terminals)
+                if stack:
+                    stack[-1][2] += 1
+                    continue
+                a["tree_offsets"].append(len(node_label))
+                a["leaf_offsets"].append(len(leaf_word))
+                context = context[-2:]  # keep at most 2 items
+                yield CompactTree(builder.store, len(builder.store) - 1)
+                if not shared:
+                    # NOTE: the yielded tree keeps the arrays of its own store alive
+                    builder.reset()
+                    a, node_label, node_start, node_end, node_preterminal, leaf_word = _columns(
+                        builder
+                    )
+                leaf_base = len(leaf_word)
+            else:
+                if not stack:
+                    _parse_error(iter_idx, context, match, _B_OPEN)
+                leaf_word.append(builder.word_id(_TREE_UNESCAPE.get(token, token)))
+                stack[-1][3] += 1
+
+    if stack:
+        _parse_error(iter_idx, context, None, _B_CLOSE)
+
+
+def load_treebank(
+    input_file: Union[str, os.PathLike], cache_dir: Optional[Union[str, os.PathLike]] = None
+) -> TreeStore:
+    # NOTE: with `cache_dir`, the store is saved and memory-mapped until `input_file` changes
+    stat = os.stat(input_file)
+    key = {"path": os.path.abspath(input_file), "size": stat.st_size, "mtime": stat.st_mtime}
+    if cache_dir is not None:
+        try:
+            with open(os.path.join(cache_dir, "source.json")) as f:
+                if json.load(f) == key:
+                    return TreeStore.load(cache_dir)
+        except (OSError, ValueError):
+            pass
+
+    builder = TreeStoreBuilder()
+    with open(input_file) as f:
+        for _ in parse_compact_trees(f, builder):
+            pass
+    store = builder.build()
+
+    if cache_dir is not None:
+        store.save(cache_dir)
+        with open(os.path.join(cache_dir, "source.json"), "w") as f:
+            json.dump(key, f)
+    return store
@@ -1,67 +1,291 @@
+import json
+import os
 import random
+from collections import deque
 from os import PathLike
-from typing import Optional, Set, Tuple, Union
+from typing import Deque, Iterable, Iterator, Optional, Set, Tuple, Union
 
 import torch
-from coordgen.models import AutoModelForCoordinationGeneration
+from coordgen import Coord, CoordinationGenerator
+from coordgen.models import AutoModelForCoordinationGeneration, ContinuousBatchingEngine
 
-from common.data import Sentence, Tree, parse_trees
-from common.selectors import RandomConstituentSelector
+from common.data import Sentence, Tree
+from common.selectors import (
+    ConstituentSpanIndex,
+    IndexedConstituentSelector,
+    RandomConstituentSelector,
+    SpanSelector,
+)
+from common.treebank import CompactTree, load_treebank, parse_compact_trees
+
+CC_TOKENS = {"and", "or", "but", "nor", "and/or"}
+TARGET_LABELS = {"NP", "VP", "ADJP", "ADVP", "PP", "S", "SBAR"}
+STOP_WORDS: Set[str] = set()
+MIN_SENTENCE_LENGTH = 10
+
+
+def _filter(node: Tree, span: Tuple[int, int]) -> bool:
+    if node.label not in TARGET_LABELS:
+        return False
+    if node.is_preterminal and next(node.leaves()).lower() in STOP_WORDS:
+        return False
+    return True
+
+
+def iter_trees(
+    input_file: Union[str, PathLike], tree_cache_dir: Optional[Union[str, PathLike]] = None
+) -> Iterator[CompactTree]:
+    # NOTE: without `tree_cache_dir`, trees are parsed as they are consumed
+    if tree_cache_dir is not None:
+        yield from load_treebank(input_file, tree_cache_dir)
+        return
+    with open(input_file) as f:
+        yield from parse_compact_trees(f)
+
+
+def iter_sentences(
+    input_file: Union[str, PathLike], tree_cache_dir: Optional[Union[str, PathLike]] = None
+) -> Iterator[Tuple[int, Sentence]]:
+    for offset, tree in enumerate(iter_trees(input_file, tree_cache_dir)):
+        tokens = list(tree.leaves())
+        if len(tokens) < MIN_SENTENCE_LENGTH:
+            continue
+        if any(token.lower() in CC_TOKENS for token in tokens):
+            continue
+        yield offset, Sentence(" ".join(tokens), tree)  # type: ignore
+
+
+def make_selector(
+    input_file: Union[str, PathLike],
+    tree_cache_dir: Optional[Union[str, PathLike]] = None,
+    span_index: Optional[Union[str, PathLike]] = None,
+) -> SpanSelector:
+    # NOTE: with `span_index`, the candidate spans are indexed once and saved to that path
+    if span_index is None:
+        return RandomConstituentSelector(exclude_root=False, filter=_filter)
+    if os.path.exists(span_index):
+        index = ConstituentSpanIndex.load(span_index)
+    else:
+        sentences = (s for _, s in iter_sentences(input_file, tree_cache_dir))
+        index = ConstituentSpanIndex.build(sentences, exclude_root=False, filter=_filter)
+        index.save(span_index)
+    # NOTE: a saved index may predate changes to `input_file`
+    fallback = RandomConstituentSelector(exclude_root=False, filter=_filter)
+    return IndexedConstituentSelector(index, fallback=fallback)
 
 
 def generate(
-    input_file: Union[str, bytes, PathLike],
+    input_file: Union[str, PathLike],
     model_name_or_path: str,
     num_spans: int = 1,
     batch_size: int = 20,
     cuda: bool = False,
     seed: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    max_in_flight: int = 1,
+    tree_cache_dir: Optional[Union[str, PathLike]] = None,
+    span_index: Optional[Union[str, PathLike]] = None,
+    continuous_batching: bool = False,
+    pipeline_workers: int = 0,
 ):
-    CC_TOKENS = {"and", "or", "but", "nor", "and/or"}
-    TARGET_LABELS = {"NP", "VP", "ADJP", "ADVP", "PP", "S", "SBAR"}
-    STOP_WORDS: Set[str] = set()
-    MIN_SENTENCE_LENGTH = 10
-
-    def _filter(node: Tree, span: Tuple[int, int]) -> bool:
-        if node.label not in TARGET_LABELS:
-            return False
-        if node.is_preterminal and next(node.leaves()).lower() in STOP_WORDS:
-            return False
-        return True
-
     if seed is not None:
         random.seed(seed)
 
-    sentences = []
-    with open(input_file) as f:
-        for tree in parse_trees(f):
-            tokens = list(tree.leaves())
-            if len(tokens) < MIN_SENTENCE_LENGTH:
-                continue
-            if any(token.lower() in CC_TOKENS for token in tokens):
-                continue
-            sentences.append(Sentence(" ".join(tokens), tree))
-
     model = AutoModelForCoordinationGeneration.from_pretrained(
         model_name_or_path, device=torch.device("cuda" if cuda else "cpu")
     )
-    selector = RandomConstituentSelector(exclude_root=False, filter=_filter)
+    selector = make_selector(input_file, tree_cache_dir, span_index)
 
-    inputs = [(s, span) for s in sentences for span in selector(s, num_spans)]
-    for offset in range(0, len(inputs), batch_size):
-        batch = inputs[offset : offset + batch_size]
-        results = model.generate((s.raw, span) for s, span in batch)
-        for raw, coord in results:
-            pre, post = coord.conjuncts
-            print(
-                "{}[{}]{}[{}]{}".format(
-                    raw[: pre[0]],
-                    raw[pre[0] : pre[1]],
-                    raw[pre[1] : post[0]],
-                    raw[post[0] : post[1]],
-                    raw[post[1] :],
-                )
+    inputs = (
+        (s.raw, span)
+        for _, s in iter_sentences(input_file, tree_cache_dir)
+        for span in selector(s, num_spans)
+    )
+    results = _iter_results(
+        model, inputs, batch_size, max_tokens, max_in_flight, continuous_batching, pipeline_workers
+    )
+    for raw, coord in results:
+        pre, post = coord.conjuncts
+        print(
+            "{}[{}]{}[{}]{}".format(
+                raw[: pre[0]],
+                raw[pre[0] : pre[1]],
+                raw[pre[1] : post[0]],
+                raw[post[0] : post[1]],
+                raw[post[1] :],
             )
+        )
+
+
+def generate_sharded(
+    input_file: Union[str, PathLike],
+    output_dir: Union[str, PathLike],
+    model_name_or_path: str,
+    num_spans: int = 1,
+    batch_size: int = 20,
+    cuda: bool = False,
+    seed: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    max_in_flight: int = 1,
+    num_workers: int = 1,
+    num_threads: Optional[int] = None,
+    tree_cache_dir: Optional[Union[str, PathLike]] = None,
+    span_index: Optional[Union[str, PathLike]] = None,
+    continuous_batching: bool = False,
+    pipeline_workers: int = 0,
+):
+    # NOTE: the tree at `offset` is handled by the worker of rank `offset % num_workers`, and
+    # spans are drawn with a per-tree seed, so outputs do not depend on how a run was resumed.
+    os.makedirs(output_dir, exist_ok=True)
+    args = (
+        input_file,
+        output_dir,
+        model_name_or_path,
+        num_spans,
+        batch_size,
+        cuda,
+        seed,
+        max_tokens,
+        max_in_flight,
+        num_workers,
+        num_threads,
+        tree_cache_dir,
+        span_index,
+        continuous_batching,
+        pipeline_workers,
+    )
+    if num_workers == 1:
+        _run_shard(0, *args)
+        return
+
+    if tree_cache_dir is not None:
+        # NOTE: build the cache once so that the workers only memory-map it
+        load_treebank(input_file, tree_cache_dir)
+    if span_index is not None:
+        make_selector(input_file, tree_cache_dir, span_index)
+
+    ctx = torch.multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=_run_shard, args=(rank, *args)) for rank in range(num_workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    failed = [rank for rank, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"workers {failed} failed; rerun the same command to resume")
+
+
+def _run_shard(
+    rank: int,
+    input_file: Union[str, PathLike],
+    output_dir: Union[str, PathLike],
+    model_name_or_path: str,
+    num_spans: int,
+    batch_size: int,
+    cuda: bool,
+    seed: Optional[int],
+    max_tokens: Optional[int],
+    max_in_flight: int,
+    num_workers: int,
+    num_threads: Optional[int],
+    tree_cache_dir: Optional[Union[str, PathLike]],
+    span_index: Optional[Union[str, PathLike]],
+    continuous_batching: bool,
+    pipeline_workers: int,
+):
+    path = os.path.join(output_dir, f"shard-{rank:05d}-of-{num_workers:05d}.jsonl")
+    if os.path.exists(path + ".done"):
+        return
+    start = _recover_shard(path)
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    device = torch.device("cpu")
+    if cuda:
+        device = torch.device("cuda", rank % torch.cuda.device_count())
+    model = AutoModelForCoordinationGeneration.from_pretrained(model_name_or_path, device=device)
+    selector = make_selector(input_file, tree_cache_dir, span_index)
+
+    pending: Deque[Tuple[int, str, Tuple[int, int]]] = deque()
+
+    def _inputs():
+        for offset, sentence in iter_sentences(input_file, tree_cache_dir):
+            if offset % num_workers != rank or offset < start:
+                continue
+            if seed is not None:
+                random.seed(f"{seed}:{offset}")
+            for span in selector(sentence, num_spans):
+                pending.append((offset, sentence.raw, span))
+                yield sentence.raw, span
+
+    results = _iter_results(
+        model,
+        _inputs(),
+        batch_size,
+        max_tokens,
+        max_in_flight,
+        continuous_batching,
+        pipeline_workers,
+    )
+    with open(path, "a", buffering=1) as f:
+        for raw, coord in results:
+            offset, source, span = pending.popleft()
+            record = {
+                "offset": offset,
+                "source": source,
+                "span": span,
+                "text": raw,
+                "cc": coord.cc,
+                "conjuncts": coord.conjuncts,
+            }
+            f.write(json.dumps(record) + "\n")
+    open(path + ".done", "w").close()
+
+
+def _iter_results(
+    model: CoordinationGenerator,
+    inputs: Iterable[Tuple[str, Tuple[int, int]]],
+    batch_size: int,
+    max_tokens: Optional[int],
+    max_in_flight: int,
+    continuous_batching: bool,
+    pipeline_workers: int,
+) -> Iterator[Tuple[str, Coord]]:
+    if not continuous_batching:
+        yield from model.generate_iter(
+            inputs,
+            batch_size,
+            max_tokens=max_tokens,
+            max_in_flight=max_in_flight,
+            num_workers=pipeline_workers,
+        )
+        return
+    # NOTE: up to `batch_size` inputs are decoded at once and a finished input is replaced at the
+    # next step; `max_tokens` does not apply.
+    with ContinuousBatchingEngine(model, batch_size) as engine:
+        yield from engine.generate_iter(inputs, (max_in_flight + 1) * batch_size)
+
+
+def _recover_shard(path: str) -> int:
+    # Returns the offset to resume from. The records of the last tree in the shard may be
+    # incomplete after a crash, so they are truncated and the tree is generated again.
+    if not os.path.exists(path):
+        return 0
+    last_offset, last_pos, pos = -1, 0, 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                offset = json.loads(line)["offset"]
+            except (ValueError, KeyError):
+                break
+            if offset != last_offset:
+                last_offset, last_pos = offset, pos
+            pos += len(line)
+    if last_offset < 0:
+        last_pos = 0
+    with open(path, "r+b") as f:
+        f.truncate(last_pos)
+    return max(last_offset, 0)
 
 
 if __name__ == "__main__":
@@ -74,12 +298,46 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", type=int, default=20)
     parser.add_argument("--cuda", action="store_true")
     parser.add_argument("--seed", type=int)
+    parser.add_argument("--max_tokens", type=int)
+    parser.add_argument("--max_in_flight", type=int, default=1)
+    parser.add_argument("--output_dir")
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--num_threads", type=int)
+    parser.add_argument("--tree_cache_dir")
+    parser.add_argument("--span_index")
+    parser.add_argument("--continuous_batching", action="store_true")
+    parser.add_argument("--pipeline_workers", type=int, default=0)
     args = parser.parse_args()
-    generate(
-        args.input_file,
-        args.model,
-        args.num,
-        args.batch_size,
-        args.cuda,
-        args.seed,
-    )
+    if args.output_dir is None:
+        generate(
+            args.input_file,
+            args.model,
+            args.num,
+            args.batch_size,
+            args.cuda,
+            args.seed,
+            args.max_tokens,
+            args.max_in_flight,
+            args.tree_cache_dir,
+            args.span_index,
+            args.continuous_batching,
+            args.pipeline_workers,
+        )
+    else:
+        generate_sharded(
+            args.input_file,
+            args.output_dir,
+            args.model,
+            args.num,
+            args.batch_size,
+            args.cuda,
+            args.seed,
+            args.max_tokens,
+            args.max_in_flight,
+            args.num_workers,
+            args.num_threads,
+            args.tree_cache_dir,
+            args.span_index,
+            args.continuous_batching,
+            args.pipeline_workers,
+        )
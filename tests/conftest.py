@@ -0,0 +1,124 @@
+import pytest
+import torch
+import transformers
+
+BERT_WORDS = (
+    "gold will retain its gain he said the market rose sharply prices of stocks , .".split()
+)
+
+T5_WORDS = [f"w{i}" for i in range(40)] + ["and", "or", ",", "."]
+
+
+def save_tiny_bert(path):
+    # NOTE: a tiny BERT checkpoint saved with its tokenizer, shared with the demo backend tests
+    vocab_file = path / "vocab.txt"
+    vocab_file.write_text(
+        "\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "and", "or"] + BERT_WORDS)
+    )
+    transformers.BertTokenizerFast(str(vocab_file)).save_pretrained(path)
+    torch.manual_seed(0)
+    config = transformers.BertConfig(
+        vocab_size=len(BERT_WORDS) + 7,
+        hidden_size=16,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=32,
+    )
+    transformers.BertForMaskedLM(config).save_pretrained(path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def bert_path(tmp_path_factory):
+    return save_tiny_bert(tmp_path_factory.mktemp("bert"))
+
+
+@pytest.fixture(scope="module")
+def bert_model_and_tokenizer(bert_path):
+    # NOTE: special tokens are registered when the tokenizer is saved and loaded back
+    tokenizer = transformers.AutoTokenizer.from_pretrained(bert_path)
+    return transformers.BertForMaskedLM.from_pretrained(bert_path), tokenizer
+
+
+def _t5_config(vocab_size):
+    return transformers.T5Config(
+        vocab_size=vocab_size,
+        d_model=16,
+        d_ff=32,
+        d_kv=4,
+        num_layers=2,
+        num_heads=4,
+        decoder_start_token_id=0,
+        pad_token_id=0,
+        eos_token_id=1,
+    )
+
+
+@pytest.fixture()
+def tiny_t5():
+    from coordgen.models.modeling_t5 import T5ForConditionalGeneration
+
+    torch.manual_seed(0)
+    return T5ForConditionalGeneration(_t5_config(64)).eval()
+
+
+def _t5_tokenizer():
+    # NOTE: a word-level T5 tokenizer over `T5_WORDS`, with the sentinels of a conjunct
+    from tokenizers import Tokenizer, models, pre_tokenizers
+
+    special = ["<pad>", "</s>", "<unk>", "<extra_id_0>", "<extra_id_1>"]
+    vocab = {w: i for i, w in enumerate(special + T5_WORDS)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, "<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.add_special_tokens(special)
+    return transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        additional_special_tokens=special[3:],
+        model_max_length=12,
+    )
+
+
+@pytest.fixture(scope="session")
+def t5_tokenizer():
+    return _t5_tokenizer()
+
+
+def save_tiny_t5(path):
+    # NOTE: a tiny T5 checkpoint saved with `_t5_tokenizer`, for the demo backend tests
+    from coordgen.models.modeling_t5 import T5ForConditionalGeneration
+
+    tokenizer = _t5_tokenizer()
+    tokenizer.save_pretrained(path)
+    torch.manual_seed(0)
+    T5ForConditionalGeneration(_t5_config(len(tokenizer))).save_pretrained(path)
+    return path
+
+
+@pytest.fixture()
+def tiny_t5_generator(t5_tokenizer):
+    # NOTE: returns a factory, as the generators of a test differ in their decoding arguments
+    from coordgen.models import T5ForCoordinationGeneration
+    from coordgen.models.modeling_t5 import T5ForConditionalGeneration
+
+    def _create(**kwargs):
+        torch.manual_seed(0)
+        model = T5ForConditionalGeneration(_t5_config(len(t5_tokenizer)))
+        return T5ForCoordinationGeneration(model, t5_tokenizer, **kwargs)
+
+    return _create
+
+
+@pytest.fixture()
+def decoding_kwargs():
+    # NOTE: the search arguments for `tiny_t5`, with 2 and 3 as the sentinel tokens of a conjunct
+    return dict(
+        min_length=3,
+        max_length=12,
+        eos_token_id=3,
+        forced_bos_token_id=2,
+        forced_eos_token_id=3,
+        bad_token_ids={1},
+    )
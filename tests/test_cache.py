@@ -0,0 +1,104 @@
+from coordgen import CachedGenerator, Coord, CoordinationGenerator, ResultCache
+
+
+class _CountingGenerator(CoordinationGenerator):
+    def __init__(self):
+        self.num_inputs = 0
+
+    def generate(self, inputs, coordinators=None):
+        inputs = list(inputs)
+        self.num_inputs += len(inputs)
+        if coordinators is None:
+            coordinators = [""] * len(inputs)
+        return [
+            (raw.upper() + cc, Coord(cc=span, conjuncts=[span, span]))
+            for (raw, span), cc in zip(inputs, coordinators)
+        ]
+
+
+def test_cached_generator():
+    generator = _CountingGenerator()
+    model = CachedGenerator(generator, ResultCache(maxsize=2))
+    outputs = model.generate([("a", (0, 1)), ("b", (0, 1)), ("a", (0, 1))])
+    assert [raw for raw, _ in outputs] == ["A", "B", "A"]
+    assert generator.num_inputs == 2
+
+    outputs[0][1].conjuncts.append((1, 1))
+    assert model.generate([("a", (0, 1))])[0][1].conjuncts == [(0, 1), (0, 1)]
+    assert generator.num_inputs == 2
+
+    model.generate([("c", (0, 1)), ("b", (0, 1))])  # evicts "a"
+    assert generator.num_inputs == 3
+    model.generate([("a", (0, 1))])
+    assert generator.num_inputs == 4
+    assert model.cache.info()["size"] == 2
+
+
+def test_cached_generator_coordinators():
+    generator = _CountingGenerator()
+    model = CachedGenerator(generator)
+    outputs = model.generate([("a", (0, 1)), ("a", (0, 1))], ["and", "or"])
+    assert [raw for raw, _ in outputs] == ["Aand", "Aor"]
+    outputs = model.generate_variants([("a", (0, 1))], [["or", "nor"]])
+    assert [raw for raw, _ in outputs[0]] == ["Aor", "Anor"]
+    assert generator.num_inputs == 3
+    assert model.cache.get(model.cache_key("a", (0, 1), "or"))[0] == "Aor"
+    assert model.cache.get(model.cache_key("a", (0, 1))) is None
+
+
+class _DefaultCoordinatorGenerator(_CountingGenerator):
+    def decoding_config(self):
+        return {"coordinator": "and"}
+
+    def generate(self, inputs, coordinators=None):
+        inputs = list(inputs)
+        return super().generate(inputs, coordinators or ["and"] * len(inputs))
+
+
+def test_cached_generator_default_coordinator():
+    generator = _DefaultCoordinatorGenerator()
+    model = CachedGenerator(generator)
+    assert model.generate([("a", (0, 1))])[0][0] == "Aand"
+    assert model.generate([("a", (0, 1))], ["and"])[0][0] == "Aand"
+    assert model.generate([("b", (0, 1))], ["and"])[0][0] == "Band"
+    assert model.generate([("b", (0, 1))])[0][0] == "Band"
+    assert generator.num_inputs == 2
+    assert model.cache_key("a", (0, 1)) == model.cache_key("a", (0, 1), "and")
+
+
+class _CandidateGenerator(_CountingGenerator):
+    def __init__(self):
+        super().__init__()
+        self.num_configs = 0
+
+    def generate_candidates(self, inputs, coordinators=None):
+        return [[output, (output[0].lower(), output[1])] for output in self.generate(inputs)]
+
+    def decoding_config(self):
+        self.num_configs += 1
+        return super().decoding_config()
+
+
+def test_cached_generator_candidates():
+    generator = _CandidateGenerator()
+    model = CachedGenerator(generator)
+    outputs = model.generate_candidates([("a", (0, 1)), ("b", (0, 1))])
+    assert [[raw for raw, _ in candidates] for candidates in outputs] == [["A", "a"], ["B", "b"]]
+    assert model.generate([("a", (0, 1))])[0][0] == "A"
+    assert generator.num_inputs == 2
+
+    results = list(model.generate_iter([("b", (0, 1)), ("c", (0, 1))], num_workers=1))
+    assert [raw for raw, _ in results] == ["B", "C"]
+    assert generator.num_inputs == 3
+    assert generator.num_configs == 1
+
+
+def test_result_cache_persistence(tmp_path):
+    path = tmp_path / "cache.pkl"
+    cache = ResultCache(maxsize=4, path=path)
+    cache.put("k", ("a", Coord(cc=(0, 1), conjuncts=[])))
+    cache.save()
+    cache = ResultCache(maxsize=4, path=path)
+    assert cache.get("k") == ("a", Coord(cc=(0, 1), conjuncts=[]))
+    assert cache.get("x") is None
+    assert (cache.hits, cache.misses) == (1, 1)
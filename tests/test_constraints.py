@@ -0,0 +1,78 @@
+import torch
+
+from coordgen.models.constraints import LogitsConstraints, TokenTrie
+from coordgen.models.generation_utils import SynchronizedBeamSearch, SynchronizedSampling
+
+
+def _segments(ids, trie):
+    # Splits `ids` into sequences of `trie` as `LogitsConstraints` does, or returns `None`
+    segments, node = [[]], trie.root
+    for token_id in ids:
+        if token_id not in node:
+            if -1 not in node or token_id not in trie.root:
+                return None
+            segments.append([])
+            node = trie.root
+        segments[-1].append(token_id)
+        node = node[token_id]
+    return segments if -1 in node else None
+
+
+def test_token_trie():
+    trie = TokenTrie([[5, 6], [5], [7, 8, 9], []])
+    assert [5] in trie and [5, 6] in trie and [7, 8] not in trie
+    assert sorted(trie.next_tokens(trie.root)) == [5, 7]
+    assert trie.depth() == 3
+
+
+def test_logits_constraints():
+    constraints = LogitsConstraints([0, 3], TokenTrie([[4], [5, 6]]), end_token_ids=[2], offset=1)
+    sequences = torch.tensor([[0, 5], [0, 7], [0, 7]])
+    scores = torch.zeros(3, 10)
+    other = torch.full((3, 10), -1.0)
+    allowed = [None, None, TokenTrie([[7, 8], [9]])]
+    out = constraints(sequences, scores, other, allowed)
+    assert out.data_ptr() == scores.data_ptr()
+    banned = out == -float("inf")
+    assert banned[:, [0, 3, 4]].all()
+    assert banned[0, 6] and not banned[1, 6]
+    assert (out[1] == -1.0).sum() == 10 - 3
+    assert (~banned[2]).nonzero().squeeze(-1).tolist() == [8]
+
+    # NOTE: left-padded sequences come with their lengths, and `offset` counts from their start
+    padded = torch.tensor([[9, 0, 5], [9, 0, 7], [9, 0, 7]])
+    scores = torch.zeros(3, 1, 10)
+    constraints(padded, scores, other.view(3, 1, 10), allowed, torch.tensor([2, 2, 2]))
+    assert torch.equal(scores.view(3, 10), out)
+    scores = torch.zeros(1, 10)
+    constraints(torch.tensor([[9, 5]]), scores, lengths=torch.tensor([1]))
+    assert not scores[0, 6].isinf()
+    constraints(torch.tensor([[9, 5]]), scores)
+    assert scores[0, 6].isinf()
+
+
+def test_constrained_search(tiny_t5, decoding_kwargs):
+    model = tiny_t5
+    input_ids = torch.randint(4, 64, (4, 7))
+    attention_mask = torch.ones_like(input_ids)
+    # NOTE: `bad_token_ids` are given to the constraints, which ban token 1 themselves
+    kwargs = {k: v for k, v in decoding_kwargs.items() if k != "bad_token_ids"}
+    forbidden = TokenTrie([[10], [11, 12]])
+    allowed = [TokenTrie([[10, 20], [21], [22, 23, 24]]), None]
+    constraints = LogitsConstraints([1], forbidden, end_token_ids=[3], offset=2)
+
+    beam_search = SynchronizedBeamSearch(model, num_beams=3, constraints=constraints, **kwargs)
+    sampling = SynchronizedSampling(
+        model, num_return_sequences=3, constraints=constraints, **kwargs
+    )
+    for search in [beam_search, sampling]:
+        for hyps, trie in zip(search.search(input_ids, attention_mask, allowed=allowed), allowed):
+            for ids, _ in hyps:
+                conjunct = ids[2:]
+                if conjunct and conjunct[-1] == 3:
+                    conjunct = conjunct[:-1]
+                assert 1 not in ids and 10 not in conjunct
+                assert all(conjunct[i : i + 2] != [11, 12] for i in range(len(conjunct)))
+                if trie is not None:
+                    # NOTE: hypotheses cut at the length cap may end inside a sequence
+                    assert _segments(conjunct, trie) is not None or len(ids) == 11
@@ -0,0 +1,96 @@
+import random
+import threading
+
+import pytest
+
+from coordgen import GenerationStats
+from coordgen.models import ContinuousBatchingEngine
+
+
+def _inputs(num, seed=0):
+    rng = random.Random(seed)
+    inputs = []
+    for _ in range(num):
+        tokens = [f"w{rng.randrange(40)}" for _ in range(rng.randint(3, 9))]
+        i = rng.randrange(len(tokens))
+        j = rng.randint(i + 1, min(i + 3, len(tokens)))
+        start = len(" ".join(tokens[:i] + [""]))
+        end = len(" ".join(tokens[:j]))
+        inputs.append((" ".join(tokens), (start, end)))
+    return inputs
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"num_beam": 1},
+        {"num_beam": 3},
+        {"num_beam": 2, "max_length_ratio": 1.0},
+        {"num_beam": 2, "conjunct_vocabulary": "sentence", "forbidden_words": ["and", "w3"]},
+    ],
+)
+def test_continuous_batching(kwargs, tiny_t5_generator):
+    model = tiny_t5_generator(**kwargs)
+    inputs = _inputs(7)
+    expected = [model.generate([x])[0] for x in inputs]
+    # NOTE: with 2 slots, inputs are admitted while others are being decoded
+    with ContinuousBatchingEngine(model, max_batch_size=2) as engine:
+        assert engine.generate(inputs) == expected
+        assert list(engine.generate_iter(inputs, max_pending=3)) == expected
+        future = engine.submit(*inputs[0], coordinator="or")
+        assert future.result() == model.generate([inputs[0]], ["or"])[0]
+        coordinators = ["or", "and"] * 3 + ["or"]
+        expected = model.generate(inputs, coordinators)
+        assert engine.generate(inputs, coordinators) == expected
+        assert list(engine.generate_iter(inputs, 3, iter(coordinators))) == expected
+        with pytest.raises(ValueError):
+            list(engine.generate_iter(inputs, coordinators=coordinators[:-1]))
+
+
+def test_continuous_batching_profile(tiny_t5_generator):
+    model = tiny_t5_generator()
+    records = []
+    model.add_profiling_hook(records.append)
+    with ContinuousBatchingEngine(model, max_batch_size=4) as engine:
+        engine.generate(_inputs(3))
+    assert records and all(isinstance(stats, GenerationStats) for stats in records)
+    assert sum(stats.num_inputs for stats in records) == 3
+    assert all(stats.num_steps == 1 for stats in records)
+
+
+def test_continuous_batching_invalid(tiny_t5_generator):
+    with pytest.raises(ValueError):
+        ContinuousBatchingEngine(tiny_t5_generator(do_sample=True))
+    with pytest.raises(ValueError):
+        ContinuousBatchingEngine(tiny_t5_generator(num_beam=4, num_beam_groups=2))
+    engine = ContinuousBatchingEngine(tiny_t5_generator())
+    engine.stop()
+    with pytest.raises(RuntimeError):
+        engine.submit("w1 and w2", (0, 2))
+
+
+def test_continuous_batching_stop(tiny_t5_generator):
+    model = tiny_t5_generator()
+    inputs = _inputs(40)
+    engine = ContinuousBatchingEngine(model, max_batch_size=2)
+    futures = []
+    errors = []
+
+    def _submit():
+        for x in inputs:
+            try:
+                futures.append(engine.submit(*x))
+            except RuntimeError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=_submit) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    engine.stop()
+    for thread in threads:
+        thread.join()
+    # NOTE: a request is either rejected or decoded before the worker exits
+    assert len(futures) + len(errors) == 3 * len(inputs)
+    assert all(future.done() for future in futures)
+    with pytest.raises(RuntimeError):
+        engine.submit(*inputs[0])
@@ -0,0 +1,47 @@
+import pytest
+import torch
+import transformers
+
+from coordgen.models.export import export_model
+from coordgen.models.generation_utils import SynchronizedBeamSearch
+from coordgen.models.runtime import ExportedModelForSeq2SeqLM
+
+
+@pytest.mark.parametrize("format", ["onnx", "torchscript"])
+def test_exported_model(tmp_path, format, tiny_t5, decoding_kwargs):
+    if format == "onnx":
+        pytest.importorskip("onnxruntime")
+    model = tiny_t5
+    vocab_file = tmp_path / "vocab.txt"
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]"]))
+    export_model(model, transformers.BertTokenizerFast(str(vocab_file)), tmp_path, format)
+    exported = ExportedModelForSeq2SeqLM.from_pretrained(tmp_path)
+
+    input_ids = torch.randint(2, 64, (6, 9))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 5:] = attention_mask[4, 3:] = 0
+    kwargs = dict(decoding_kwargs, num_beams=3, num_return_sequences=2, max_length=20)
+    expected = SynchronizedBeamSearch(model, **kwargs).search(input_ids, attention_mask)
+
+    outputs = SynchronizedBeamSearch(exported, **kwargs).search(input_ids, attention_mask)
+    for hyps, expected_hyps in zip(outputs, expected):
+        assert [ids for ids, _ in hyps] == [ids for ids, _ in expected_hyps]
+        for (_, score), (_, expected_score) in zip(hyps, expected_hyps):
+            assert abs(score - expected_score) < 1e-4
+
+    # NOTE: each step after the first decodes the last token over the key/value cache
+    encoder_outputs = exported.get_encoder()(input_ids, attention_mask)
+    decoder_input_ids = torch.zeros((6, 1), dtype=torch.long)
+    past_key_values = None
+    for _ in range(8):
+        outputs = exported(
+            encoder_outputs, attention_mask, decoder_input_ids[:, -1:], past_key_values
+        )
+        expected = model(
+            input_ids=input_ids, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids
+        )
+        assert torch.allclose(outputs.logits[:, -1], expected.logits[:, -1], atol=1e-5)
+        past_key_values = outputs.past_key_values
+        assert past_key_values[0][0].size(2) == decoder_input_ids.size(1)
+        next_ids = outputs.logits[:, -1].argmax(-1, keepdim=True)
+        decoder_input_ids = torch.cat([decoder_input_ids, next_ids], dim=-1)
@@ -0,0 +1,146 @@
+import torch
+
+from coordgen import GenerationStats
+from coordgen.models.generation_utils import (
+    EncoderCache,
+    SynchronizedBeamSearch,
+    SynchronizedSampling,
+)
+
+
+def test_synchronized_beam_search(tiny_t5, decoding_kwargs):
+    model = tiny_t5
+    input_ids = torch.randint(2, 64, (6, 7))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 5:] = attention_mask[4, 3:] = 0
+    kwargs = dict(decoding_kwargs, early_stopping=True)
+
+    for num_beams in [1, 3]:
+        expected = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            num_beams=num_beams,
+            synchronize=True,
+            **kwargs,
+        )
+        search = SynchronizedBeamSearch(model, num_beams=num_beams, **kwargs)
+        outputs = search(input_ids, attention_mask)
+        assert len(outputs) == 3
+        stats = GenerationStats(3)
+        assert search.search(input_ids, attention_mask, stats) == search.search(
+            input_ids, attention_mask
+        )
+        assert max(len(ids) for ids in outputs) - 1 <= stats.num_steps < kwargs["max_length"]
+        assert set(stats.stage_times) == {"encode", "model", "logits_processors"}
+        for ids, expected_ids in zip(outputs, expected[:3].tolist()):
+            assert ids == expected_ids[: len(ids)]
+            assert all(i in (0, 3) for i in expected_ids[len(ids) :])
+
+
+def test_synchronized_beam_search_candidates(tiny_t5, decoding_kwargs):
+    model = tiny_t5
+    input_ids = torch.randint(2, 64, (6, 7))
+    attention_mask = torch.ones_like(input_ids)
+    kwargs = dict(decoding_kwargs, early_stopping=True)
+
+    for num_beams, num_beam_groups in [(4, 1), (4, 2), (6, 3)]:
+        num_return_sequences = num_beams // 2
+        diversity_penalty = 1.0 if num_beam_groups > 1 else 0.0
+        expected = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            num_beams=num_beams,
+            num_beam_groups=num_beam_groups,
+            diversity_penalty=diversity_penalty,
+            num_return_sequences=num_return_sequences,
+            output_scores=True,
+            return_dict_in_generate=True,
+            synchronize=True,
+            **kwargs,
+        )
+        search = SynchronizedBeamSearch(
+            model,
+            num_beams=num_beams,
+            num_beam_groups=num_beam_groups,
+            diversity_penalty=diversity_penalty,
+            num_return_sequences=num_return_sequences,
+            **kwargs,
+        )
+        outputs = [hyp for hyps in search.search(input_ids, attention_mask) for hyp in hyps]
+        assert len(outputs) == 3 * num_return_sequences
+        for (ids, score), expected_ids, expected_score in zip(
+            outputs, expected.sequences.tolist(), expected.sequences_scores.tolist()
+        ):
+            assert ids == expected_ids[: len(ids)]
+            assert abs(score - expected_score) < 1e-4
+
+
+def test_synchronized_sampling(tiny_t5, decoding_kwargs):
+    model = tiny_t5
+    input_ids = torch.randint(2, 64, (6, 7))
+    attention_mask = torch.ones_like(input_ids)
+    kwargs = decoding_kwargs
+
+    # top-1 sampling is greedy search
+    greedy = SynchronizedBeamSearch(model, num_beams=1, **kwargs).search(input_ids, attention_mask)
+    sampling = SynchronizedSampling(model, num_return_sequences=2, top_k=1, **kwargs)
+    for hyps, expected in zip(sampling.search(input_ids, attention_mask), greedy):
+        assert len(hyps) == 2
+        for ids, score in hyps:
+            assert ids == expected[0][0]
+            assert abs(score - expected[0][1]) < 1e-4
+
+    sampling = SynchronizedSampling(model, num_return_sequences=4, temperature=2.0, **kwargs)
+    for hyps in sampling.search(input_ids, attention_mask):
+        scores = [score for _, score in hyps]
+        assert scores == sorted(scores, reverse=True)
+
+
+def test_encoder_cache(tiny_t5, decoding_kwargs):
+    model = tiny_t5
+    input_ids = torch.randint(2, 64, (6, 7))
+    input_ids[2] = input_ids[0]
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 5:] = attention_mask[4, 3:] = 0
+    kwargs = dict(decoding_kwargs, num_beams=2)
+    expected = SynchronizedBeamSearch(model, **kwargs)(input_ids, attention_mask)
+
+    cache = EncoderCache()
+    search = SynchronizedBeamSearch(model, encoder_cache=cache, **kwargs)
+    assert search(input_ids, attention_mask) == expected
+    assert (cache.hits, cache.misses, len(cache)) == (0, 6, 5)
+    # the same views padded differently
+    padded_ids = torch.cat([input_ids, torch.zeros_like(input_ids)], dim=1)
+    padded_mask = torch.cat([attention_mask, torch.zeros_like(attention_mask)], dim=1)
+    assert search(padded_ids, padded_mask) == expected
+    assert cache.hits == 6
+
+    cache = EncoderCache(max_bytes=2 * 7 * 16 * 4)
+    search = SynchronizedBeamSearch(model, encoder_cache=cache, **kwargs)
+    assert search(input_ids, attention_mask) == expected
+    assert cache.num_bytes <= cache.max_bytes and len(cache) == 2
+
+
+def test_max_lengths_and_compaction(tiny_t5, decoding_kwargs):
+    model = tiny_t5
+    input_ids = torch.randint(2, 64, (8, 7))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 5:] = 0
+    max_lengths = [4, 30, 6, 9]
+    kwargs = dict(decoding_kwargs, max_length=30)
+
+    for search_class, search_kwargs in [
+        (SynchronizedBeamSearch, dict(num_beams=4, num_beam_groups=2, diversity_penalty=0.5)),
+        (SynchronizedSampling, dict(num_return_sequences=2, top_k=1)),
+    ]:
+        search = search_class(model, **search_kwargs, **kwargs)
+        outputs = search.search(input_ids, attention_mask, max_lengths=max_lengths)
+        expected = search_class(model, compact=False, **search_kwargs, **kwargs).search(
+            input_ids, attention_mask, max_lengths=max_lengths
+        )
+        assert [[ids for ids, _ in hyps] for hyps in outputs] == [
+            [ids for ids, _ in hyps] for hyps in expected
+        ]
+        for hyps, max_length in zip(outputs, max_lengths):
+            # NOTE: the hypotheses exclude the final eos token
+            assert all(len(ids) < max_length for ids, _ in hyps)
@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from coordgen.models import AutoModelForCoordinationGeneration
+from coordgen.models.snapshot import save_snapshot
+
+
+@pytest.mark.parametrize(
+    "kwargs, precision",
+    [
+        ({}, "float32"),
+        ({"torch_dtype": torch.bfloat16}, "bfloat16"),
+        ({"quantization": "int8"}, "int8"),
+    ],
+)
+def test_from_pretrained_precision(bert_path, kwargs, precision):
+    model = AutoModelForCoordinationGeneration.from_pretrained(bert_path, **kwargs)
+    assert model.decoding_config()["precision"] == precision
+    raw, span = "gold will retain its gain , he said .", (10, 25)
+    text, coord = model.generate([(raw, span)])[0]
+    assert text[slice(*coord.conjuncts[0])] == raw[slice(*span)]
+
+
+def test_from_pretrained_invalid_options(bert_path):
+    with pytest.raises(ValueError):
+        AutoModelForCoordinationGeneration.from_pretrained(bert_path, quantization="int4")
+    with pytest.raises(ValueError):
+        AutoModelForCoordinationGeneration.from_pretrained(
+            bert_path, quantization="int8", torch_dtype=torch.bfloat16
+        )
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"quantization": "int8"}])
+def test_from_pretrained_snapshot(bert_path, tmp_path, kwargs):
+    model = AutoModelForCoordinationGeneration.from_pretrained(bert_path, **kwargs)
+    save_snapshot(model, tmp_path)
+    restored = AutoModelForCoordinationGeneration.from_pretrained(tmp_path)
+    assert restored.decoding_config()["precision"] == model.decoding_config()["precision"]
+    inputs = [("gold will retain its gain , he said .", (10, 25)), ("the market rose .", (4, 15))]
+    assert restored.generate(inputs) == model.generate(inputs)
+    with pytest.raises(ValueError):
+        AutoModelForCoordinationGeneration.from_pretrained(tmp_path, quantization="int8")
+
+
+def test_from_pretrained_snapshot_without_mmap(bert_path, tmp_path, monkeypatch):
+    model = AutoModelForCoordinationGeneration.from_pretrained(bert_path)
+    save_snapshot(model, tmp_path)
+    load = torch.load
+    calls = []
+
+    # NOTE: `torch.load` of torch<2.1, which has no `mmap` argument
+    def _load(f, map_location=None):
+        calls.append(f)
+        return load(f, map_location=map_location, weights_only=False)
+
+    monkeypatch.setattr(torch, "load", _load)
+    restored = AutoModelForCoordinationGeneration.from_pretrained(tmp_path)
+    assert len(calls) == 1
+    inputs = [("gold will retain its gain , he said .", (10, 25))]
+    assert restored.generate(inputs) == model.generate(inputs)
+
+
+def test_from_pretrained_shared_tokenizer(bert_path):
+    model = AutoModelForCoordinationGeneration.from_pretrained(bert_path)
+    other = AutoModelForCoordinationGeneration.from_pretrained(
+        bert_path, tokenizer=model.tokenizer, quantization="int8"
+    )
+    assert other.tokenizer is model.tokenizer
+    assert other._tokenizer_lock is model._tokenizer_lock
+    inputs = [("gold will retain its gain , he said .", (10, 25))]
+    assert other.generate(inputs)[0][0].startswith("gold will retain its gain and")
@@ -0,0 +1,115 @@
+import pytest
+
+from coordgen.models import BertForCoordinationGeneration
+
+
+def test_mask_predict(bert_model_and_tokenizer):
+    model = BertForCoordinationGeneration(
+        *bert_model_and_tokenizer,
+        decoding="mask_predict",
+        num_iterations=3,
+        length_offsets=(-1, 0, 2),
+    )
+    inputs = [
+        ("gold will retain its gain , he said .", (10, 25)),
+        ("the market rose sharply .", (4, 15)),
+        ("prices of stocks rose .", (0, 16)),
+    ]
+    outputs = model.generate(inputs)
+    assert outputs == [model.generate([x])[0] for x in inputs]
+    for (raw, span), (text, coord) in zip(inputs, outputs):
+        assert text[slice(*coord.conjuncts[0])] == raw[slice(*span)]
+        assert text[slice(*coord.cc)] == "and"
+
+
+def test_argmax(bert_model_and_tokenizer):
+    # NOTE: mask-predict without refinement rounds scores the views as argmax decoding does
+    model = BertForCoordinationGeneration(*bert_model_and_tokenizer, length_offsets=(-1, 0, 2))
+    single_pass = BertForCoordinationGeneration(
+        *bert_model_and_tokenizer,
+        decoding="mask_predict",
+        num_iterations=1,
+        length_offsets=(-1, 0, 2),
+    )
+    inputs = [("gold will retain its gain , he said .", (10, 25)), ("the market rose .", (4, 15))]
+    outputs = model.generate(inputs)
+    expected = single_pass.generate(inputs)
+    assert outputs == expected
+    assert [c.score for _, c in outputs] == pytest.approx([c.score for _, c in expected])
+    for raw, span in inputs:
+        batch = model._prepare_batch([(raw, span)]).features["batch"]
+        assert batch.input_ids.size(1) == model.input_length(raw, span)
+
+
+def test_pretokenize(bert_model_and_tokenizer):
+    model = BertForCoordinationGeneration(*bert_model_and_tokenizer, length_offsets=(0, 1))
+    fast_model = BertForCoordinationGeneration(
+        *bert_model_and_tokenizer, length_offsets=(0, 1), pretokenize=True
+    )
+    inputs = [
+        ("gold will retain its gain , he said .", (10, 25)),
+        ("the market rose sharply .", (4, 15)),
+        ("prices of stocks rose .", (0, 8)),
+        ("prices of stocks rose .", (1, 8)),  # not on token boundaries
+    ]
+    assert fast_model.generate(inputs) == model.generate(inputs)
+    for raw, span in inputs:
+        assert fast_model.input_length(raw, span) == model.input_length(raw, span)
+
+
+def test_generate_candidates(bert_model_and_tokenizer):
+    model = BertForCoordinationGeneration(
+        *bert_model_and_tokenizer, length_offsets=(-1, 0, 1), num_return_sequences=2
+    )
+    inputs = [("gold will retain its gain , he said .", (10, 25)), ("the market rose .", (4, 15))]
+    outputs = model.generate_candidates(inputs)
+    assert [candidates[0] for candidates in outputs] == model.generate(inputs)
+    for candidates in outputs:
+        assert len(candidates) == 2
+        assert candidates[0][1].score >= candidates[1][1].score
+
+
+@pytest.mark.parametrize("pretokenize", [False, True])
+def test_generate_variants(bert_model_and_tokenizer, pretokenize):
+    model = BertForCoordinationGeneration(*bert_model_and_tokenizer, pretokenize=pretokenize)
+    inputs = [("gold will retain its gain , he said .", (10, 25)), ("the market rose .", (4, 15))]
+    outputs = model.generate_variants(inputs, [["and", "or"], "or"])
+    assert [len(variants) for variants in outputs] == [2, 1]
+    assert outputs[0][0] == model.generate(inputs[:1])[0]
+    assert outputs[0][1] == model.generate(inputs[:1], ["or"])[0]
+    assert outputs[1][0] == model.generate(inputs[1:], ["or"])[0]
+    text, coord = outputs[0][1]
+    assert text[slice(*coord.cc)] == "or"
+
+
+def test_profile(bert_model_and_tokenizer):
+    model = BertForCoordinationGeneration(
+        *bert_model_and_tokenizer, decoding="mask_predict", num_iterations=3
+    )
+    inputs = [("gold will retain its gain , he said .", (10, 25)), ("the market rose .", (4, 15))]
+    with model.profile() as records:
+        outputs = model.generate(inputs)
+    model.generate(inputs)
+    assert outputs == model.generate(inputs)
+    assert len(records) == 1
+    stats = records[0]
+    assert stats.num_inputs == 2
+    assert set(stats.stage_times) >= {"embed_mask", "tokenize", "search", "model", "decode"}
+    assert stats.num_steps == 3
+    assert 0 < stats.num_tokens < stats.num_padded_tokens
+    assert 0.0 < stats.padding_ratio < 1.0
+    assert stats.elapsed >= sum(stats.stage_times[k] for k in ("tokenize", "search", "decode"))
+
+
+@pytest.mark.parametrize("pretokenize", [False, True])
+def test_generate_iter_pipelined(bert_model_and_tokenizer, pretokenize):
+    model = BertForCoordinationGeneration(
+        *bert_model_and_tokenizer, length_offsets=(0, 1), pretokenize=pretokenize
+    )
+    inputs = [
+        ("gold will retain its gain , he said .", (10, 25)),
+        ("the market rose sharply .", (4, 15)),
+        ("prices of stocks rose .", (0, 8)),
+    ] * 3
+    results = model.generate_iter(inputs, batch_size=2, num_workers=2, max_in_flight=2)
+    assert list(results) == model.generate(inputs)
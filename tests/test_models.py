@@ -1,4 +1,11 @@
+import subprocess
+import sys
+
+import torch
+import transformers
+
 import coordgen.models._utils as modeling_utils
+from coordgen.models.modeling_bert import _find_span_pairs
 
 
 def test_embed_mask():
@@ -16,3 +23,33 @@ def test_embed_coord():
     conj1, conj2 = coord.conjuncts
     assert s[conj1[0] : conj1[1]] == "retain its gain"
     assert s[conj2[0] : conj2[1]] == "rise further"
+
+
+def test_find_span_pairs():
+    ids = torch.tensor(
+        [
+            [1, 5, 9, 9, 6, 2, 5, 9, 9, 6, 2, 0],
+            [1, 9, 5, 2, 5, 5, 5, 9, 2, 0, 0, 0],
+        ]
+    )
+    positions, lengths = _find_span_pairs(ids, sep_token_id=2, mask_token_id=9)
+    assert lengths.tolist() == [2, 1]
+    assert positions[0].tolist() == [[2, 3], [1, 2]]
+    assert positions[1].tolist() == [[7, 8], [7, 8]]
+
+
+def test_span_tokenizer(tmp_path):
+    vocab_file = tmp_path / "vocab.txt"
+    vocab_file.write_text(
+        "\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "gold", "will", "retain"])
+    )
+    tokenizer = modeling_utils.SpanTokenizer(transformers.BertTokenizerFast(str(vocab_file)))
+    raw = "Gold will retain"
+    assert tokenizer.split(raw, (5, 16)) == ([4], [5, 6], [])
+    assert tokenizer.split(raw, (4, 9)) == ([4], [5], [6])
+    assert tokenizer.split(raw, (6, 9)) is None
+
+
+def test_lazy_import():
+    code = "import sys, coordgen.models; assert 'torch' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True)
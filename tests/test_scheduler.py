@@ -0,0 +1,115 @@
+import threading
+
+import pytest
+
+from coordgen import BatchScheduler, Coord, CoordinationGenerator
+from coordgen._core import PreparedBatch
+
+
+class _EchoGenerator(CoordinationGenerator):
+    def __init__(self):
+        self.batches = []
+
+    def generate(self, inputs):
+        inputs = list(inputs)
+        self.batches.append(inputs)
+        return [(raw, Coord(cc=span, conjuncts=[span, span])) for raw, span in inputs]
+
+
+def test_schedule():
+    scheduler = BatchScheduler(max_tokens=12)
+    batches = scheduler.schedule([5, 2, 3, 20, 3, 2])
+    assert batches == [[1, 5, 2, 4], [0], [3]]
+    assert BatchScheduler(max_tokens=12, max_batch_size=3).schedule([1] * 5) == [[0, 1, 2], [3, 4]]
+
+
+def test_run():
+    inputs = [(" ".join(["x"] * n), (0, 1)) for n in [4, 1, 7, 2, 1, 4, 9]]
+    generator = _EchoGenerator()
+    scheduler = BatchScheduler(max_tokens=12, buffer_size=4)
+    outputs = scheduler.run(generator, iter(inputs))
+    assert [raw for raw, _ in outputs] == [raw for raw, _ in inputs]
+    assert all(
+        len(batch) * max(len(raw.split()) + 1 for raw, _ in batch) <= 12 or len(batch) == 1
+        for batch in generator.batches
+    )
+
+
+def test_generate_iter():
+    inputs = [(" ".join(["x"] * n), (0, 1)) for n in [4, 1, 7, 2, 1, 4, 9]]
+    generator = _EchoGenerator()
+    consumed = []
+
+    def _inputs():
+        for x in inputs:
+            consumed.append(x)
+            yield x
+
+    results = generator.generate_iter(_inputs(), batch_size=2, max_in_flight=2)
+    assert next(results)[0] == inputs[0][0]
+    assert len(consumed) == 4
+    assert [raw for raw, _ in results] == [raw for raw, _ in inputs[1:]]
+
+
+class _StagedGenerator(_EchoGenerator):
+    def __init__(self, fail_at=None):
+        super().__init__()
+        self.fail_at = fail_at
+        self.threads = {"prepare": set(), "run": set(), "finish": set()}
+
+    def _prepare_batch(self, inputs, coordinators=None):
+        self.threads["prepare"].add(threading.current_thread().name)
+        return PreparedBatch(inputs, features={"upper": [raw.upper() for raw, _ in inputs]})
+
+    def _run_batch(self, batch):
+        self.threads["run"].add(threading.current_thread().name)
+        if self.fail_at is not None and self.fail_at in batch.features["upper"]:
+            raise RuntimeError("failed")
+        return self.generate(batch.inputs)
+
+    def _finish_batch(self, batch, outputs):
+        self.threads["finish"].add(threading.current_thread().name)
+        return [[(raw, coord)] for raw, (_, coord) in zip(batch.features["upper"], outputs)]
+
+
+def test_generate_iter_pipelined():
+    inputs = [(" ".join(["x"] * n), (0, 1)) for n in [4, 1, 7, 2, 1, 4, 9]]
+    generator = _StagedGenerator()
+    results = generator.generate_iter(inputs, batch_size=2, max_in_flight=2, num_workers=2)
+    assert [raw for raw, _ in results] == [raw.upper() for raw, _ in inputs]
+    main = threading.current_thread().name
+    assert all(main not in names for names in generator.threads.values())
+    assert all(name.startswith("coordgen-prepare") for name in generator.threads["prepare"])
+
+    # NOTE: generators without stages run everything in `_run_batch`
+    results = _EchoGenerator().generate_iter(inputs, batch_size=3, num_workers=1)
+    assert [raw for raw, _ in results] == [raw for raw, _ in inputs]
+
+    results = _StagedGenerator(fail_at="X X").generate_iter(inputs, batch_size=2, num_workers=1)
+    assert next(results)[0] == "X X X X"
+    with pytest.raises(RuntimeError):
+        list(results)
+
+
+def test_generate_iter_pipelined_close():
+    inputs = [(f"x{i}", (0, 1)) for i in range(10)]
+    generator = _StagedGenerator()
+    gate = threading.Event()
+    prepared = []
+
+    def _prepare_batch(inputs, coordinators=None):
+        prepared.append(inputs)
+        if len(prepared) > 1:
+            gate.wait()
+        return _StagedGenerator._prepare_batch(generator, inputs, coordinators)
+
+    generator._prepare_batch = _prepare_batch
+    results = generator.generate_iter(inputs, batch_size=1, max_in_flight=2, num_workers=1)
+    assert next(results)[0] == "X0"
+    results.close()
+    gate.set()
+    for thread in threading.enumerate():
+        if thread.name.startswith("coordgen-"):
+            thread.join(5)
+    # NOTE: the batches waiting to be prepared are cancelled once the consumer has gone away
+    assert len(prepared) == 2
@@ -0,0 +1,142 @@
+import os
+import random
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples")
+sys.path.insert(0, EXAMPLES_DIR)
+
+from common.data import Sentence, parse_trees  # noqa: E402
+from common.selectors import (  # noqa: E402
+    ConstituentSpanIndex,
+    IndexedConstituentSelector,
+    RandomConstituentSelector,
+    _hash,
+)
+
+TREES = [
+    "(S (NP (NNP Gold)) (VP (MD will) (VP (VB retain) (NP (PRP$ its) (NN gain)))) (. .))",
+    "(S (NP (DT the) (NN market)) (VP (VBD rose) (ADVP (RB sharply))) (. .))",
+    "(NP (NP (NNS prices)) (PP (IN of) (NP (NNS stocks))))",
+]
+
+
+def _sentences():
+    return [Sentence(" ".join(t.leaves()), t) for t in parse_trees("\n".join(TREES))]
+
+
+def _filter(node, span):
+    return node.label in {"NP", "VP"}
+
+
+def test_build():
+    sentences = _sentences()
+    index = ConstituentSpanIndex.build(sentences, exclude_root=True, filter=_filter)
+    assert len(index) == 3
+    assert sorted(index.labels) == ["NP", "VP"]
+    for row, sentence in enumerate(sentences):
+        assert sentence.raw in index and index.row(sentence.raw) == row
+        # NOTE: the candidates of `RandomConstituentSelector` with the same settings
+        selector = RandomConstituentSelector(exclude_root=True, filter=_filter)
+        expected = selector(sentence, num=100)
+        assert sorted(span for _, span in index.spans(row)) == sorted(expected)
+    assert "Gold will" not in index
+
+    raw = sentences[0].raw
+    spans = index.spans(0)
+    texts = ["Gold", "its gain", "retain its gain", "will retain its gain"]
+    assert [raw[s:e] for _, (s, e) in spans] == texts
+    assert [label for label, _ in spans] == ["NP", "NP", "VP", "VP"]
+    assert index.spans(0, labels={"VP"}) == spans[2:]
+    assert index.spans(2, labels={"VP"}) == []
+
+
+def test_sample():
+    index = ConstituentSpanIndex.build(_sentences())
+    spans = [span for _, span in index.spans(0)]
+
+    samples = index.sample(0, 3, rng=random.Random(0))
+    assert samples == index.sample(0, 3, rng=random.Random(0))
+    assert len(set(samples)) == 3 and set(samples) <= set(spans)
+    assert sorted(index.sample(0, 100, rng=random.Random(1))) == sorted(spans)
+
+    samples = index.sample(0, 100, replace=True, rng=random.Random(0))
+    assert samples == index.sample(0, 100, replace=True, rng=random.Random(0))
+    assert len(samples) == 100 and set(samples) <= set(spans)
+    assert len(set(samples)) < len(samples)
+
+    samples = index.sample(1, 10, replace=True, labels={"ADVP"}, rng=random.Random(0))
+    assert set(samples) == {span for _, span in index.spans(1, labels={"ADVP"})}
+    assert index.sample(2, 10, labels={"ADVP"}) == []
+
+    random.seed(0)
+    selector = IndexedConstituentSelector(index, labels={"NP"})
+    samples = selector(_sentences()[0], 2)
+    random.seed(0)
+    assert samples == index.sample(0, 2, labels={"NP"})
+
+
+def test_index_miss():
+    sentences = _sentences()
+    index = ConstituentSpanIndex.build(sentences[:2])
+    with pytest.raises(ValueError, match="prices of stocks"):
+        IndexedConstituentSelector(index)(sentences[2])
+    selector = IndexedConstituentSelector(index, fallback=RandomConstituentSelector())
+    random.seed(0)
+    samples = selector(sentences[2], 2)
+    random.seed(0)
+    assert samples == RandomConstituentSelector()(sentences[2], 2)
+
+    # NOTE: a duplicate sentence resolves to its first row
+    index = ConstituentSpanIndex.build(sentences + sentences[:1])
+    assert len(index) == 4 and index.row(sentences[0].raw) == 0
+
+
+def test_sample_all():
+    index = ConstituentSpanIndex.build(_sentences())
+    for replace in [False, True]:
+        results = list(index.sample_all(2, replace=replace, labels={"NP", "VP"}, seed=0))
+        assert results == list(index.sample_all(2, replace=replace, labels={"NP", "VP"}, seed=0))
+        assert [row for row, _ in results] == [0, 1, 2]
+        for row, samples in results:
+            candidates = {span for _, span in index.spans(row, labels={"NP", "VP"})}
+            assert len(samples) == 2 and set(samples) <= candidates
+            if not replace:
+                assert len(set(samples)) == 2
+
+    # NOTE: without replacement, a sentence with fewer candidates yields all of them
+    results = dict(index.sample_all(10, labels={"ADVP"}, seed=0))
+    assert results == {0: [], 1: [span for _, span in index.spans(1, labels={"ADVP"})], 2: []}
+    results = dict(index.sample_all(10, replace=True, labels={"ADVP"}, seed=0))
+    assert results[0] == results[2] == [] and len(results[1]) == 10
+
+
+def test_save_and_load(tmp_path):
+    sentences = _sentences()
+    index = ConstituentSpanIndex.build(sentences, filter=_filter)
+    path = tmp_path / "index.npz"
+    index.save(path)
+    loaded = ConstituentSpanIndex.load(path)
+    assert loaded.labels == index.labels
+    for name in ["keys", "offsets", "span_labels", "span_starts", "span_ends"]:
+        assert np.array_equal(getattr(loaded, name), getattr(index, name))
+    for row, sentence in enumerate(sentences):
+        assert loaded.row(sentence.raw) == row
+        assert loaded.spans(row) == index.spans(row)
+
+
+def test_hash():
+    raw = "Gold will retain its gain ."
+    assert _hash(raw) == 2287628660544415870
+    # NOTE: the keys must not depend on the hash seed of the process that built the index
+    code = f"from common.selectors import _hash; print(_hash({raw!r}))"
+    for seed in ["0", "1"]:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        env["PYTHONPATH"] = os.pathsep.join([EXAMPLES_DIR, os.path.join(EXAMPLES_DIR, "..")])
+        output = subprocess.run(
+            [sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True
+        )
+        assert int(output.stdout) == _hash(raw)
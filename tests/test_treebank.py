@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples"))
+
+from common.data import parse_trees  # noqa: E402
+from common.treebank import (  # noqa: E402
+    TreeStoreBuilder,
+    load_treebank,
+    parse_compact_trees,
+)
+
+TREEBANK = """\
+(S (NP (NNP Gold)) (VP (MD will) (VP (VB retain) (NP (PRP$ its) (NN gain)))) (. .))
+( (S (NP (PRP he)) (VP (VBD said)
+  (SBAR (S (NP (DT the) (NN market)) (VP (VBD rose) (ADVP (RB sharply))))))))
+(NP (NP (NNS prices)) (PP (IN of) (NP (-LRB- -LRB-) (NNS stocks) (-RRB- -RRB-))))
+"""
+
+
+def _flatten(tree):
+    return (
+        tree.label,
+        list(tree.leaves()),
+        [(node.label, node.is_preterminal, span) for node, span in tree.traverse()],
+    )
+
+
+def test_parse_compact_trees():
+    expected = [_flatten(tree) for tree in parse_trees(TREEBANK.splitlines(keepends=True))]
+    trees = list(parse_compact_trees(TREEBANK.splitlines(keepends=True)))
+    assert [_flatten(tree) for tree in trees] == expected
+    for tree in trees:
+        for node, (start, end) in tree.traverse():
+            assert list(node.leaves()) == list(tree.leaves())[start:end]
+    # NOTE: without a builder, each tree is held by a store of its own, over one vocabulary
+    assert len({id(tree.store) for tree in trees}) == len(trees)
+    assert all(len(tree.store) == 1 for tree in trees)
+    assert all(tree.store.words is trees[0].store.words for tree in trees)
+    assert sorted(trees[0].store.labels) == sorted(set(trees[0].store.labels))
+
+    builder = TreeStoreBuilder()
+    trees = list(parse_compact_trees(TREEBANK, builder))
+    assert [_flatten(tree) for tree in trees] == expected
+    store = builder.build()
+    assert len(store) == len(expected)
+    assert [_flatten(tree) for tree in store] == expected
+
+
+def test_load_treebank(tmp_path):
+    input_file = tmp_path / "train.mrg"
+    input_file.write_text(TREEBANK)
+    cache_dir = tmp_path / "cache"
+    expected = [_flatten(tree) for tree in parse_trees(TREEBANK)]
+
+    store = load_treebank(input_file, cache_dir)
+    assert [_flatten(tree) for tree in store] == expected
+    assert not isinstance(store.leaf_word, np.memmap)
+    store = load_treebank(input_file, cache_dir)
+    assert isinstance(store.leaf_word, np.memmap)
+    assert [_flatten(tree) for tree in store] == expected
+
+    # NOTE: the cache is rebuilt when the key in `source.json` does not match the input
+    with open(cache_dir / "source.json") as f:
+        key = json.load(f)
+    with open(cache_dir / "source.json", "w") as f:
+        json.dump(dict(key, mtime=key["mtime"] - 1), f)
+    store = load_treebank(input_file, cache_dir)
+    assert not isinstance(store.leaf_word, np.memmap)
+    with open(cache_dir / "source.json") as f:
+        assert json.load(f) == key
+
+    input_file.write_text(TREEBANK.split("\n(NP")[0] + "\n")
+    store = load_treebank(input_file, cache_dir)
+    assert [_flatten(tree) for tree in store] == expected[:2]
+    assert not isinstance(store.leaf_word, np.memmap)
+    assert len(load_treebank(input_file, cache_dir)) == 2